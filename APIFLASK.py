@@ -6,22 +6,23 @@ O Power BI chama essa API, ela busca na API CISP e insere no PostgreSQL
 """
 
 import os
-import requests
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from flask import Flask, jsonify, Response
 from flask_cors import CORS
 from datetime import datetime
-from requests.auth import HTTPBasicAuth
+from cliente_cisp import cliente_cisp, ErroCISP, STATUS_POR_ERRO_CISP
+import assinatura
+import rastreio
+from logs import obter as obter_log
 
 app = Flask(__name__)
 CORS(app)
+rastreio.instalar(app)
 
-# Configurações
-API_BASE_URL = "https://servicos.cisp.com.br/v1/avaliacao-analitica/raiz"
-API_USERNAME = os.environ.get('CISP_USERNAME')
-API_PASSWORD = os.environ.get('CISP_PASSWORD')
+log = obter_log("apiflask")
 
+# Configurações
 DB_CONFIG = {
     'host': '127.0.0.1',
     'port': '5432',
@@ -31,6 +32,9 @@ DB_CONFIG = {
     'options': '-c search_path=scsilverlayer'
 }
 
+# Prazo total da busca na CISP (leitura de até 30 s + retries)
+PRAZO_CISP = float(os.environ.get('APIFLASK_CISP_DEADLINE_S', '35'))
+
 def conectar_db():
     return psycopg2.connect(**DB_CONFIG)
 
@@ -80,21 +84,19 @@ def inserir_generico(cursor, tabela, dados, pk_cols=None):
     cursor.execute(sql, values)
 
 def buscar_api_cisp(raiz):
-    """Busca dados da API CISP"""
-    try:
-        url = f"{API_BASE_URL}/{raiz}"
-        response = requests.get(
-            url,
-            auth=HTTPBasicAuth(API_USERNAME, API_PASSWORD),
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            return response.json()
-        return None
-    except Exception as e:
-        print(f"❌ Erro ao buscar API: {e}")
-        return None
+    """Busca dados da API CISP. Falhas levantam ErroCISP (404, 429, timeout, 5xx, circuito aberto)."""
+    payload, _ = cliente_cisp.buscar_json(raiz, timeout=(cliente_cisp.timeout[0], 30), prazo=PRAZO_CISP)
+    return payload
+
+def resposta_erro_cisp(raiz, erro):
+    """Cada tipo de falha da CISP com o seu status (o mesmo mapa do app.py)"""
+    status = STATUS_POR_ERRO_CISP.get(erro.tipo, 502)
+    mensagem = 'Raiz não encontrada na API CISP' if erro.tipo == 'nao_encontrada' else str(erro)
+    resp = jsonify({'success': False, 'raiz': raiz, 'erro_tipo': erro.tipo, 'mensagem': mensagem})
+    resp.status_code = status
+    if erro.retry_after is not None:
+        resp.headers['Retry-After'] = str(max(1, int(erro.retry_after + 0.999)))
+    return resp
 
 def inserir_no_postgres(raiz, dados):
     """Insere TODOS os dados no PostgreSQL"""
@@ -139,6 +141,8 @@ def inserir_no_postgres(raiz, dados):
             "data_atualizacao": datetime.now(),
         }
         inserir_generico(cursor, "cisp_avaliacao_analitica", dados_principal, pk_cols=["raiz"])
+        # filhas regravadas por fora do app.py: as assinaturas das seções deixam de valer
+        assinatura.esquecer(cursor, raiz)
         
         if tabela_tem_coluna(cursor, "cisp_restritivas", "raiz"):
             cursor.execute("DELETE FROM cisp_restritivas WHERE raiz = %s", (raiz,))
@@ -208,7 +212,7 @@ def inserir_no_postgres(raiz, dados):
         
     except Exception as e:
         conn.rollback()
-        print(f"❌ Erro ao inserir: {e}")
+        log.error("Erro ao inserir raiz %s: %s", raiz, e)
         return False
     finally:
         cursor.close()
@@ -346,33 +350,25 @@ def sincronizar(raiz):
     2. Insere no PostgreSQL
     3. Retorna sucesso/erro
     """
-    print(f"\n{'='*60}")
-    print(f"📡 REQUISIÇÃO RECEBIDA DO POWER BI")
-    print(f"   Raiz: {raiz}")
-    print(f"{'='*60}\n")
+    log.info("Requisição do Power BI: raiz %s", raiz)
     
     try:
         # Passo 1: Buscar na API CISP
-        print(f"1️⃣  Buscando raiz {raiz} na API CISP...")
-        dados = buscar_api_cisp(raiz)
-        
-        if not dados:
-            print(f"❌ Raiz {raiz} não encontrada na API CISP")
-            return jsonify({
-                'success': False,
-                'raiz': raiz,
-                'mensagem': 'Raiz não encontrada na API CISP'
-            }), 404
-        
-        print(f"✅ Dados obtidos da API CISP")
+        log.debug("Buscando raiz %s na API CISP", raiz)
+        try:
+            with rastreio.span("cisp"):
+                dados = buscar_api_cisp(raiz)
+        except ErroCISP as e:
+            log.warning("Falha ao buscar raiz %s na API CISP [%s]: %s", raiz, e.tipo, e)
+            return resposta_erro_cisp(raiz, e)
         
         # Passo 2: Inserir no PostgreSQL
-        print(f"2️⃣  Inserindo dados no PostgreSQL...")
-        sucesso = inserir_no_postgres(raiz, dados)
+        log.debug("Inserindo raiz %s no PostgreSQL", raiz)
+        with rastreio.span("gravar"):
+            sucesso = inserir_no_postgres(raiz, dados)
         
         if sucesso:
-            print(f"✅ Raiz {raiz} sincronizada com sucesso!")
-            print(f"\n{'='*60}\n")
+            log.info("Raiz %s sincronizada com sucesso", raiz)
             return jsonify({
                 'success': True,
                 'raiz': raiz,
@@ -380,7 +376,7 @@ def sincronizar(raiz):
                 'timestamp': str(datetime.now())
             })
         else:
-            print(f"❌ Erro ao inserir no PostgreSQL")
+            log.error("Erro ao inserir raiz %s no PostgreSQL", raiz)
             return jsonify({
                 'success': False,
                 'raiz': raiz,
@@ -388,7 +384,7 @@ def sincronizar(raiz):
             }), 500
         
     except Exception as e:
-        print(f"❌ ERRO: {e}")
+        log.exception("Erro ao sincronizar raiz %s: %s", raiz, e)
         return jsonify({
             'success': False,
             'raiz': raiz,
@@ -603,7 +599,7 @@ def pagina():
 # =============================================================================
 
 if __name__ == '__main__':
-    print("""
+    log.info("""
 ╔════════════════════════════════════════════════════════════════╗
 ║                  API CISP PARA POWER BI                        ║
 ║                    RODANDO NA PORTA 5000                       ║
@@ -0,0 +1,431 @@
+"""
+AGENDADOR DE ATUALIZAÇÃO DA CARTEIRA
+
+Ressincroniza em segundo plano as raízes da watchlist (cisp_watchlist), para
+que as consultas do portal/Power BI encontrem o banco já atualizado:
+
+- só entram na fila raízes gravadas há mais de AGENDA_IDADE_ALVO_S segundos
+  (ou nunca gravadas)
+- prioridade = idade do registro (data_atualizacao) x frequência de acesso;
+  a frequência é uma contagem de acessos com meia-vida de AGENDA_MEIA_VIDA_H
+- orçamento de AGENDA_ORCAMENTO_HORA chamadas à CISP por hora, contado no
+  banco (vale para todas as instâncias do agendador); as chamadas saem
+  espaçadas ao longo da hora, não em rajada
+- só roda dentro das janelas AGENDA_JANELAS (ex.: "22:00-06:00,12:00-13:30",
+  hora local do processo; vazio = o dia todo)
+- várias instâncias podem rodar juntas: cada raiz é reservada com
+  FOR UPDATE SKIP LOCKED
+
+Raízes entram na watchlist por POST /api/agenda/raizes e, com
+AGENDA_INCLUIR_ACESSADAS=1, ao serem consultadas na API: os acessos são
+contados em memória e gravados a cada AGENDA_ACESSOS_FLUSH_S segundos.
+
+Rode separado com `python agendador.py` ou dentro da API com AGENDA_NO_PROCESSO=1.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from psycopg2.extras import execute_values
+
+from cliente_cisp import ErroCISP, CISPNaoEncontrada
+from esquema import esquema, OPCOES_RAIZ
+from frescor import COLUNAS_ATUALIZACAO
+from leitura import TABELA_PRINCIPAL
+from lote import normalizar_raiz, deduplicar
+from logs import obter as obter_log
+
+log = obter_log("agendador")
+
+TABELA_WATCHLIST = "cisp_watchlist"
+
+AGENDA_ORCAMENTO_HORA = int(os.environ.get('AGENDA_ORCAMENTO_HORA', '600'))
+AGENDA_JANELAS = os.environ.get('AGENDA_JANELAS', '')
+AGENDA_IDADE_ALVO_S = float(os.environ.get('AGENDA_IDADE_ALVO_S', '43200'))
+AGENDA_REPETIR_FALHA_S = float(os.environ.get('AGENDA_REPETIR_FALHA_S', '3600'))
+AGENDA_MEIA_VIDA_H = float(os.environ.get('AGENDA_MEIA_VIDA_H', '168'))
+AGENDA_WORKERS = int(os.environ.get('AGENDA_WORKERS', '2'))
+AGENDA_OCIOSO_S = float(os.environ.get('AGENDA_OCIOSO_S', '60'))
+AGENDA_INCLUIR_ACESSADAS = os.environ.get('AGENDA_INCLUIR_ACESSADAS', '1') not in ('0', 'false', 'False')
+AGENDA_ACESSOS_FLUSH_S = float(os.environ.get('AGENDA_ACESSOS_FLUSH_S', '60'))
+AGENDA_NO_PROCESSO = os.environ.get('AGENDA_NO_PROCESSO', '0') in ('1', 'true', 'True')
+
+# ultimo_status de cada raiz na watchlist
+EXECUTANDO = "executando"
+OK = "ok"
+NAO_ENCONTRADA = "nao_encontrada"
+ERRO = "erro"
+
+SQL_CRIAR_TABELA = f"""
+    CREATE TABLE IF NOT EXISTS {TABELA_WATCHLIST} (
+        raiz text PRIMARY KEY,
+        origem text NOT NULL DEFAULT 'manual',
+        frequencia double precision NOT NULL DEFAULT 0,
+        ultimo_acesso timestamp,
+        incluida_em timestamp NOT NULL DEFAULT now(),
+        ultima_tentativa timestamp,
+        ultimo_status text,
+        ultimo_erro text
+    );
+    CREATE INDEX IF NOT EXISTS {TABELA_WATCHLIST}_tentativa_idx ON {TABELA_WATCHLIST} (ultima_tentativa)
+"""
+
+
+def garantir_tabela(cursor):
+    """Cria tabela e índices só se a tabela não existir (CREATE INDEX IF NOT EXISTS pede lock mesmo sem criar)"""
+    cursor.execute("SELECT to_regclass(%s) AS tabela", (TABELA_WATCHLIST,))
+    row = cursor.fetchone()
+    if (row["tabela"] if isinstance(row, dict) else row[0]) is not None:
+        return
+    cursor.execute(SQL_CRIAR_TABELA)
+
+
+def ler_janelas(texto):
+    """"22:00-06:00,12:00-13:30" -> [(minuto inicial, minuto final)]; vazio = o dia todo"""
+    janelas = []
+    for parte in (texto or "").split(","):
+        parte = parte.strip()
+        if not parte:
+            continue
+        try:
+            ini, fim = (datetime.strptime(h.strip(), "%H:%M") for h in parte.split("-"))
+        except ValueError:
+            raise ValueError(f"janela inválida: {parte} (use HH:MM-HH:MM)")
+        janelas.append((ini.hour * 60 + ini.minute, fim.hour * 60 + fim.minute))
+    return janelas
+
+
+def em_janela(janelas, momento):
+    if not janelas:
+        return True
+    m = momento.hour * 60 + momento.minute
+    for ini, fim in janelas:
+        if ini <= m < fim or (ini > fim and (m >= ini or m < fim)):
+            return True
+    return False
+
+
+def _frequencia(momento):
+    """Frequência de acesso decaída até `momento` (expressão SQL sobre o alias w)"""
+    return (
+        f"w.frequencia * power(0.5, GREATEST(0, extract(epoch FROM {momento} - COALESCE(w.ultimo_acesso, {momento})))"
+        f" / 3600.0 / {float(AGENDA_MEIA_VIDA_H)})"
+    )
+
+
+# ----------------------------------------------------------------------
+# Watchlist
+
+def incluir(cursor, raizes):
+    """Inclui (ou confirma como manuais) as raízes; devolve quantas eram válidas"""
+    raizes = deduplicar(raizes)
+    if raizes:
+        execute_values(
+            cursor,
+            f"INSERT INTO {TABELA_WATCHLIST} (raiz, origem) VALUES %s "
+            f"ON CONFLICT (raiz) DO UPDATE SET origem = 'manual'",
+            [(r, "manual") for r in raizes],
+        )
+    return len(raizes)
+
+
+def remover(cursor, raiz):
+    cursor.execute(f"DELETE FROM {TABELA_WATCHLIST} WHERE raiz = %s", (normalizar_raiz(raiz) or raiz,))
+    return cursor.rowcount
+
+
+class RegistroAcessos:
+    """Conta os acessos por raiz em memória e os grava na watchlist de tempos em tempos"""
+
+    def __init__(self, incluir_novas=AGENDA_INCLUIR_ACESSADAS):
+        self.incluir_novas = incluir_novas
+        self._contagem = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def registrar(self, raiz):
+        raiz = normalizar_raiz(raiz)
+        if raiz:
+            with self._lock:
+                self._contagem[raiz] = self._contagem.get(raiz, 0) + 1
+
+    def descarregar(self, conexao):
+        with self._lock:
+            contagem, self._contagem = self._contagem, {}
+        if not contagem:
+            return 0
+        agora = datetime.now()
+        linhas = [(raiz, n, agora) for raiz, n in contagem.items()]
+        try:
+            with conexao() as conn:
+                cursor = conn.cursor()
+                try:
+                    if self.incluir_novas:
+                        execute_values(
+                            cursor,
+                            f"INSERT INTO {TABELA_WATCHLIST} AS w (raiz, frequencia, ultimo_acesso, origem) VALUES %s "
+                            f"ON CONFLICT (raiz) DO UPDATE SET "
+                            f"frequencia = {_frequencia('EXCLUDED.ultimo_acesso')} + EXCLUDED.frequencia, "
+                            f"ultimo_acesso = EXCLUDED.ultimo_acesso",
+                            linhas, template="(%s, %s, %s, 'acesso')",
+                        )
+                    else:
+                        execute_values(
+                            cursor,
+                            f"UPDATE {TABELA_WATCHLIST} w SET frequencia = {_frequencia('a.em')} + a.n, ultimo_acesso = a.em "
+                            f"FROM (VALUES %s) AS a (raiz, n, em) WHERE w.raiz = a.raiz",
+                            linhas,
+                        )
+                    conn.commit()
+                finally:
+                    cursor.close()
+        except Exception:
+            # devolve as contagens para a próxima tentativa
+            with self._lock:
+                for raiz, n in contagem.items():
+                    self._contagem[raiz] = self._contagem.get(raiz, 0) + n
+            raise
+        return len(linhas)
+
+    def iniciar(self, conexao, intervalo=AGENDA_ACESSOS_FLUSH_S):
+        if self._thread is not None:
+            return
+
+        def laco():
+            while True:
+                time.sleep(intervalo)
+                try:
+                    self.descarregar(conexao)
+                except Exception as e:
+                    log.warning("Acessos não gravados na watchlist: %s", e)
+
+        self._thread = threading.Thread(target=laco, name="agenda-acessos", daemon=True)
+        self._thread.start()
+
+
+acessos = RegistroAcessos()
+
+
+# ----------------------------------------------------------------------
+# Agendador
+
+class Agendador:
+    """
+    sincronizar(raiz) -> resultado da gravação (None = falhou); falhas da CISP levantam ErroCISP
+    conexao()         (context manager do pool)
+    """
+
+    def __init__(self, sincronizar, conexao, orcamento_hora=AGENDA_ORCAMENTO_HORA,
+                 janelas=AGENDA_JANELAS, workers=AGENDA_WORKERS):
+        self.sincronizar = sincronizar
+        self.conexao = conexao
+        self.orcamento_hora = max(1, orcamento_hora)
+        self.intervalo = 3600.0 / self.orcamento_hora
+        self.janelas_texto = janelas
+        self.janelas = ler_janelas(janelas)
+        self.workers = max(1, workers)
+        self._compilado = (None, None)   # (versão do esquema, sql da fila)
+        self._parar = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._estado = "parado"
+        self._stats = {"sincronizadas": 0, "nao_encontradas": 0, "falhas": 0, "ultima_raiz": None, "ultima_em": None}
+
+    # -- SQL ------------------------------------------------------------
+    def _fila(self, snap):
+        """FROM/WHERE das raízes vencidas e as expressões de idade e prioridade"""
+        versao, sql = self._compilado
+        if versao == snap.versao:
+            return sql
+        cols = snap.colunas_de(TABELA_PRINCIPAL)
+        raiz = next((c for c in OPCOES_RAIZ if c in cols), None)
+        atual = [f"p.{c}" for c in COLUNAS_ATUALIZACAO if c in cols]
+        if raiz is None or not atual:
+            juncao, atualizado = "", "NULL::timestamp"
+        else:
+            juncao = f" LEFT JOIN {TABELA_PRINCIPAL} p ON p.{raiz} = w.raiz"
+            atualizado = atual[0] if len(atual) == 1 else f"GREATEST({', '.join(atual)})"
+        idade = f"extract(epoch FROM %(agora)s - {atualizado})"
+        sql = {
+            "de": (
+                f"FROM {TABELA_WATCHLIST} w{juncao}"
+                f" WHERE (w.ultima_tentativa IS NULL OR w.ultima_tentativa < %(agora)s - make_interval(secs =>"
+                f" CASE WHEN w.ultimo_status = '{NAO_ENCONTRADA}' THEN %(alvo)s ELSE %(repetir)s END))"
+                f" AND ({atualizado} IS NULL OR {atualizado} < %(agora)s - make_interval(secs => %(alvo)s))"
+            ),
+            "idade": idade,
+            "prioridade": f"COALESCE({idade}, 1e12) * (1 + ln(1 + {_frequencia('%(agora)s')}))",
+        }
+        self._compilado = (snap.versao, sql)
+        return sql
+
+    def _params(self, agora, **extra):
+        return {"agora": agora, "alvo": AGENDA_IDADE_ALVO_S, "repetir": AGENDA_REPETIR_FALHA_S, **extra}
+
+    def _usadas(self, cursor, agora):
+        """Chamadas do agendador (todas as instâncias) na última hora"""
+        cursor.execute(
+            f"SELECT count(*) FROM {TABELA_WATCHLIST} WHERE ultima_tentativa > %s",
+            (agora - timedelta(hours=1),),
+        )
+        return cursor.fetchone()[0]
+
+    def _reservar(self, cursor, snap, agora):
+        """Marca a próxima raiz da fila como em execução (e a conta no orçamento)"""
+        fila = self._fila(snap)
+        cursor.execute(
+            f"WITH c AS (SELECT w.raiz {fila['de']} ORDER BY {fila['prioridade']} DESC, w.raiz LIMIT 1"
+            f" FOR UPDATE OF w SKIP LOCKED)"
+            f" UPDATE {TABELA_WATCHLIST} w SET ultima_tentativa = %(agora)s, ultimo_status = '{EXECUTANDO}'"
+            f" FROM c WHERE w.raiz = c.raiz RETURNING w.raiz",
+            self._params(agora),
+        )
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def resumo(self, cursor, snap, limite=20):
+        """Tamanho da watchlist, fila vencida, orçamento usado e as próximas raízes"""
+        agora = datetime.now()
+        fila = self._fila(snap)
+        cursor.execute(
+            f"SELECT count(*) FILTER (WHERE origem = 'manual'), count(*) FILTER (WHERE origem = 'acesso'),"
+            f" count(*) FILTER (WHERE ultimo_status = '{ERRO}'), count(*) FILTER (WHERE ultimo_status = '{NAO_ENCONTRADA}')"
+            f" FROM {TABELA_WATCHLIST}"
+        )
+        manuais, acessadas, com_erro, nao_encontradas = cursor.fetchone()
+        cursor.execute(f"SELECT count(*) {fila['de']}", self._params(agora))
+        vencidas = cursor.fetchone()[0]
+        cursor.execute(
+            f"SELECT w.raiz, {fila['idade']}, {_frequencia('%(agora)s')} {fila['de']}"
+            f" ORDER BY {fila['prioridade']} DESC, w.raiz LIMIT %(limite)s",
+            self._params(agora, limite=limite),
+        )
+        proximas = [
+            {"raiz": r, "idade_s": round(i) if i is not None else None, "frequencia": round(f, 3)}
+            for r, i, f in cursor.fetchall()
+        ]
+        return {
+            "total": manuais + acessadas,
+            "manuais": manuais,
+            "por_acesso": acessadas,
+            "com_erro": com_erro,
+            "nao_encontradas": nao_encontradas,
+            "vencidas": vencidas,
+            "orcamento_hora": self.orcamento_hora,
+            "usadas_ultima_hora": self._usadas(cursor, agora),
+            "proximas": proximas,
+        }
+
+    # -- execução -------------------------------------------------------
+    def estatisticas(self):
+        with self._lock:
+            return {
+                "estado": self._estado,
+                "janelas": self.janelas_texto or "sempre",
+                "em_janela": em_janela(self.janelas, datetime.now()),
+                "orcamento_hora": self.orcamento_hora,
+                "intervalo_s": round(self.intervalo, 3),
+                "workers": self.workers,
+                **self._stats,
+            }
+
+    def _marcar_estado(self, estado):
+        with self._lock:
+            self._estado = estado
+
+    def _passo(self, executor, vagas):
+        """Dispara no máximo uma raiz; devolve quantos segundos esperar até o próximo passo"""
+        agora = datetime.now()
+        if not em_janela(self.janelas, agora):
+            self._marcar_estado("fora_da_janela")
+            return AGENDA_OCIOSO_S
+        if not vagas.acquire(blocking=False):
+            return min(1.0, self.intervalo)
+        raiz = None
+        try:
+            with self.conexao() as conn:
+                cursor = conn.cursor()
+                try:
+                    if self._usadas(cursor, agora) >= self.orcamento_hora:
+                        self._marcar_estado("orcamento_esgotado")
+                    else:
+                        raiz = self._reservar(cursor, esquema.atual(cursor), agora)
+                        self._marcar_estado("executando" if raiz else "em_dia")
+                    conn.commit()
+                finally:
+                    cursor.close()
+        except Exception as e:
+            vagas.release()
+            self._marcar_estado("erro_banco")
+            log.warning("Falha ao ler a watchlist: %s", e)
+            return AGENDA_OCIOSO_S
+        if raiz is None:
+            vagas.release()
+            return AGENDA_OCIOSO_S
+        executor.submit(self._sincronizar, raiz, vagas)
+        return self.intervalo
+
+    def _sincronizar(self, raiz, vagas):
+        status, erro = OK, None
+        try:
+            if self.sincronizar(raiz) is None:
+                status, erro = ERRO, "falha ao gravar no PostgreSQL"
+        except CISPNaoEncontrada:
+            status = NAO_ENCONTRADA
+        except ErroCISP as e:
+            status, erro = ERRO, f"{e.tipo}: {e}"
+        except Exception as e:
+            status, erro = ERRO, str(e)
+        finally:
+            vagas.release()
+        with self._lock:
+            chave = {OK: "sincronizadas", NAO_ENCONTRADA: "nao_encontradas"}.get(status, "falhas")
+            self._stats[chave] += 1
+            self._stats["ultima_raiz"] = raiz
+            self._stats["ultima_em"] = datetime.now().isoformat()
+        try:
+            with self.conexao() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(
+                        f"UPDATE {TABELA_WATCHLIST} SET ultimo_status = %s, ultimo_erro = %s WHERE raiz = %s",
+                        (status, erro, raiz),
+                    )
+                    conn.commit()
+                finally:
+                    cursor.close()
+        except Exception as e:
+            log.warning("Status de %s não gravado: %s", raiz, e)
+
+    def executar(self):
+        """Laço do agendador (bloqueia até parar())"""
+        self._parar.clear()
+        vagas = threading.BoundedSemaphore(self.workers)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="agenda") as executor:
+            while not self._parar.is_set():
+                self._parar.wait(self._passo(executor, vagas))
+        self._marcar_estado("parado")
+
+    def iniciar(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self.executar, name="agendador", daemon=True)
+        self._thread.start()
+
+    def parar(self):
+        self._parar.set()
+
+
+if __name__ == "__main__":
+    # Processo separado: mesma gravação da API (app.py), sem servir HTTP
+    import app
+
+    ag = app.agendador
+    print(f"⏰ Agendador CISP: {ag.orcamento_hora} chamadas/h, janelas: {ag.janelas_texto or 'sempre'}, workers: {ag.workers}")
+    try:
+        ag.executar()
+    except KeyboardInterrupt:
+        ag.parar()
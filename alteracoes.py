@@ -0,0 +1,143 @@
+"""
+FEED DE ALTERAÇÕES (carga incremental)
+
+GET /api/alteracoes?desde=<watermark> devolve as raízes gravadas depois do
+watermark (data_atualizacao de cisp_avaliacao_analitica), com o documento
+completo de cada uma, em páginas:
+
+- ordem estável por (data_atualizacao, raiz) com paginação por chave: cada
+  página continua exatamente de onde a anterior parou, sem OFFSET
+- "proximo_cursor" leva à página seguinte; null = acabou
+- "watermark" é o limite superior desta varredura: guarde-o só depois da
+  última página e use-o como ?desde= na próxima carga
+
+O limite superior fica FEED_MARGEM_SEGUNDOS no passado: data_atualizacao é
+carimbada antes do commit, e um lote ainda aberto pode tornar visível depois
+uma linha com horário anterior. A entrega é "pelo menos uma vez": uma raiz
+pode voltar em duas cargas, nunca ser perdida.
+"""
+
+import os
+import json
+import base64
+import threading
+from datetime import datetime, timedelta
+
+from esquema import OPCOES_RAIZ
+from leitura import TABELA_PRINCIPAL, compilar
+
+FEED_MARGEM_SEGUNDOS = float(os.environ.get('FEED_MARGEM_SEGUNDOS', '60'))
+FEED_LIMITE_PADRAO = int(os.environ.get('FEED_LIMITE_PADRAO', '500'))
+FEED_LIMITE_MAX = int(os.environ.get('FEED_LIMITE_MAX', '5000'))
+
+COLUNA_WATERMARK = "data_atualizacao"
+
+
+class CursorInvalido(ValueError):
+    pass
+
+
+def codificar_cursor(desde, ate, ultimo_ts, ultima_raiz):
+    bruto = json.dumps({
+        "d": desde.isoformat() if desde else None,
+        "a": ate.isoformat(),
+        "t": ultimo_ts.isoformat(),
+        "r": ultima_raiz,
+    }, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(bruto).decode("ascii").rstrip("=")
+
+
+def decodificar_cursor(token):
+    try:
+        bruto = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        d = json.loads(bruto)
+        return (
+            datetime.fromisoformat(d["d"]) if d["d"] else None,
+            datetime.fromisoformat(d["a"]),
+            datetime.fromisoformat(d["t"]),
+            str(d["r"]),
+        )
+    except Exception:
+        raise CursorInvalido("cursor inválido")
+
+
+def _momento(valor):
+    if not valor:
+        return None
+    try:
+        return datetime.fromisoformat(str(valor))
+    except ValueError:
+        raise ValueError("desde inválido (use o watermark devolvido, AAAA-MM-DDTHH:MM:SS)")
+
+
+class FeedAlteracoes:
+    def __init__(self):
+        self._compilado = {}   # (versão do esquema, com documentos) -> sql
+        self._lock = threading.Lock()
+
+    def _sql(self, snap, documentos):
+        chave = (snap.versao, documentos)
+        sql = self._compilado.get(chave)
+        if sql is not None:
+            return sql
+        cols = snap.colunas_de(TABELA_PRINCIPAL)
+        if COLUNA_WATERMARK not in cols:
+            raise ValueError(f"{TABELA_PRINCIPAL} não tem a coluna {COLUNA_WATERMARK}")
+        raiz = next((c for c in OPCOES_RAIZ if c in cols), None)
+        if raiz is None:
+            raise ValueError(f"{TABELA_PRINCIPAL} não tem coluna de raiz")
+        pagina = (
+            f"(SELECT t.{raiz}::text AS raiz, t.{COLUNA_WATERMARK} AS ts FROM {TABELA_PRINCIPAL} t"
+            f" WHERE t.{COLUNA_WATERMARK} <= %(ate)s"
+            f" AND t.{COLUNA_WATERMARK} >= %(ts)s"
+            f" AND (t.{COLUNA_WATERMARK} > %(ts)s OR t.{raiz} > %(raiz)s)"
+            f" ORDER BY t.{COLUNA_WATERMARK}, t.{raiz} LIMIT %(limite)s) k"
+        )
+        if documentos:
+            sql = compilar(snap, fonte=pagina, colunas_fonte=("raiz", "ts"), ordem="k.ts, k.raiz")
+        else:
+            sql = f"SELECT k.raiz, k.ts FROM {pagina} ORDER BY k.ts, k.raiz"
+        with self._lock:
+            self._compilado = {c: s for c, s in self._compilado.items() if c[0] == snap.versao}
+            self._compilado[chave] = sql
+        return sql
+
+    def pagina(self, cursor, snap, desde=None, token=None, limite=None, documentos=True):
+        """Uma página do feed, pronta para jsonify"""
+        limite = max(1, min(int(limite or FEED_LIMITE_PADRAO), FEED_LIMITE_MAX))
+        if token:
+            desde, ate, ultimo_ts, ultima_raiz = decodificar_cursor(token)
+        else:
+            desde = _momento(desde)
+            ate = datetime.now() - timedelta(seconds=FEED_MARGEM_SEGUNDOS)
+            # desde é exclusivo (raiz NULL: nada do mesmo instante entra)
+            ultimo_ts, ultima_raiz = desde or datetime.min, None
+
+        cursor.execute(self._sql(snap, documentos), {
+            "ate": ate, "ts": ultimo_ts, "raiz": ultima_raiz, "limite": limite,
+        })
+        linhas = cursor.fetchall()
+
+        itens = []
+        for linha in linhas:
+            valores = list(linha.values()) if isinstance(linha, dict) else list(linha)
+            item = {"raiz": valores[0], "data_atualizacao": valores[1].isoformat()}
+            if documentos:
+                item["documento"] = json.loads(valores[3])
+            itens.append(item)
+
+        proximo = None
+        if len(linhas) == limite:
+            ult = list(linhas[-1].values()) if isinstance(linhas[-1], dict) else linhas[-1]
+            proximo = codificar_cursor(desde, ate, ult[1], ult[0])
+        return {
+            "success": True,
+            "desde": desde.isoformat() if desde else None,
+            "watermark": ate.isoformat(),
+            "quantidade": len(itens),
+            "proximo_cursor": proximo,
+            "itens": itens,
+        }
+
+
+feed_alteracoes = FeedAlteracoes()
@@ -3,18 +3,21 @@ API FLASK PARA POWER BI + PORTAL WEB (UI) PARA CONSULTA DE RAIZ CNPJ
 Porta: 5000
 
 - /api/sincronizar/<raiz>  -> busca na API CISP e grava no Postgres
-- /api/cliente/<raiz>      -> retorna dados do Postgres
+- /api/sincronizar/lote    -> POST com várias raízes; progresso por job_id
+- /api/cliente/<raiz>      -> busca na CISP uma vez, grava e retorna os dados
+                              (?modo=leitura: só Postgres)
+- /api/agenda              -> watchlist do agendador de atualização (agendador.py)
+- /api/fila                -> fila de sincronização no Postgres (fila.py)
 - /                         -> página web profissional para consulta
 """
 
 import os
-import requests
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from flask import Flask, jsonify, render_template
+import json
+import time
+from psycopg2.extras import RealDictCursor, execute_values
+from flask import Flask, g, jsonify, render_template, request
 from flask_cors import CORS
 from datetime import datetime
-from requests.auth import HTTPBasicAuth
 
 # Carrega .env automaticamente (opcional) 
 try:
@@ -27,21 +30,35 @@ app = Flask(__name__, static_folder="static", template_folder="templates")
 CORS(app)
 
 # Configurações
-API_BASE_URL = "https://servicos.cisp.com.br/v1/avaliacao-analitica/raiz"
-API_USERNAME = os.environ.get('CISP_USERNAME')
-API_PASSWORD = os.environ.get('CISP_PASSWORD')
-
-DB_CONFIG = {
-    'host': os.environ.get('DB_HOST', '127.0.0.1'),
-    'port': os.environ.get('DB_PORT', '5432'),
-    'database': os.environ.get('DB_NAME', 'dbDataLakePrd'),
-    'user': os.environ.get('DB_USER', 'postgres'),
-    'password': os.environ.get('POSTGRES'),
-    'options': f"-c search_path={os.environ.get('DB_SCHEMA', 'scsilverlayer')}"
-}
+from cliente_cisp import cliente_cisp, API_BASE_URL, ErroCISP, STATUS_POR_ERRO_CISP
+from banco import pool, conexao, WAITRESS_THREADS
+from cache_cisp import cache_payload
+import arquivo_cisp
+from arquivo_cisp import arquivo_payload
+import frescor
+from singleflight import voo_unico
+from lote import GerenciadorLotes, raizes_de_csv
+from esquema import esquema, OPCOES_RAIZ
+from leitura import leitor_documento, documento_completo, LISTAS as LISTAS_DOCUMENTO
+import exportacao
+from alteracoes import feed_alteracoes
+import assinatura
+import mesclagem
+import derivados
+import historico
+from historico import historico_clientes
+import migracoes
+import agendador as agenda
+import fila
+import metricas
+import rastreio
+from logs import obter as obter_log
+from metricas import (
+    CISP_BUSCA, DB_CONSULTA, DB_COMMIT, GRAVACAO, LINHAS_GRAVADAS, SECOES_INALTERADAS,
+    HTTP_DURACAO, HTTP_EM_ANDAMENTO, CLIENTE_DOCUMENTO,
+)
 
-def conectar_db():
-    return psycopg2.connect(**DB_CONFIG)
+log = obter_log("app")
 
 def converter_data(data_str):
     if not data_str:
@@ -51,559 +68,715 @@ def converter_data(data_str):
     except Exception:
         return None
 
-_cols_cache = {}
-
 def obter_colunas(cursor, tabela):
-    if tabela in _cols_cache:
-        return _cols_cache[tabela]
-    cursor.execute("""
-        SELECT column_name
-        FROM information_schema.columns
-        WHERE table_schema = (SELECT current_schema())
-          AND table_name = %s
-          ORDER BY ordinal_position
-    """, (tabela,))
-    rows = cursor.fetchall()
-    cols = [(r.get('column_name') if isinstance(r, dict) else r[0]) for r in rows]
-    _cols_cache[tabela] = cols
-    return cols
-
+    """Colunas da tabela segundo o snapshot de esquema (carregado uma vez; ver esquema.py)"""
+    return list(esquema.atual(cursor).colunas_de(tabela))
 
 def tabela_tem_coluna(cursor, tabela, coluna):
-    return coluna in obter_colunas(cursor, tabela)
+    return coluna in esquema.atual(cursor).colunas_de(tabela)
 
 def escolher_col(cursor, tabela, opcoes):
-    cols = obter_colunas(cursor, tabela)
+    cols = esquema.atual(cursor).colunas_de(tabela)
     for c in opcoes:
         if c in cols:
             return c
     return None
 
 def tabela_existe(cursor, tabela):
-    cursor.execute("""
-        SELECT EXISTS (
-            SELECT 1 FROM information_schema.tables
-            WHERE table_schema = (SELECT current_schema())
-              AND table_name = %s
-        )
-    """, (tabela,))
-    row = cursor.fetchone()
-    if isinstance(row, dict):
-        return bool(row.get('exists')) if row else False
-    return bool(row[0]) if row else False
-
-def montar_dict(cursor, tabela, spec):
-    out = {}
-    for value, opcoes in spec:
-        col = escolher_col(cursor, tabela, opcoes)
-        if col is not None:
-            out[col] = value
-    return out
-
-def inserir_generico(cursor, tabela, dados, pk_cols=None):
-    cols_disp = obter_colunas(cursor, tabela)
-    cols = [c for c in dados.keys() if c in cols_disp]
-    if not cols:
-        return
-    values = [dados[c] for c in cols]
-    placeholders = ", ".join(["%s"] * len(cols))
-    colnames = ", ".join(cols)
-
-    if pk_cols and all(pk in cols_disp for pk in pk_cols):
-        set_cols = [c for c in cols if c not in (pk_cols or [])]
-        if set_cols:
-            set_clause = ", ".join([f"{c} = EXCLUDED.{c}" for c in set_cols])
-            sql = f"INSERT INTO {tabela} ({colnames}) VALUES ({placeholders}) ON CONFLICT ({', '.join(pk_cols)}) DO UPDATE SET {set_clause}"
-        else:
-            sql = f"INSERT INTO {tabela} ({colnames}) VALUES ({placeholders}) ON CONFLICT ({', '.join(pk_cols)}) DO NOTHING"
-    else:
-        sql = f"INSERT INTO {tabela} ({colnames}) VALUES ({placeholders})"
-    cursor.execute(sql, values)
+    return esquema.atual(cursor).existe(tabela)
+
+def buscar_api_cisp(raiz, max_age=None):
+    """Busca dados da API CISP (passando pelo cache em memória). Falhas levantam ErroCISP."""
+    payload, _ = buscar_api_cisp_com_origem(raiz, max_age)
+    return payload
+
+def buscar_api_cisp_com_origem(raiz, max_age=None):
+    """
+    Devolve (payload, veio_do_cache). Procura no cache em memória, depois no
+    arquivo compartilhado (cisp_payload_raw) e só então na CISP; o que vem da
+    CISP é arquivado. max_age limita a idade aceitável dos caches; 0 força a CISP
+    """
+    payload, do_cache, tamanho = _buscar_com_origem(raiz, max_age)
+    if not do_cache:
+        _guardar_payload(raiz, payload, tamanho)
+    return payload, do_cache
+
+def _buscar_com_origem(raiz, max_age=None):
+    """(payload, veio_do_cache, bytes) sem guardar o que veio da CISP (ver _guardar_payload)"""
+    inicio = time.perf_counter()
+    payload = cache_payload.obter(raiz, max_age)
+    if payload is not None:
+        duracao = time.perf_counter() - inicio
+        CISP_BUSCA.observar(duracao, origem="cache")
+        rastreio.registrar("cisp", duracao, "cache")
+        return payload, True, None
+    arquivado = ler_arquivo(raiz, max_age)
+    if arquivado is not None:
+        payload, idade, tamanho = arquivado
+        duracao = time.perf_counter() - inicio
+        CISP_BUSCA.observar(duracao, origem="arquivo")
+        rastreio.registrar("cisp", duracao, "arquivo")
+        cache_payload.guardar(raiz, payload, tamanho, idade)
+        return payload, True, tamanho
+    try:
+        payload, tamanho = cliente_cisp.buscar_json(raiz)
+    except ErroCISP as e:
+        duracao = time.perf_counter() - inicio
+        CISP_BUSCA.observar(duracao, origem="erro")
+        rastreio.registrar("cisp", duracao, "erro")
+        log.error("Erro ao buscar API [%s] raiz %s: %s", e.tipo, raiz, e)
+        raise
+    duracao = time.perf_counter() - inicio
+    CISP_BUSCA.observar(duracao, origem="cisp")
+    rastreio.registrar("cisp", duracao, "cisp")
+    return payload, False, tamanho
 
-def buscar_api_cisp(raiz):
-    """Busca dados da API CISP"""
+def _guardar_payload(raiz, payload, tamanho):
+    """Payload novo da CISP no cache em memória e no arquivo"""
+    cache_payload.guardar(raiz, payload, tamanho)
+    arquivar_payload(raiz, payload)
+
+def _arquivo_disponivel(cursor):
+    return arquivo_cisp.ARQUIVO_ATIVO and esquema.atual(cursor).existe(arquivo_cisp.TABELA_RAW)
+
+def ler_arquivo(raiz, max_age=None):
+    """(payload, idade, bytes) do arquivo no Postgres, ou None; falhas do banco viram miss"""
+    if not arquivo_cisp.ARQUIVO_ATIVO or (max_age is not None and max_age <= 0):
+        return None
     try:
-        url = f"{API_BASE_URL}/{raiz}"
-        response = requests.get(
-            url,
-            auth=HTTPBasicAuth(API_USERNAME, API_PASSWORD),
-            timeout=10
-        )
-        if response.status_code == 200:
-            return response.json()
+        with conexao() as conn:
+            cursor = conn.cursor()
+            try:
+                if not _arquivo_disponivel(cursor):
+                    return None
+                with DB_CONSULTA.medir(tabela=arquivo_cisp.TABELA_RAW, operacao="leitura"):
+                    arquivado = arquivo_payload.obter(cursor, raiz, max_age)
+                conn.commit()
+                return arquivado
+            finally:
+                cursor.close()
+    except Exception as e:
+        log.warning("Arquivo de payloads indisponível na leitura da raiz %s: %s", raiz, e)
         return None
+
+def arquivar_payload(raiz, payload):
+    """Guarda o payload bruto em cisp_payload_raw (transação própria; falha não derruba a busca)"""
+    if not arquivo_cisp.ARQUIVO_ATIVO:
+        return
+    try:
+        with conexao() as conn:
+            cursor = conn.cursor()
+            try:
+                if not _arquivo_disponivel(cursor):
+                    return
+                with DB_CONSULTA.medir(tabela=arquivo_cisp.TABELA_RAW, operacao="gravacao"), rastreio.span("arquivar"):
+                    arquivo_payload.arquivar(cursor, raiz, payload)
+                    conn.commit()
+            finally:
+                cursor.close()
     except Exception as e:
-        print(f"❌ Erro ao buscar API: {e}")
+        log.warning("Falha ao arquivar payload da raiz %s: %s", raiz, e)
+
+def resposta_erro_cisp(raiz, erro):
+    status = STATUS_POR_ERRO_CISP.get(erro.tipo, 502)
+    mensagem = 'Raiz não encontrada na API CISP' if erro.tipo == 'nao_encontrada' else str(erro)
+    resp = jsonify({'success': False, 'raiz': raiz, 'erro_tipo': erro.tipo, 'mensagem': mensagem})
+    resp.status_code = status
+    if erro.retry_after is not None:
+        resp.headers['Retry-After'] = str(max(1, int(erro.retry_after + 0.999)))
+    return resp
+
+def _max_age_param():
+    """Lê ?max_age=<segundos> da requisição (None se ausente ou inválido)"""
+    valor = request.args.get("max_age")
+    if valor is None:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
         return None
 
-def inserir_no_postgres(raiz, dados):
+def inserir_no_postgres(raiz, dados, forcar=False):
     """Insere dados no PostgreSQL"""
-    conn = conectar_db()
+    with conexao() as conn:
+        return _inserir_no_postgres(conn, raiz, dados, forcar)
+
+
+def _inserir_no_postgres(conn, raiz, dados, forcar=False):
+    """Grava e faz commit; devolve o resultado de gravar_payload, ou None se falhar"""
+    inicio = time.perf_counter()
     cursor = conn.cursor()
 
     try:
-        cliente = dados.get('cliente', {})
-        info_sup = dados.get('informacaoSuporte', {})
-        receita = dados.get('receitaFederal', {})
-        segmentos = dados.get('positivaSegmentos', []) or []
-        ratings = dados.get('ratings', [])
-        rating_atual = ratings[0] if ratings else {}
-
-        melhor_maior_valor = None
-        melhor_maior_data = None
-        melhor_maior_codigo = None
-        ultima_compra_data = None
-        ultima_compra_codigo = None
+        resultado = gravar_payload(cursor, raiz, dados, forcar)
+        with DB_COMMIT.medir(contexto="gravacao"), rastreio.span("gravar.commit"):
+            conn.commit()
+        duracao = time.perf_counter() - inicio
+        GRAVACAO.observar(duracao, resultado="ok")
+        rastreio.registrar("gravar", duracao)
+        return resultado
+
+    except Exception as e:
+        conn.rollback()
+        duracao = time.perf_counter() - inicio
+        GRAVACAO.observar(duracao, resultado="erro")
+        rastreio.registrar("gravar", duracao, "erro")
+        log.error("Erro ao inserir raiz %s: %s", raiz, e)
+        return None
+    finally:
+        cursor.close()
+
+
+# =============================================================================
+# GRAVAÇÃO (specs compilados uma vez em esquema.py)
+# =============================================================================
+
+# Linhas por INSERT multi-VALUES (execute_values); acima disso o INSERT é dividido
+BULK_PAGE_SIZE = int(os.environ.get('DB_BULK_PAGE_SIZE', '1000'))
+
+TABELA_PRINCIPAL = "cisp_avaliacao_analitica"
+
+def _data_ocorrencia(rest):
+    if not rest.get('dataOcorrencia'):
+        return None
+    try:
+        return datetime.fromtimestamp(rest['dataOcorrencia'] / 1000).date()
+    except Exception:
+        return None
+
+def _data_hora_alerta(alerta):
+    if not alerta.get('dataAtualizacao'):
+        return None
+    try:
+        return datetime.strptime(alerta['dataAtualizacao'], '%Y-%m-%d %H:%M:%S')
+    except Exception:
+        return None
+
+def _contexto_principal(dados, obtido_em=None):
+    """
+    Extrai do payload o que a linha principal (e cisp_metricas_derivadas) precisa,
+    incluindo as métricas de positivaSegmentos (derivados.derivar, uma vez por gravação).
+    obtido_em: quando o payload veio da CISP (data_atualizacao); padrão agora
+    """
+    ratings = dados.get('ratings', [])
+    return {
+        "cliente": dados.get('cliente', {}),
+        "info_sup": dados.get('informacaoSuporte', {}),
+        "receita": dados.get('receitaFederal', {}),
+        "rating_atual": ratings[0] if ratings else {},
+        "derivados": derivados.derivar(dados),
+        "agora": obtido_em or datetime.now(),
+    }
+
+# (colunas candidatas, extrator(raiz, item)) por tabela. Se duas entradas caem
+# na mesma coluna, vale a última.
+SPEC_PRINCIPAL = [
+    (["cnpj"], lambda raiz, c: c["cliente"].get('identificacaoCliente')),
+    (["razao_social"], lambda raiz, c: c["cliente"].get('razaoSocial')),
+    (["nome_fantasia"], lambda raiz, c: c["cliente"].get('nomeFantasia')),
+    (["data_fundacao"], lambda raiz, c: converter_data(c["cliente"].get('dataFundacao'))),
+    (["data_inclusao_cisp"], lambda raiz, c: converter_data(c["cliente"].get('dataCadastramento'))),
+    (["endereco"], lambda raiz, c: c["cliente"].get('endereco')),
+    (["bairro"], lambda raiz, c: c["cliente"].get('bairro')),
+    (["cidade"], lambda raiz, c: c["cliente"].get('cidade')),
+    (["uf"], lambda raiz, c: c["cliente"].get('uf')),
+    (["cep"], lambda raiz, c: c["cliente"].get('cep')),
+    (["telefone"], lambda raiz, c: c["cliente"].get('telefone')),
+    (["email"], lambda raiz, c: c["cliente"].get('email')),
+    (["capital_social"], lambda raiz, c: c["cliente"].get('capitalSocial')),
+    (["cnae"], lambda raiz, c: c["cliente"].get('cnae')),
+    (["descricao_atividade_fiscal"], lambda raiz, c: c["cliente"].get('descricaoAtividadeFiscal') or c["receita"].get('descricaoAtividadeFiscal')),
+    (["situacao_receita_federal"], lambda raiz, c: c["receita"].get('situacaoCadastral')),
+    (["data_situacao_cadastral"], lambda raiz, c: converter_data(c["receita"].get('dataSituacaoCadastral'))),
+    (["rating_atual"], lambda raiz, c: c["rating_atual"].get('classificacao')),
+    (["descricao_rating"], lambda raiz, c: c["rating_atual"].get('descricaoClassificacao')),
+    (["ultima_atualizacao"], lambda raiz, c: c["agora"]),
+    (["data_atualizacao"], lambda raiz, c: c["agora"]),
+    (["valor_total_debito_atual", "total_debito_atual"], lambda raiz, c: c["info_sup"].get('valorTotalDebitoAtual')),
+    (["valor_total_debito_vencido_05dias", "valor_total_debito_vencido_5dias"], lambda raiz, c: c["info_sup"].get('valorTotalDebitoVencidoMais05Dias')),
+    (["valor_total_debito_vencido_15dias"], lambda raiz, c: c["info_sup"].get('valorTotalDebitoVencidoMais15Dias')),
+    (["valor_total_debito_vencido_30dias"], lambda raiz, c: c["info_sup"].get('valorTotalDebitoVencidoMais30Dias')),
+    (["qtd_associadas_debito_atual"], lambda raiz, c: c["info_sup"].get('quantidadeAssociadasDebitoAtual')),
+    (["qtd_associadas_debito_vencido_05dias", "qtd_associadas_debito_vencido_5dias"], lambda raiz, c: c["info_sup"].get('quantidadeAssociadasDebitoVencidoMais05Dias')),
+    (["qtd_associadas_debito_vencido_15dias"], lambda raiz, c: c["info_sup"].get('quantidadeAssociadasDebitoVencidoMais15Dias')),
+    (["qtd_associadas_debito_vencido_30dias"], lambda raiz, c: c["info_sup"].get('quantidadeAssociadasDebitoVencidoMais30Dias')),
+    (["valor_total_limite_credito", "total_limite_credito"], lambda raiz, c: c["info_sup"].get('valorTotalLimiteCredito')),
+    (["valor_total_maior_acumulo", "total_maior_acumulo"], lambda raiz, c: c["info_sup"].get('valorTotalMaiorAcumulo')),
+    (["qtd_associadas_informacoes_negociais", "qtd_associadas_informacoes"], lambda raiz, c: c["info_sup"].get('quantidadeAssociadasInformacoesNegociais')),
+    (["qtd_associadas_limite_credito"], lambda raiz, c: c["info_sup"].get('quantidadeAssociadasLimiteCredito')),
+    (["qtd_associadas_maior_acumulo"], lambda raiz, c: c["info_sup"].get('quantidadeAssociadasMaiorAcumulo')),
+    (["qtd_associadas_vendas_ultimos_2meses"], lambda raiz, c: c["info_sup"].get('quantidadeAssociadasVendasUltimos2Meses')),
+    (["data_maior_acumulo"], lambda raiz, c: c["derivados"]["data_maior_acumulo"]),
+    (["data_ultima_compra"], lambda raiz, c: c["derivados"]["data_ultima_compra"]),
+    (["codigo_associada_ultima_compra"], lambda raiz, c: c["derivados"]["codigo_associada_ultima_compra"]),
+    (OPCOES_RAIZ, lambda raiz, c: raiz),
+]
+
+# Uma linha por raiz, do mesmo contexto da principal (ver derivados.py)
+SPEC_DERIVADAS = [(["raiz"], lambda raiz, c: raiz)] + [
+    ([campo], (lambda campo: lambda raiz, c: c["derivados"][campo])(campo))
+    for campo in (
+        "rating_atual", "descricao_rating", "data_maior_acumulo", "valor_maior_acumulo",
+        "data_ultima_compra", "codigo_associada_ultima_compra", "total_debito_atual",
+    )
+] + [(["calculado_em"], lambda raiz, c: c["agora"])]
+
+SPEC_RESTRITIVAS = [
+    (OPCOES_RAIZ, lambda raiz, r: raiz),
+    (["codigo_associada", "codigoAssociada"], lambda raiz, r: r.get('codigoAssociada')),
+    (["razao_social", "razaoSocial"], lambda raiz, r: r.get('razaoSocial')),
+    (["codigo_primeira_restritiva"], lambda raiz, r: r.get('codigoPrimeiraRestritiva')),
+    (["descricao_primeira_restritiva"], lambda raiz, r: r.get('descricaoPrimeiraRestritiva')),
+    (["codigo_segunda_restritiva"], lambda raiz, r: r.get('codigoSegundaRestritiva')),
+    (["descricao_segunda_restritiva"], lambda raiz, r: r.get('descricaoSegundaRestritiva')),
+    (["data_ocorrencia"], lambda raiz, r: _data_ocorrencia(r)),
+    (["data_informacao"], lambda raiz, r: converter_data(r.get('dataInformacao'))),
+]
+
+SPEC_ALERTAS = [
+    (OPCOES_RAIZ, lambda raiz, a: raiz),
+    (["codigo_alerta", "codigo", "cod_alerta"], lambda raiz, a: a.get('codigoAlerta')),
+    (["descricao_alerta", "descricao", "desc_alerta"], lambda raiz, a: a.get('descricaoAlerta')),
+    (["associada_informante", "associada", "informante"], lambda raiz, a: a.get('associadaInformante')),
+    (["razao_social", "razaoSocial"], lambda raiz, a: a.get('razaoSocial')),
+    (["data_atualizacao", "atualizacao", "data"], lambda raiz, a: _data_hora_alerta(a)),
+]
+
+SPEC_CONSULTAS = [
+    (OPCOES_RAIZ, lambda raiz, c: raiz),
+    (["mes_ano", "mes", "data"], lambda raiz, c: c.get('data')),
+    (["quantidade_consultas", "qtd_consultas"], lambda raiz, c: c.get('consultas')),
+]
+
+SPEC_RATINGS = [
+    (["raiz"], lambda raiz, r: raiz),
+    (["data"], lambda raiz, r: converter_data(r.get('data'))),
+    (["classificacao"], lambda raiz, r: r.get('classificacao')),
+    (["descricao_classificacao"], lambda raiz, r: r.get('descricaoClassificacao')),
+]
+
+# Itens já achatados por derivados.linhas_positivas
+SPEC_POSITIVAS = [(["raiz"], lambda raiz, p: raiz)] + [
+    ([coluna], (lambda coluna: lambda raiz, p: p.get(coluna))(coluna))
+    for coluna in (
+        "segmento", "ordem_segmento", "total_associadas_segmento", "valor_total_debito_segmento",
+        "posicao", "codigo_associada", "razao_social",
+    )
+] + [
+    ([coluna], (lambda coluna: lambda raiz, p: converter_data(p.get(coluna)))(coluna))
+    for coluna in ("data_ultima_compra", "data_maior_acumulo")
+] + [
+    ([coluna], (lambda coluna: lambda raiz, p: p.get(coluna))(coluna))
+    for coluna in ("valor_maior_acumulo", "valor_debito_atual", "valor_limite_credito")
+]
+
+SPEC_ASSOCIADAS = [
+    (OPCOES_RAIZ, lambda raiz, a: raiz),
+    (["codigo_associada", "codigoAssociada", "cod_associada"], lambda raiz, a: a.get('codigoAssociada')),
+    (["razao_social", "razaoSocial"], lambda raiz, a: a.get('razaoSocial')),
+]
+
+# Chave natural das linhas de uma raiz em cada tabela filha (colunas candidatas, como nos specs)
+CHAVE_RESTRITIVAS = [["codigo_associada", "codigoAssociada"], ["codigo_primeira_restritiva"], ["data_ocorrencia"]]
+CHAVE_ALERTAS = [["codigo_alerta", "codigo", "cod_alerta"], ["associada_informante", "associada", "informante"]]
+CHAVE_CONSULTAS = [["mes_ano", "mes", "data"]]
+CHAVE_ASSOCIADAS = [["codigo_associada", "codigoAssociada", "cod_associada"]]
+CHAVE_RATINGS = [["data"]]
+CHAVE_POSITIVAS = [["segmento"], ["codigo_associada"]]
+
+# DELETE + INSERT ("substituir") ou diff por chave natural ("mesclar", ver mesclagem.py)
+MODO_FILHAS = os.environ.get('DB_MODO_FILHAS', 'mesclar')
+
+# (tabela, chave no payload da CISP ou função(dados) -> itens, spec)
+TABELAS_FILHAS = [
+    ("cisp_restritivas", "restritivas", SPEC_RESTRITIVAS),
+    ("cisp_alertas", "alertas", SPEC_ALERTAS),
+    ("cisp_consultas_mensais", "quantidadeConsultasUltimos12Meses", SPEC_CONSULTAS),
+    ("cisp_associadas_consultaram", "associadaConsultaUltimos30Dias", SPEC_ASSOCIADAS),
+    ("cisp_associadas_nao_concederam_credito", "associadaNaoConcederamCredito", SPEC_ASSOCIADAS),
+    (derivados.TABELA_RATINGS, "ratings", SPEC_RATINGS),
+    (derivados.TABELA_POSITIVAS, derivados.linhas_positivas, SPEC_POSITIVAS),
+]
+
+def _itens(dados, chave):
+    return (chave(dados) if callable(chave) else dados.get(chave)) or []
+
+# Nome da seção (assinatura e resposta da sincronização) de cada tabela filha
+SECAO_POR_TABELA = {tabela: tabela[len("cisp_"):] for tabela, _, _ in TABELAS_FILHAS}
+
+CHAVES_FILHAS = {
+    "cisp_restritivas": CHAVE_RESTRITIVAS,
+    "cisp_alertas": CHAVE_ALERTAS,
+    "cisp_consultas_mensais": CHAVE_CONSULTAS,
+    "cisp_associadas_consultaram": CHAVE_ASSOCIADAS,
+    "cisp_associadas_nao_concederam_credito": CHAVE_ASSOCIADAS,
+    derivados.TABELA_RATINGS: CHAVE_RATINGS,
+    derivados.TABELA_POSITIVAS: CHAVE_POSITIVAS,
+}
+
+esquema.registrar(TABELA_PRINCIPAL, SPEC_PRINCIPAL)
+esquema.registrar(derivados.TABELA_DERIVADAS, SPEC_DERIVADAS)
+for _tabela, _chave, _spec in TABELAS_FILHAS:
+    esquema.registrar(_tabela, _spec, CHAVES_FILHAS[_tabela])
+
+def gravar_principal(cursor, snap, raiz, contexto, tabela=TABELA_PRINCIPAL):
+    """
+    Upsert da linha única da raiz (principal ou cisp_metricas_derivadas) pelo statement
+    preparado (ON CONFLICT na raiz, ou DELETE+INSERT sem índice único)
+    """
+    m = snap.mapeadores.get(tabela)
+    if m is None or not m.colunas:
+        return
+    if m.conflito is None:
+        esquema.apagar_raiz(cursor, snap, m, raiz)
+    esquema.upsert(cursor, snap, m, m.linha(raiz, contexto))
+
+def gravar_filhas(cursor, snap, tabela, raiz, itens):
+    """
+    Deixa as linhas da raiz iguais aos itens: merge por chave natural (um
+    statement, só a diferença) ou DELETE + um INSERT multi-VALUES.
+    Devolve {"inseridas", "atualizadas", "apagadas"}.
+    """
+    m = snap.mapeadores.get(tabela)
+    if m is None:
+        return {"inseridas": 0, "atualizadas": 0, "apagadas": 0}
+    if not itens or not m.colunas:
+        return {"inseridas": 0, "atualizadas": 0, "apagadas": esquema.apagar_raiz(cursor, snap, m, raiz)}
+    linhas = [m.linha(raiz, item) for item in itens]
+    if MODO_FILHAS == "mesclar" and m.sql_merge and mesclagem.chaves_unicas(linhas, m.indices_chave):
+        return mesclagem.mesclar(cursor, m.sql_merge, linhas)
+    apagadas = esquema.apagar_raiz(cursor, snap, m, raiz)
+    execute_values(cursor, m.sql_insert_lote, linhas, page_size=BULK_PAGE_SIZE)
+    return {"inseridas": len(linhas), "atualizadas": 0, "apagadas": apagadas}
+
+
+# Classe (1º argumento) dos advisory locks por raiz: 0x43495350 = "CISP"
+LOCK_CLASSE_RAIZ = 1128878928
+
+def travar_raiz(cursor, raiz):
+    """Advisory lock da raiz até o fim da transação: serializa gravações da mesma raiz entre processos"""
+    cursor.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))", (LOCK_CLASSE_RAIZ, str(raiz)))
+
+def gravar_payload(cursor, raiz, dados, forcar=False, obtido_em=None):
+    """
+    Grava o payload da raiz em todas as tabelas, sem commit (a transação é de quem chama).
+
+    A linha principal é sempre gravada (carimba data_atualizacao com obtido_em,
+    ou agora; reprocessar.py passa o buscado_em do arquivo) e, se algo mudou,
+    ganha um ponto em cisp_historico (ver historico.py). Tabelas filhas
+    cuja seção do payload tem a mesma assinatura da última gravação são puladas
+    (ver assinatura.py), a menos que forcar=True.
+    Devolve {"secoes_gravadas": [...], "secoes_inalteradas": [...], "linhas": {secao: contagens}}.
+    """
+    snap = esquema.atual(cursor)
+    contexto = _contexto_principal(dados, obtido_em)
+    with DB_CONSULTA.medir(tabela="", operacao="advisory_lock"), rastreio.span("gravar.lock"):
+        travar_raiz(cursor, raiz)
+    with DB_CONSULTA.medir(tabela=TABELA_PRINCIPAL, operacao="upsert"), rastreio.span("gravar.principal"):
+        gravar_principal(cursor, snap, raiz, contexto)
+    with DB_CONSULTA.medir(tabela=derivados.TABELA_DERIVADAS, operacao="upsert"), rastreio.span("gravar.derivadas"):
+        gravar_principal(cursor, snap, raiz, contexto, derivados.TABELA_DERIVADAS)
+    if historico.HISTORICO_ATIVO and snap.existe(historico.TABELA_HISTORICO):
+        with DB_CONSULTA.medir(tabela=historico.TABELA_HISTORICO, operacao="gravacao"), rastreio.span("gravar.historico"):
+            historico_clientes.registrar(cursor, raiz, contexto["agora"], historico.ponto(dados, contexto["derivados"]))
+
+    usar_hash = assinatura.PULAR_INALTERADOS and snap.existe(assinatura.TABELA_HASH)
+    anteriores = {}
+    if usar_hash and not forcar:
+        with DB_CONSULTA.medir(tabela=assinatura.TABELA_HASH, operacao="leitura"), rastreio.span("gravar.hash"):
+            anteriores = assinatura.hashes_gravados(cursor, raiz)
+    gravadas, inalteradas, novos, linhas = [], [], {}, {}
+    for tabela, chave, _ in TABELAS_FILHAS:
+        secao = SECAO_POR_TABELA[tabela]
+        itens = _itens(dados, chave)
+        if usar_hash:
+            m = snap.mapeadores.get(tabela)
+            novos[secao] = assinatura.hash_secao(itens, m.colunas if m else ())
+            if anteriores.get(secao) == novos[secao]:
+                inalteradas.append(secao)
+                SECOES_INALTERADAS.inc(tabela=tabela)
+                continue
+        with DB_CONSULTA.medir(tabela=tabela, operacao="gravacao"), rastreio.span(f"gravar.{secao}"):
+            linhas[secao] = gravar_filhas(cursor, snap, tabela, raiz, itens)
+        for operacao, n in linhas[secao].items():
+            if n:
+                LINHAS_GRAVADAS.inc(n, tabela=tabela, operacao=operacao)
+        gravadas.append(secao)
+    if usar_hash:
+        with DB_CONSULTA.medir(tabela=assinatura.TABELA_HASH, operacao="gravacao"), rastreio.span("gravar.hash"):
+            assinatura.gravar_hashes(cursor, raiz, {s: novos[s] for s in gravadas})
+    return {"secoes_gravadas": gravadas, "secoes_inalteradas": inalteradas, "linhas": linhas}
+
+# =============================================================================
+# API
+# =============================================================================
+
+# As listas (tabelas filhas) vêm na mesma consulta da principal: um span só
+LEITURA_DESC = f"principal+{len(LISTAS_DOCUMENTO) + 2} listas"
+
+def ler_documento(conn, raiz):
+    """(idade em segundos, documento JSON em texto) da raiz, numa única consulta ao banco (ver leitura.py)"""
+    cursor = conn.cursor()
+    try:
+        with DB_CONSULTA.medir(tabela=TABELA_PRINCIPAL, operacao="documento"), rastreio.span("ler", LEITURA_DESC):
+            atualizado_em, texto = leitor_documento.ler(cursor, esquema.atual(cursor), raiz)
+    finally:
+        cursor.close()
+    return frescor.idade_em_segundos(atualizado_em), texto
+
+
+def montar_documento(conn, raiz, payload_cisp=None):
+    """
+    Lê o cliente do banco. O payload da CISP só complementa se o banco não tiver
+    a raiz ou as tabelas de derivados.py (ratings, positivas, métricas derivadas)
+    """
+    _, texto = ler_documento(conn, raiz)
+    with rastreio.span("json.ler"):
+        documento = json.loads(texto)
+    if payload_cisp and not (documento.get("principal") and documento_completo(esquema.atual())):
+        complementar_documento(documento, raiz, payload_cisp)
+    return documento
+
+
+def complementar_documento(documento, raiz, payload_cisp):
+    """Preenche o que o banco não tem (ou ainda não tem) com o payload da CISP já obtido"""
+    principal = documento.get("principal")
+
+    # Fallback: se não salvou no banco, monta principal direto do payload da CISP
+    if not principal and payload_cisp:
+        principal = {}
+        try:
+            cli = payload_cisp.get("cliente") or {}
+            rf = payload_cisp.get("receitaFederal") or {}
+            principal.update({
+                "raiz": cli.get("raizCnpj") or raiz,
+                "cnpj": cli.get("identificacaoCliente"),
+                "razao_social": cli.get("razaoSocial") or rf.get("razaoSocial"),
+                "nome_fantasia": cli.get("nomeFantasia"),
+                "data_fundacao": cli.get("dataFundacao"),
+                "endereco": cli.get("endereco"),
+                "bairro": cli.get("bairro"),
+                "cidade": cli.get("cidade"),
+                "uf": cli.get("uf") or rf.get("uf"),
+                "cep": cli.get("cep"),
+                "telefone": cli.get("telefone"),
+                "email": cli.get("email"),
+                "cnae": cli.get("cnae") or rf.get("cnae"),
+                "descricao_atividade_fiscal": cli.get("descricaoAtividadeFiscal") or rf.get("descricaoAtividadeFiscal"),
+                "situacao_receita_federal": rf.get("situacaoCadastral"),
+                "data_situacao_cadastral": rf.get("dataSituacaoCadastral"),
+            })
+        except Exception:
+            pass
+
+    # Complementa campos de datas e rating direto do payload_cisp já obtido
+    if payload_cisp and principal is not None:
         try:
+            info_sup = payload_cisp.get("informacaoSuporte", {}) or {}
+            ratings = payload_cisp.get("ratings") or []
+            segmentos = payload_cisp.get("positivaSegmentos") or []
+            melhor_maior_data = None
+            ultima_compra_data = None
+            ultima_compra_codigo = None
+            melhor_maior_valor = None
             for seg in segmentos:
-                for pos in seg.get('positivas', []) or []:
-                    v = pos.get('valorMaiorAcumulo')
-                    d_maior = converter_data(pos.get('dataMaiorAcumulo'))
-                    cod = pos.get('codigoAssociada')
-                    if v is not None:
+                for pos in seg.get("positivas", []) or []:
+                    v = pos.get("valorMaiorAcumulo")
+                    d_maior = converter_data(pos.get("dataMaiorAcumulo"))
+                    d_ult = converter_data(pos.get("dataUltimaCompra"))
+                    cod = pos.get("codigoAssociada")
+                    if v is not None and d_maior:
                         if (melhor_maior_valor is None) or (float(v) > float(melhor_maior_valor)):
                             melhor_maior_valor = v
                             melhor_maior_data = d_maior
-                            melhor_maior_codigo = cod
-                    d_ult = converter_data(pos.get('dataUltimaCompra'))
                     if d_ult:
                         if (ultima_compra_data is None) or (d_ult > ultima_compra_data):
                             ultima_compra_data = d_ult
                             ultima_compra_codigo = cod
+            if melhor_maior_data and not principal.get("data_maior_acumulo"):
+                principal["data_maior_acumulo"] = melhor_maior_data.isoformat()
+            if ultima_compra_data and not principal.get("data_ultima_compra"):
+                principal["data_ultima_compra"] = ultima_compra_data.isoformat()
+                principal["codigo_associada_ultima_compra"] = ultima_compra_codigo
+            if (not principal.get("rating_atual")) and ratings:
+                r0 = ratings[0]
+                principal["rating_atual"] = r0.get("classificacao")
+                principal["descricao_rating"] = r0.get("descricaoClassificacao")
+            principal.setdefault("total_limite_credito", info_sup.get("valorTotalLimiteCredito"))
+            principal.setdefault("total_maior_acumulo", info_sup.get("valorTotalMaiorAcumulo"))
+            principal.setdefault("total_debito_atual", info_sup.get("valorTotalDebitoAtual"))
+            principal.setdefault("total_debito_vencido_05_dias", info_sup.get("valorTotalDebitoVencidoMais05Dias"))
+            principal.setdefault("total_debito_vencido_15_dias", info_sup.get("valorTotalDebitoVencidoMais15Dias"))
+            principal.setdefault("total_debito_vencido_30_dias", info_sup.get("valorTotalDebitoVencidoMais30Dias"))
+            try:
+                comp = payload_cisp.get("informacoesComportamentaisSegmentos") or []
+                if isinstance(comp, list) and comp:
+                    ultimo = comp[0]
+                    total_ultimo = ultimo.get("total")
+                    if total_ultimo is not None:
+                        principal["total_debito_atual"] = total_ultimo
+            except Exception:
+                pass
         except Exception:
             pass
 
-        dados_principal = {
-            "raiz": raiz,
-            "cnpj": cliente.get('identificacaoCliente'),
-            "razao_social": cliente.get('razaoSocial'),
-            "nome_fantasia": cliente.get('nomeFantasia'),
-            "data_fundacao": converter_data(cliente.get('dataFundacao')),
-            "data_inclusao_cisp": converter_data(cliente.get('dataCadastramento')),
-            "endereco": cliente.get('endereco'),
-            "bairro": cliente.get('bairro'),
-            "cidade": cliente.get('cidade'),
-            "uf": cliente.get('uf'),
-            "cep": cliente.get('cep'),
-            "telefone": cliente.get('telefone'),
-            "email": cliente.get('email'),
-            "capital_social": cliente.get('capitalSocial'),
-            "cnae": cliente.get('cnae'),
-            "descricao_atividade_fiscal": cliente.get('descricaoAtividadeFiscal') or receita.get('descricaoAtividadeFiscal'),
-            "situacao_receita_federal": receita.get('situacaoCadastral'),
-            "data_situacao_cadastral": converter_data(receita.get('dataSituacaoCadastral')),
-            "rating_atual": rating_atual.get('classificacao'),
-            "descricao_rating": rating_atual.get('descricaoClassificacao'),
-            "data_maior_acumulo": melhor_maior_data,
-            "data_ultima_compra": ultima_compra_data,
-            "codigo_associada_ultima_compra": ultima_compra_codigo,
-            "ultima_atualizacao": datetime.now(),
-            "data_atualizacao": datetime.now(),
-        }
-        dados_principal.update(montar_dict(cursor, "cisp_avaliacao_analitica", [
-            (info_sup.get('valorTotalDebitoAtual'), ["valor_total_debito_atual", "total_debito_atual"]),
-            (info_sup.get('valorTotalDebitoVencidoMais05Dias'), ["valor_total_debito_vencido_05dias", "valor_total_debito_vencido_5dias"]),
-            (info_sup.get('valorTotalDebitoVencidoMais15Dias'), ["valor_total_debito_vencido_15dias"]),
-            (info_sup.get('valorTotalDebitoVencidoMais30Dias'), ["valor_total_debito_vencido_30dias"]),
-            (info_sup.get('quantidadeAssociadasDebitoAtual'), ["qtd_associadas_debito_atual"]),
-            (info_sup.get('quantidadeAssociadasDebitoVencidoMais05Dias'), ["qtd_associadas_debito_vencido_05dias", "qtd_associadas_debito_vencido_5dias"]),
-            (info_sup.get('quantidadeAssociadasDebitoVencidoMais15Dias'), ["qtd_associadas_debito_vencido_15dias"]),
-            (info_sup.get('quantidadeAssociadasDebitoVencidoMais30Dias'), ["qtd_associadas_debito_vencido_30dias"]),
-            (info_sup.get('valorTotalLimiteCredito'), ["valor_total_limite_credito", "total_limite_credito"]),
-            (info_sup.get('valorTotalMaiorAcumulo'), ["valor_total_maior_acumulo", "total_maior_acumulo"]),
-            (info_sup.get('quantidadeAssociadasInformacoesNegociais'), ["qtd_associadas_informacoes_negociais", "qtd_associadas_informacoes"]),
-            (info_sup.get('quantidadeAssociadasLimiteCredito'), ["qtd_associadas_limite_credito"]),
-            (info_sup.get('quantidadeAssociadasMaiorAcumulo'), ["qtd_associadas_maior_acumulo"]),
-            (info_sup.get('quantidadeAssociadasVendasUltimos2Meses'), ["qtd_associadas_vendas_ultimos_2meses"]),
-            (melhor_maior_data, ["data_maior_acumulo"]),
-            (ultima_compra_data, ["data_ultima_compra"]),
-            (ultima_compra_codigo, ["codigo_associada_ultima_compra"]),
-        ]))
-        root_main = escolher_col(cursor, "cisp_avaliacao_analitica", ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"])
-        if root_main:
-            dados_principal[root_main] = raiz
-        inserir_generico(cursor, "cisp_avaliacao_analitica", dados_principal, pk_cols=[root_main] if root_main else None)
-
-        root_rest = escolher_col(cursor, "cisp_restritivas", ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"])
-        if root_rest:
-            cursor.execute(f"DELETE FROM cisp_restritivas WHERE {root_rest} = %s", (raiz,))
-        for rest in dados.get('restritivas', []):
-            data_ocorrencia = None
-            if rest.get('dataOcorrencia'):
-                try:
-                    data_ocorrencia = datetime.fromtimestamp(rest['dataOcorrencia'] / 1000).date()
-                except Exception:
-                    data_ocorrencia = None
-
-            inserir_generico(
-                cursor,
-                "cisp_restritivas",
-                montar_dict(
-                    cursor,
-                    "cisp_restritivas",
-                    [
-                        (raiz, ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"]),
-                        (rest.get('codigoAssociada'), ["codigo_associada", "codigoAssociada"]),
-                        (rest.get('razaoSocial'), ["razao_social", "razaoSocial"]),
-                        (rest.get('codigoPrimeiraRestritiva'), ["codigo_primeira_restritiva"]),
-                        (rest.get('descricaoPrimeiraRestritiva'), ["descricao_primeira_restritiva"]),
-                        (rest.get('codigoSegundaRestritiva'), ["codigo_segunda_restritiva"]),
-                        (rest.get('descricaoSegundaRestritiva'), ["descricao_segunda_restritiva"]),
-                        (data_ocorrencia, ["data_ocorrencia"]),
-                        (converter_data(rest.get('dataInformacao')), ["data_informacao"]),
-                    ],
-                ),
-            )
-
-        root_alert = escolher_col(cursor, "cisp_alertas", ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"])
-        if root_alert:
-            cursor.execute(f"DELETE FROM cisp_alertas WHERE {root_alert} = %s", (raiz,))
-        for alerta in dados.get('alertas', []):
-            data_atualizacao = None
-            if alerta.get('dataAtualizacao'):
-                try:
-                    data_atualizacao = datetime.strptime(alerta['dataAtualizacao'], '%Y-%m-%d %H:%M:%S')
-                except Exception:
-                    data_atualizacao = None
-
-            inserir_generico(
-                cursor,
-                "cisp_alertas",
-                montar_dict(
-                    cursor,
-                    "cisp_alertas",
-                    [
-                        (raiz, ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"]),
-                        (alerta.get('codigoAlerta'), ["codigo_alerta", "codigo", "cod_alerta"]),
-                        (alerta.get('descricaoAlerta'), ["descricao_alerta", "descricao", "desc_alerta"]),
-                        (alerta.get('associadaInformante'), ["associada_informante", "associada", "informante"]),
-                        (alerta.get('razaoSocial'), ["razao_social", "razaoSocial"]),
-                        (data_atualizacao, ["data_atualizacao", "atualizacao", "data"]),
-                    ],
-                ),
-            )
-
-        root_cons = escolher_col(cursor, "cisp_consultas_mensais", ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"])
-        if root_cons:
-            cursor.execute(f"DELETE FROM cisp_consultas_mensais WHERE {root_cons} = %s", (raiz,))
-        for consulta in dados.get('quantidadeConsultasUltimos12Meses', []):
-            inserir_generico(
-                cursor,
-                "cisp_consultas_mensais",
-                montar_dict(
-                    cursor,
-                    "cisp_consultas_mensais",
-                    [
-                        (raiz, ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"]),
-                        (consulta.get('data'), ["mes_ano", "mes", "data"]),
-                        (consulta.get('consultas'), ["quantidade_consultas", "qtd_consultas"]),
-                    ],
-                ),
-            )
-
-        root_assoc_cons = escolher_col(cursor, "cisp_associadas_consultaram", ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"])
-        if root_assoc_cons:
-            cursor.execute(f"DELETE FROM cisp_associadas_consultaram WHERE {root_assoc_cons} = %s", (raiz,))
-        for assoc in dados.get('associadaConsultaUltimos30Dias', []):
-            inserir_generico(
-                cursor,
-                "cisp_associadas_consultaram",
-                montar_dict(
-                    cursor,
-                    "cisp_associadas_consultaram",
-                    [
-                        (raiz, ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"]),
-                        (assoc.get('codigoAssociada'), ["codigo_associada", "codigoAssociada", "cod_associada"]),
-                        (assoc.get('razaoSocial'), ["razao_social", "razaoSocial"]),
-                    ],
-                ),
-            )
-
-        root_assoc_nao = escolher_col(cursor, "cisp_associadas_nao_concederam_credito", ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"])
-        if root_assoc_nao:
-            cursor.execute(f"DELETE FROM cisp_associadas_nao_concederam_credito WHERE {root_assoc_nao} = %s", (raiz,))
-        for assoc in dados.get('associadaNaoConcederamCredito', []):
-            inserir_generico(
-                cursor,
-                "cisp_associadas_nao_concederam_credito",
-                montar_dict(
-                    cursor,
-                    "cisp_associadas_nao_concederam_credito",
-                    [
-                        (raiz, ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"]),
-                        (assoc.get('codigoAssociada'), ["codigo_associada", "codigoAssociada", "cod_associada"]),
-                        (assoc.get('razaoSocial'), ["razao_social", "razaoSocial"]),
-                    ],
-                ),
-            )
-
-        conn.commit()
-        return True
+    documento["principal"] = principal
+    # Ratings e segmentos positivos direto do payload já obtido
+    if isinstance(payload_cisp.get("ratings"), list):
+        documento["ratings"] = payload_cisp.get("ratings") or []
+    if isinstance(payload_cisp.get("positivaSegmentos"), list):
+        documento["positivaSegmentos"] = payload_cisp.get("positivaSegmentos") or []
+    return documento
 
-    except Exception as e:
-        conn.rollback()
-        print(f"❌ Erro ao inserir: {e}")
-        return False
-    finally:
-        cursor.close()
-        conn.close()
 
+def sincronizar_raiz(raiz, max_age=None, gravar_do_cache=False, forcar=False):
+    """
+    Busca na CISP e grava a raiz, UMA vez entre chamadas concorrentes do processo.
+
+    Devolve (payload, veio_do_cache, gravou); gravou é o resultado de
+    gravar_payload (seções regravadas/inalteradas) ou None se não gravou ou
+    falhou. Payload vindo do cache só é regravado com gravar_do_cache=True
+    (já foi gravado quando foi buscado).
+    Falhas da CISP levantam ErroCISP para todos os que esperavam.
+    Só coalesce chamadas com os mesmos parâmetros: quem exige max_age=0 ou
+    gravar_do_cache não pode receber o resultado de quem serviu do cache sem gravar.
+    """
+    with rastreio.span("sincronizar"):
+        chave = ("sincronizar", raiz, max_age, gravar_do_cache, forcar)
+        return voo_unico.executar(chave, _sincronizar_raiz, raiz, max_age, gravar_do_cache, forcar)
+
+def _sincronizar_raiz(raiz, max_age, gravar_do_cache, forcar):
+    payload, do_cache, tamanho = _buscar_com_origem(raiz, max_age)
+    gravou = None
+    if not do_cache or gravar_do_cache:
+        with conexao() as conn:
+            gravou = _inserir_no_postgres(conn, raiz, payload, forcar)
+    # o payload novo só vira cache depois de gravado: se a gravação falhou, a
+    # próxima chamada não o encontra como "já gravado" e busca e grava de novo
+    if not do_cache and gravou is not None:
+        _guardar_payload(raiz, payload, tamanho)
+    return payload, do_cache, gravou
+
+def buscar_api_cisp_coalescido(raiz, max_age=None):
+    """buscar_api_cisp com uma única chamada à CISP por raiz entre threads concorrentes"""
+    return voo_unico.executar(("buscar", raiz), buscar_api_cisp, raiz, max_age)
+
+
+def consultar_e_montar(raiz, max_age=None):
+    """
+    Busca UMA vez na CISP, grava UMA vez e devolve (documento, origem, idade_segundos).
+
+    Se o registro no Postgres estiver dentro do limite de frescor, nem a CISP
+    nem a gravação são executadas e o documento é o texto JSON montado pelo
+    banco, sem passar por dicts. Origem: cisp | cache | banco.
+    """
+    with conexao() as conn:
+        idade, texto = ler_documento(conn, raiz)
+    if frescor.esta_fresco(idade, max_age):
+        return texto, frescor.ORIGEM_BANCO, idade
+
+    try:
+        payload_cisp, do_cache, gravou = sincronizar_raiz(raiz, max_age)
+    except ErroCISP as e:
+        # CISP sem resposta: o que já foi lido do banco, com a idade real do registro
+        with rastreio.span("json.ler"):
+            documento = json.loads(texto)
+        documento["erro_cisp"] = {"tipo": e.tipo, "mensagem": str(e)}
+        return documento, frescor.ORIGEM_BANCO, idade
+    if do_cache:
+        origem, idade = frescor.ORIGEM_CACHE, cache_payload.idade(raiz) or 0.0
+    else:
+        origem, idade = frescor.ORIGEM_CISP, 0.0
+    with conexao() as conn:
+        if gravou is not None and documento_completo(esquema.atual()):
+            # acabou de gravar e o banco tem tudo: o texto do banco já é a resposta
+            _, texto = ler_documento(conn, raiz)
+            return texto, origem, idade
+        documento = montar_documento(conn, raiz, payload_cisp)
+    return documento, origem, idade
+
+
+def _com_origem(texto, origem, idade):
+    """Acrescenta origem/idade_segundos ao JSON pronto vindo do banco, sem decodificá-lo"""
+    return json.dumps({"origem": origem, "idade_segundos": idade})[:-1] + ", " + texto[1:]
+
+
+def _resposta_documento(documento, origem, idade):
+    """documento: texto JSON do banco (enviado como está) ou dict já complementado"""
+    idade = round(idade, 1) if idade is not None else None
+    rastreio.anotar(origem=origem)
+    if isinstance(documento, str):
+        with rastreio.span("json", "texto do banco"):
+            resp = app.response_class(_com_origem(documento, origem, idade), mimetype="application/json")
+    else:
+        documento.update({"origem": origem, "idade_segundos": idade})
+        with rastreio.span("json", "jsonify"):
+            resp = jsonify(documento)
+    resp.headers["X-Dados-Origem"] = origem
+    if idade is not None:
+        resp.headers["X-Dados-Idade"] = str(int(idade))
+    return resp
 
-# =============================================================================
-# API
-# =============================================================================
 
 @app.route('/api/cliente/<raiz>')
 def obter_cliente(raiz):
-    conn = None
-    cursor = None
+    """
+    GET /api/cliente/<raiz>               -> busca na CISP, grava e devolve o documento
+    GET /api/cliente/<raiz>?modo=leitura  -> só lê do Postgres, nunca chama a CISP
+    GET /api/cliente/<raiz>?max_age=3600  -> aceita dados (banco ou cache) de até 1h (0 = força a CISP)
+
+    Headers X-Dados-Origem (cisp | cache | banco) e X-Dados-Idade (segundos).
+    """
+    agenda.acessos.registrar(raiz)
+    inicio = time.perf_counter()
     try:
-        # =====================================================================
-        # 1. SEMPRE busca na CISP primeiro e atualiza o banco
-        # =====================================================================
-        payload_cisp = buscar_api_cisp(raiz)
-        if payload_cisp:
-            inserir_no_postgres(raiz, payload_cisp)
-
-        # =====================================================================
-        # 2. Lê do banco (já atualizado)
-        # =====================================================================
-        conn = conectar_db()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-
-        root_col = escolher_col(cursor, "cisp_avaliacao_analitica", ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"]) or "raiz"
-        cursor.execute(f"SELECT * FROM cisp_avaliacao_analitica WHERE {root_col} = %s LIMIT 1", (raiz,))
-        principal_row = cursor.fetchone()
-
-        principal = None
-        if principal_row:
-            principal = {
-                "raiz": principal_row.get("raiz"),
-                "cnpj": principal_row.get("cnpj"),
-                "razao_social": principal_row.get("razao_social"),
-                "nome_fantasia": principal_row.get("nome_fantasia"),
-                "data_fundacao": principal_row.get("data_fundacao").isoformat() if principal_row.get("data_fundacao") else None,
-                "endereco": principal_row.get("endereco"),
-                "bairro": principal_row.get("bairro"),
-                "cidade": principal_row.get("cidade") or principal_row.get("municipio"),
-                "uf": principal_row.get("uf"),
-                "cep": principal_row.get("cep"),
-                "telefone": principal_row.get("telefone"),
-                "email": principal_row.get("email"),
-                "capital_social": principal_row.get("capital_social"),
-                "cnae": principal_row.get("cnae"),
-                "descricao_atividade_fiscal": principal_row.get("descricao_atividade_fiscal"),
-                "situacao_receita_federal": principal_row.get("situacao_receita_federal"),
-                "data_situacao_cadastral": principal_row.get("data_situacao_cadastral").isoformat() if principal_row.get("data_situacao_cadastral") else None,
-                "rating_atual": principal_row.get("rating_atual") or principal_row.get("classificacao_atual_cisp") or principal_row.get("classificacao_cisp_atual") or principal_row.get("classificacao"),
-                "descricao_rating": principal_row.get("descricao_rating") or principal_row.get("descricao_classificacao") or principal_row.get("descricao_classificacao_atual"),
-                "total_debito_atual": principal_row.get("total_debito_atual") or principal_row.get("valor_total_debito_atual"),
-                "total_debito_vencido_05_dias": principal_row.get("total_debito_vencido_05_dias") or principal_row.get("valor_total_debito_vencido_05dias") or principal_row.get("valor_total_debito_vencido_5dias"),
-                "total_debito_vencido_15_dias": principal_row.get("total_debito_vencido_15_dias") or principal_row.get("valor_total_debito_vencido_15dias"),
-                "total_debito_vencido_30_dias": principal_row.get("total_debito_vencido_30_dias") or principal_row.get("valor_total_debito_vencido_30dias"),
-                "qtd_associadas_debito_atual": principal_row.get("qtd_associadas_debito_atual"),
-                "qtd_associadas_vencido_05_dias": principal_row.get("qtd_associadas_vencido_05_dias") or principal_row.get("qtd_associadas_debito_vencido_05dias") or principal_row.get("qtd_associadas_debito_vencido_5dias"),
-                "total_limite_credito": principal_row.get("total_limite_credito") or principal_row.get("valor_total_limite_credito"),
-                "total_maior_acumulo": principal_row.get("total_maior_acumulo") or principal_row.get("valor_total_maior_acumulo"),
-                "qtd_associadas_informacoes": principal_row.get("qtd_associadas_informacoes") or principal_row.get("qtd_associadas_informacoes_negociais"),
-                "qtd_associadas_limite_credito": principal_row.get("qtd_associadas_limite_credito"),
-                "qtd_associadas_maior_acumulo": principal_row.get("qtd_associadas_maior_acumulo"),
-                "qtd_associadas_vendas_ultimos_2meses": principal_row.get("qtd_associadas_vendas_ultimos_2meses"),
-                "data_maior_acumulo": principal_row.get("data_maior_acumulo").isoformat() if principal_row.get("data_maior_acumulo") else None,
-                "data_ultima_compra": principal_row.get("data_ultima_compra").isoformat() if principal_row.get("data_ultima_compra") else None,
-                "codigo_associada_ultima_compra": principal_row.get("codigo_associada_ultima_compra"),
-                "data_inclusao_cisp": principal_row.get("data_inclusao_cisp").isoformat() if principal_row.get("data_inclusao_cisp") else None,
-                "hora_modificacao": principal_row.get("hora_modificacao"),
-                "usuario_modificacao": principal_row.get("usuario_modificacao"),
-                "situacao_sintegra": principal_row.get("situacao_sintegra"),
-                "data_atualizacao": principal_row.get("data_atualizacao").isoformat() if principal_row.get("data_atualizacao") else None,
-            }
-
-        # Fallback: se não salvou no banco, monta principal direto do payload da CISP
-        if not principal and payload_cisp:
-            principal = {}
-            try:
-                cli = payload_cisp.get("cliente") or {}
-                rf = payload_cisp.get("receitaFederal") or {}
-                principal.update({
-                    "raiz": cli.get("raizCnpj") or raiz,
-                    "cnpj": cli.get("identificacaoCliente"),
-                    "razao_social": cli.get("razaoSocial") or rf.get("razaoSocial"),
-                    "nome_fantasia": cli.get("nomeFantasia"),
-                    "data_fundacao": cli.get("dataFundacao"),
-                    "endereco": cli.get("endereco"),
-                    "bairro": cli.get("bairro"),
-                    "cidade": cli.get("cidade"),
-                    "uf": cli.get("uf") or rf.get("uf"),
-                    "cep": cli.get("cep"),
-                    "telefone": cli.get("telefone"),
-                    "email": cli.get("email"),
-                    "cnae": cli.get("cnae") or rf.get("cnae"),
-                    "descricao_atividade_fiscal": cli.get("descricaoAtividadeFiscal") or rf.get("descricaoAtividadeFiscal"),
-                    "situacao_receita_federal": rf.get("situacaoCadastral"),
-                    "data_situacao_cadastral": rf.get("dataSituacaoCadastral"),
-                })
-            except Exception:
-                pass
+        if request.args.get("modo") == "leitura":
+            with conexao() as conn:
+                idade, texto = ler_documento(conn, raiz)
+            CLIENTE_DOCUMENTO.observar(time.perf_counter() - inicio, origem=frescor.ORIGEM_BANCO)
+            return _resposta_documento(texto, frescor.ORIGEM_BANCO, idade)
+        documento, origem, idade = consultar_e_montar(raiz, _max_age_param())
+        CLIENTE_DOCUMENTO.observar(time.perf_counter() - inicio, origem=origem)
+        return _resposta_documento(documento, origem, idade)
+    except Exception as e:
+        CLIENTE_DOCUMENTO.observar(time.perf_counter() - inicio, origem="erro")
+        return jsonify({"success": False, "erro": str(e)}), 500
 
-        # Complementa campos de datas e rating direto do payload_cisp já obtido
-        if payload_cisp and principal is not None:
-            try:
-                info_sup = payload_cisp.get("informacaoSuporte", {}) or {}
-                ratings = payload_cisp.get("ratings") or []
-                segmentos = payload_cisp.get("positivaSegmentos") or []
-                melhor_maior_data = None
-                ultima_compra_data = None
-                ultima_compra_codigo = None
-                melhor_maior_valor = None
-                for seg in segmentos:
-                    for pos in seg.get("positivas", []) or []:
-                        v = pos.get("valorMaiorAcumulo")
-                        d_maior = converter_data(pos.get("dataMaiorAcumulo"))
-                        d_ult = converter_data(pos.get("dataUltimaCompra"))
-                        cod = pos.get("codigoAssociada")
-                        if v is not None and d_maior:
-                            if (melhor_maior_valor is None) or (float(v) > float(melhor_maior_valor)):
-                                melhor_maior_valor = v
-                                melhor_maior_data = d_maior
-                        if d_ult:
-                            if (ultima_compra_data is None) or (d_ult > ultima_compra_data):
-                                ultima_compra_data = d_ult
-                                ultima_compra_codigo = cod
-                if melhor_maior_data and not principal.get("data_maior_acumulo"):
-                    principal["data_maior_acumulo"] = melhor_maior_data.isoformat()
-                if ultima_compra_data and not principal.get("data_ultima_compra"):
-                    principal["data_ultima_compra"] = ultima_compra_data.isoformat()
-                    principal["codigo_associada_ultima_compra"] = ultima_compra_codigo
-                if (not principal.get("rating_atual")) and ratings:
-                    r0 = ratings[0]
-                    principal["rating_atual"] = r0.get("classificacao")
-                    principal["descricao_rating"] = r0.get("descricaoClassificacao")
-                principal.setdefault("total_limite_credito", info_sup.get("valorTotalLimiteCredito"))
-                principal.setdefault("total_maior_acumulo", info_sup.get("valorTotalMaiorAcumulo"))
-                principal.setdefault("total_debito_atual", info_sup.get("valorTotalDebitoAtual"))
-                principal.setdefault("total_debito_vencido_05_dias", info_sup.get("valorTotalDebitoVencidoMais05Dias"))
-                principal.setdefault("total_debito_vencido_15_dias", info_sup.get("valorTotalDebitoVencidoMais15Dias"))
-                principal.setdefault("total_debito_vencido_30_dias", info_sup.get("valorTotalDebitoVencidoMais30Dias"))
-                try:
-                    comp = payload_cisp.get("informacoesComportamentaisSegmentos") or []
-                    if isinstance(comp, list) and comp:
-                        ultimo = comp[0]
-                        total_ultimo = ultimo.get("total")
-                        if total_ultimo is not None:
-                            principal["total_debito_atual"] = total_ultimo
-                except Exception:
-                    pass
-            except Exception:
-                pass
+@app.route('/api/cliente/<raiz>/historico')
+def historico_cliente(raiz):
+    """
+    Séries da raiz no tempo, em colunas (ver historico.py); só lê do Postgres.
 
-        root_rest = escolher_col(cursor, "cisp_restritivas", ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"]) or "raiz"
-        cursor.execute(f"SELECT * FROM cisp_restritivas WHERE {root_rest} = %s", (raiz,))
-        restritivas_rows = cursor.fetchall()
-        restritivas = [
-            {
-                "codigo_associada": r.get("codigo_associada"),
-                "razao_social": r.get("razao_social"),
-                "codigo_primeira_restritiva": r.get("codigo_primeira_restritiva"),
-                "descricao_primeira_restritiva": r.get("descricao_primeira_restritiva"),
-                "codigo_segunda_restritiva": r.get("codigo_segunda_restritiva"),
-                "descricao_segunda_restritiva": r.get("descricao_segunda_restritiva"),
-                "data_ocorrencia": r.get("data_ocorrencia").isoformat() if r.get("data_ocorrencia") else None,
-                "data_informacao": r.get("data_informacao").isoformat() if r.get("data_informacao") else None,
-            }
-            for r in restritivas_rows
-        ]
-
-        root_alert = escolher_col(cursor, "cisp_alertas", ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"]) or "raiz"
-        cursor.execute(f"SELECT * FROM cisp_alertas WHERE {root_alert} = %s", (raiz,))
-        alertas_rows = cursor.fetchall()
-        alertas = [
-            {
-                "codigo_alerta": a.get("codigo_alerta"),
-                "descricao_alerta": a.get("descricao_alerta"),
-                "associada_informante": a.get("associada_informante"),
-                "razao_social": a.get("razao_social"),
-                "data_atualizacao": a.get("data_atualizacao").isoformat() if a.get("data_atualizacao") else None,
-            }
-            for a in alertas_rows
-        ]
-
-        root_cons = escolher_col(cursor, "cisp_consultas_mensais", ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"]) or "raiz"
-        cursor.execute(f"SELECT * FROM cisp_consultas_mensais WHERE {root_cons} = %s", (raiz,))
-        consultas_rows = cursor.fetchall()
-        consultas_mensais = [
-            {"mes_ano": c.get("mes_ano"), "quantidade_consultas": c.get("quantidade_consultas")}
-            for c in consultas_rows
-        ]
-
-        root_assoc_cons = escolher_col(cursor, "cisp_associadas_consultaram", ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"]) or "raiz"
-        cursor.execute(f"SELECT * FROM cisp_associadas_consultaram WHERE {root_assoc_cons} = %s", (raiz,))
-        assoc_cons_rows = cursor.fetchall()
-        associadas_consultaram = [
-            {"codigo_associada": s.get("codigo_associada"), "razao_social": s.get("razao_social")}
-            for s in assoc_cons_rows
-        ]
-
-        root_assoc_nao = escolher_col(cursor, "cisp_associadas_nao_concederam_credito", ["raiz", "raizcnpj", "raiz_cnpj", "raizCnpj"]) or "raiz"
-        cursor.execute(f"SELECT * FROM cisp_associadas_nao_concederam_credito WHERE {root_assoc_nao} = %s", (raiz,))
-        assoc_nao_rows = cursor.fetchall()
-        associadas_nao_concederam = [
-            {"codigo_associada": s.get("codigo_associada"), "razao_social": s.get("razao_social")}
-            for s in assoc_nao_rows
-        ]
-
-        extras = {}
-        try:
-            if tabela_existe(cursor, "cisp_cheques_sem_fundo"):
-                cursor.execute("SELECT COUNT(*) AS total FROM cisp_cheques_sem_fundo WHERE raiz = %s", (raiz,))
-                r = cursor.fetchone()
-                extras["tot_cheques_sem_fundo"] = r.get("total") if isinstance(r, dict) else (r[0] if r else None)
-        except Exception:
-            extras["tot_cheques_sem_fundo"] = None
-        try:
-            if tabela_existe(cursor, "cisp_titulos_protesto"):
-                cursor.execute("SELECT COUNT(*) AS total FROM cisp_titulos_protesto WHERE raiz = %s", (raiz,))
-                r = cursor.fetchone()
-                extras["tot_titulos_protesto"] = r.get("total") if isinstance(r, dict) else (r[0] if r else None)
-        except Exception:
-            extras["tot_titulos_protesto"] = None
-
-        # Ratings e segmentos positivos direto do payload já obtido
-        ratings_list = []
-        positiva_segmentos = []
-        if payload_cisp:
-            if isinstance(payload_cisp.get("ratings"), list):
-                ratings_list = payload_cisp.get("ratings") or []
-            if isinstance(payload_cisp.get("positivaSegmentos"), list):
-                positiva_segmentos = payload_cisp.get("positivaSegmentos") or []
-
-        return jsonify({
-            "success": True,
-            "raiz": raiz,
-            "principal": principal,
-            "restritivas": restritivas,
-            "alertas": alertas,
-            "consultas_mensais": consultas_mensais,
-            "associadas_consultaram": associadas_consultaram,
-            "associadas_nao_concederam": associadas_nao_concederam,
-            "ratings": ratings_list,
-            "positivaSegmentos": positiva_segmentos,
-            "extras": extras,
-        })
+    ?desde=2025-01-01&ate=2026-01-01   período [desde, ate) (padrão: últimos 365 dias)
+    ?agrupar=dia|semana|mes            último ponto de cada período
+    """
+    try:
+        with conexao() as conn:
+            cursor = conn.cursor()
+            try:
+                if not esquema.atual(cursor).existe(historico.TABELA_HISTORICO):
+                    return jsonify({'success': False, 'mensagem': f'{historico.TABELA_HISTORICO} não existe'}), 404
+                with DB_CONSULTA.medir(tabela=historico.TABELA_HISTORICO, operacao="serie"), rastreio.span("historico"):
+                    serie = historico_clientes.serie(
+                        cursor, raiz,
+                        desde=request.args.get('desde'),
+                        ate=request.args.get('ate'),
+                        agrupar=request.args.get('agrupar'),
+                    )
+            finally:
+                cursor.close()
+        return jsonify({'success': True, **serie})
+    except ValueError as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 400
     except Exception as e:
-        return jsonify({"success": False, "erro": str(e)}), 500
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+        return jsonify({'success': False, 'mensagem': str(e)}), 500
 
 @app.route('/api/debug/<raiz>')
 def debug_raiz(raiz):
     conn = None
     cur = None
     try:
-        conn = conectar_db()
+        conn = pool.emprestar()
         cur = conn.cursor(cursor_factory=RealDictCursor)
         cur.execute("SELECT * FROM cisp_avaliacao_analitica WHERE raiz = %s LIMIT 1", (raiz,))
         row = cur.fetchone()
@@ -622,12 +795,11 @@ def debug_raiz(raiz):
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            pool.devolver(conn)
 
 @app.route('/api/debug-data')
 def debug_data():
     try:
-        import json
         with open(os.path.join(os.path.dirname(__file__), "data.json"), "r", encoding="utf-8") as f:
             payload = json.load(f)
         def keys(d):
@@ -657,28 +829,425 @@ def sincronizar(raiz):
     1. Busca dados na API CISP
     2. Insere no PostgreSQL
     3. Retorna sucesso/erro
+
+    Com ?retornar=1 devolve também o documento do cliente (campo "dados"),
+    montado na mesma conexão e sem nova chamada à CISP.
+    A resposta lista as seções regravadas e as puladas por não terem mudado;
+    ?forcar=1 regrava todas.
+    Com ?assincrono=1 só enfileira (fila.py) e responde 202 com o job_id.
     """
+    agenda.acessos.registrar(raiz)
+    forcar = request.args.get('forcar') in ('1', 'true')
+    if request.args.get('assincrono') in ('1', 'true'):
+        return _enfileirar([raiz], forcar)
     try:
-        dados = buscar_api_cisp(raiz)
-        if not dados:
-            return jsonify({'success': False, 'raiz': raiz, 'mensagem': 'Raiz não encontrada na API CISP'}), 404
+        try:
+            dados, _, gravou = sincronizar_raiz(raiz, _max_age_param(), gravar_do_cache=True, forcar=forcar)
+        except ErroCISP as e:
+            return resposta_erro_cisp(raiz, e)
 
-        sucesso = inserir_no_postgres(raiz, dados)
+        sucesso = gravou is not None
+        documento = None
+        if sucesso and request.args.get('retornar') in ('1', 'true'):
+            with conexao() as conn:
+                documento = montar_documento(conn, raiz, dados)
         if sucesso:
-            return jsonify({'success': True, 'raiz': raiz, 'mensagem': 'Dados sincronizados com sucesso', 'timestamp': str(datetime.now())})
+            resposta = {'success': True, 'raiz': raiz, 'mensagem': 'Dados sincronizados com sucesso', 'timestamp': str(datetime.now()), **gravou}
+            if documento is not None:
+                resposta['dados'] = documento
+            return jsonify(resposta)
         return jsonify({'success': False, 'raiz': raiz, 'mensagem': 'Erro ao inserir dados no PostgreSQL'}), 500
     except Exception as e:
         return jsonify({'success': False, 'raiz': raiz, 'mensagem': str(e)}), 500
 
 
+lotes = GerenciadorLotes(buscar=buscar_api_cisp_coalescido, gravar=gravar_payload, conexao=conexao, url_base=API_BASE_URL)
+
+@app.route('/api/sincronizar/lote', methods=['POST'])
+def sincronizar_lote():
+    """
+    Sincroniza várias raízes em segundo plano.
+
+    JSON:  {"raizes": ["45543915", ...], "workers": 8}
+    CSV:   multipart com o arquivo no campo "arquivo" (ou corpo text/csv),
+           raiz/CNPJ na primeira coluna; ?workers=8 opcional
+
+    Retorna 202 com o job_id; acompanhe em GET /api/sincronizar/lote/<job_id>.
+    """
+    try:
+        workers = request.args.get('workers')
+        if 'arquivo' in request.files:
+            raizes = raizes_de_csv(request.files['arquivo'].read().decode('utf-8-sig', errors='replace'))
+        elif request.mimetype in ('text/csv', 'text/plain'):
+            raizes = raizes_de_csv(request.get_data(as_text=True))
+        else:
+            corpo = request.get_json(silent=True) or {}
+            raizes = corpo.get('raizes') or []
+            workers = corpo.get('workers', workers)
+        job = lotes.criar(raizes, workers)
+        return jsonify({'success': True, **job.resumo(detalhar=False)}), 202
+    except ValueError as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 500
+
+@app.route('/api/sincronizar/lote', methods=['GET'])
+def listar_lotes():
+    return jsonify({'success': True, 'jobs': lotes.listar()})
+
+@app.route('/api/sincronizar/lote/<job_id>')
+def status_lote(job_id):
+    job = lotes.obter(job_id)
+    if job is None:
+        return jsonify({'success': False, 'mensagem': 'Job não encontrado'}), 404
+    return jsonify({'success': True, **job.resumo(detalhar=request.args.get('detalhe', '1') != '0')})
+
+
+def _enfileirar(raizes, forcar=False, max_tentativas=None):
+    try:
+        with conexao() as conn:
+            cursor = conn.cursor()
+            try:
+                jobs = fila.enfileirar(cursor, raizes, forcar, max_tentativas)
+                conn.commit()
+            finally:
+                cursor.close()
+        return jsonify({'success': True, 'quantidade': len(jobs), 'jobs': jobs}), 202
+    except ValueError as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 500
+
+@app.route('/api/fila', methods=['POST'])
+def enfileirar_jobs():
+    """
+    Enfileira sincronizações em cisp_sync_jobs (consumidas pelos workers de fila.py).
+
+    JSON:  {"raizes": ["45543915", ...], "forcar": false, "max_tentativas": 5}
+    CSV:   multipart com o arquivo no campo "arquivo" (ou corpo text/csv)
+
+    Retorna 202 com um job_id por raiz; raiz que já tinha job pendente reaproveita o existente.
+    """
+    forcar = request.args.get('forcar') in ('1', 'true')
+    max_tentativas = request.args.get('max_tentativas', type=int)
+    if 'arquivo' in request.files:
+        raizes = raizes_de_csv(request.files['arquivo'].read().decode('utf-8-sig', errors='replace'))
+    elif request.mimetype in ('text/csv', 'text/plain'):
+        raizes = raizes_de_csv(request.get_data(as_text=True))
+    else:
+        corpo = request.get_json(silent=True) or {}
+        raizes = corpo.get('raizes') or []
+        forcar = bool(corpo.get('forcar', forcar))
+        max_tentativas = corpo.get('max_tentativas', max_tentativas)
+    return _enfileirar(raizes, forcar, max_tentativas)
+
+@app.route('/api/fila', methods=['GET'])
+def ver_fila():
+    """Resumo da fila; ?estado=falhou (dead-letter) ou ?raiz= lista os jobs"""
+    try:
+        with conexao() as conn:
+            cursor = conn.cursor()
+            try:
+                resposta = {'success': True, **fila.resumo(cursor)}
+                estado, raiz = request.args.get('estado'), request.args.get('raiz')
+                if estado or raiz:
+                    resposta['jobs'] = fila.listar(cursor, estado, raiz, limite=request.args.get('limite', 100, type=int))
+            finally:
+                cursor.close()
+        return jsonify(resposta)
+    except Exception as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 500
+
+@app.route('/api/fila/<int:job_id>', methods=['GET'])
+def status_job(job_id):
+    try:
+        with conexao() as conn:
+            cursor = conn.cursor()
+            try:
+                job = fila.obter(cursor, job_id)
+            finally:
+                cursor.close()
+        if job is None:
+            return jsonify({'success': False, 'mensagem': 'Job não encontrado'}), 404
+        return jsonify({'success': True, **job})
+    except Exception as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 500
+
+@app.route('/api/fila/<int:job_id>/reprocessar', methods=['POST'])
+def reprocessar_job(job_id):
+    """Devolve à fila um job que falhou (dead-letter), com as tentativas zeradas"""
+    try:
+        with conexao() as conn:
+            cursor = conn.cursor()
+            try:
+                ok = fila.reprocessar(cursor, job_id)
+                conn.commit()
+            finally:
+                cursor.close()
+        if not ok:
+            return jsonify({'success': False, 'mensagem': 'Job não encontrado ou ainda na fila'}), 404
+        return jsonify({'success': True, 'job_id': job_id})
+    except Exception as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 500
+
+
+# Atualização em segundo plano da watchlist (ver agendador.py)
+agendador = agenda.Agendador(
+    sincronizar=lambda raiz: sincronizar_raiz(raiz, max_age=0, gravar_do_cache=True)[2],
+    conexao=conexao,
+)
+
+@app.route('/api/agenda', methods=['GET'])
+def ver_agenda():
+    """Watchlist: tamanho, raízes vencidas, orçamento usado na última hora e as próximas da fila"""
+    try:
+        with conexao() as conn:
+            cursor = conn.cursor()
+            try:
+                resumo = agendador.resumo(cursor, esquema.atual(cursor), limite=request.args.get('limite', 20, type=int))
+            finally:
+                cursor.close()
+        return jsonify({'success': True, **resumo, 'agendador': agendador.estatisticas() if agenda.AGENDA_NO_PROCESSO else None})
+    except Exception as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 500
+
+@app.route('/api/agenda/raizes', methods=['POST'])
+def incluir_agenda():
+    """Inclui raízes na watchlist: JSON {"raizes": [...]} ou CSV (campo "arquivo"), como no lote"""
+    try:
+        if 'arquivo' in request.files:
+            raizes = raizes_de_csv(request.files['arquivo'].read().decode('utf-8-sig', errors='replace'))
+        elif request.mimetype in ('text/csv', 'text/plain'):
+            raizes = raizes_de_csv(request.get_data(as_text=True))
+        else:
+            raizes = (request.get_json(silent=True) or {}).get('raizes') or []
+        with conexao() as conn:
+            cursor = conn.cursor()
+            try:
+                incluidas = agenda.incluir(cursor, raizes)
+                conn.commit()
+            finally:
+                cursor.close()
+        if not incluidas:
+            return jsonify({'success': False, 'mensagem': 'nenhuma raiz válida informada'}), 400
+        return jsonify({'success': True, 'incluidas': incluidas})
+    except Exception as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 500
+
+@app.route('/api/agenda/raizes/<raiz>', methods=['DELETE'])
+def remover_agenda(raiz):
+    try:
+        with conexao() as conn:
+            cursor = conn.cursor()
+            try:
+                removidas = agenda.remover(cursor, raiz)
+                conn.commit()
+            finally:
+                cursor.close()
+        if not removidas:
+            return jsonify({'success': False, 'mensagem': 'Raiz não está na watchlist'}), 404
+        return jsonify({'success': True, 'raiz': raiz})
+    except Exception as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 500
+
+
+@app.route('/api/exportar', methods=['GET', 'POST'])
+def exportar():
+    """
+    Exporta uma tabela cisp_* em streaming (chunked), com memória constante.
+
+    ?formato=ndjson|csv|parquet   (padrão ndjson)
+    ?tabela=cisp_restritivas      (padrão cisp_avaliacao_analitica)
+    ?raizes=1,2  ?uf=SP,RJ  ?rating=A,B  ?desde=2026-01-01  ?ate=2026-02-01
+    POST aceita os mesmos campos em JSON (útil para listas grandes de raízes).
+    """
+    try:
+        params = dict(request.args)
+        if request.method == 'POST':
+            params.update(request.get_json(silent=True) or {})
+        formato = params.get('formato', 'ndjson')
+        tabela = params.get('tabela', exportacao.TABELA_PRINCIPAL)
+        with conexao() as conn:
+            cursor = conn.cursor()
+            try:
+                snap = esquema.atual(cursor)
+            finally:
+                cursor.close()
+        escritor, sql, sql_params = exportacao.preparar(snap, tabela, exportacao.filtros_de(params), formato)
+        corpo = exportacao.Exportacao(pool, escritor, sql, sql_params)
+    except ValueError as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 400
+    except exportacao.ExportacaoOcupada as e:
+        resp = jsonify({'success': False, 'mensagem': str(e)})
+        resp.status_code = 429
+        resp.headers['Retry-After'] = '30'
+        return resp
+    except Exception as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 500
+
+    mimetype, extensao = exportacao.FORMATOS[formato]
+    nome = f"{tabela}_{datetime.now():%Y%m%d_%H%M%S}.{extensao}"
+    return app.response_class(corpo, content_type=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{nome}"',
+        'X-Accel-Buffering': 'no',
+    })
+
+@app.route('/api/alteracoes')
+def alteracoes():
+    """
+    Raízes gravadas depois de ?desde=<watermark>, com o documento de cada uma.
+
+    ?limite=500        itens por página
+    ?cursor=<token>    página seguinte (proximo_cursor da resposta anterior)
+    ?documentos=0      só raiz + data_atualizacao
+
+    Percorra até proximo_cursor vir null e guarde "watermark" para a próxima carga.
+    """
+    try:
+        with conexao() as conn:
+            cursor = conn.cursor()
+            try:
+                pagina = feed_alteracoes.pagina(
+                    cursor, esquema.atual(cursor),
+                    desde=request.args.get('desde'),
+                    token=request.args.get('cursor'),
+                    limite=request.args.get('limite', type=int),
+                    documentos=request.args.get('documentos', '1') not in ('0', 'false'),
+                )
+            finally:
+                cursor.close()
+        return jsonify(pagina)
+    except ValueError as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 500
+
+# 1 = não sobe com migração pendente; 0 = só avisa (o que faltar no banco fica desligado)
+EXIGIR_MIGRACOES = os.environ.get('CISP_EXIGIR_MIGRACOES', '0') in ('1', 'true', 'True')
+
+def verificar_migracoes(cursor):
+    """As tabelas são criadas por migracoes.py; aqui só confere se falta alguma versão"""
+    pendentes = migracoes.pendentes(cursor)
+    if not pendentes:
+        return
+    lista = ", ".join(f"{versao} ({nome})" for versao, nome, *_ in pendentes)
+    if EXIGIR_MIGRACOES:
+        raise migracoes.ErroMigracao(f"migrações pendentes: {lista}; rode python migracoes.py aplicar")
+    log.warning("Migrações pendentes: %s; rode python migracoes.py aplicar", lista)
+
+def carregar_esquema():
+    """(Re)lê o catálogo das tabelas cisp_* e recompila os mapeadores (sem DDL: ver migracoes.py)"""
+    with conexao() as conn:
+        cursor = conn.cursor()
+        try:
+            verificar_migracoes(cursor)
+            snap = esquema.carregar(cursor)
+            conn.commit()
+        finally:
+            cursor.close()
+    return snap
+
+@app.route('/api/esquema', methods=['GET'])
+def ver_esquema():
+    try:
+        with conexao() as conn:
+            cursor = conn.cursor()
+            try:
+                return jsonify({'success': True, **esquema.atual(cursor).resumo()})
+            finally:
+                cursor.close()
+    except Exception as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 500
+
+@app.route('/api/esquema/recarregar', methods=['POST'])
+def recarregar_esquema():
+    """Chame após ALTER TABLE/CREATE INDEX nas tabelas cisp_*: novos statements são preparados sob nova versão"""
+    try:
+        return jsonify({'success': True, **carregar_esquema().resumo()})
+    except Exception as e:
+        return jsonify({'success': False, 'mensagem': str(e)}), 500
+
+# Compila na inicialização; se o banco estiver fora, compila na primeira gravação/leitura
+try:
+    carregar_esquema()
+except migracoes.ErroMigracao:
+    raise
+except Exception as e:
+    log.warning("Esquema não carregado na inicialização: %s", e)
+
+agenda.acessos.iniciar(conexao)
+if agenda.AGENDA_NO_PROCESSO:
+    agendador.iniciar()
+
+# =============================================================================
+# MÉTRICAS (ver metricas.py) E RASTREIO POR REQUISIÇÃO (ver rastreio.py)
+# =============================================================================
+rastreio.instalar(app)
+
+def _rota():
+    return request.url_rule.rule if request.url_rule is not None else "desconhecida"
+
+@app.before_request
+def _inicio_requisicao():
+    g.inicio_requisicao = time.perf_counter()
+    g.rota_metrica = _rota()
+    HTTP_EM_ANDAMENTO.inc(rota=g.rota_metrica)
+
+@app.after_request
+def _fim_requisicao(resp):
+    inicio = g.get("inicio_requisicao")
+    if inicio is not None:
+        HTTP_DURACAO.observar(time.perf_counter() - inicio, rota=g.rota_metrica, metodo=request.method, status=resp.status_code)
+    return resp
+
+@app.teardown_request
+def _liberar_requisicao(_erro=None):
+    rota = g.pop("rota_metrica", None)
+    if rota is not None:
+        HTTP_EM_ANDAMENTO.dec(rota=rota)
+
+@metricas.registro.coletor
+def _coletar_processo():
+    c = cache_payload.estatisticas()
+    a = arquivo_payload.estatisticas()
+    h = historico_clientes.estatisticas()
+    p = pool.estatisticas()
+    ocupadas = HTTP_EM_ANDAMENTO.total()
+    return [
+        ("cache_payload_consultas_total", "counter", "Consultas ao cache de payloads da CISP",
+         [({"resultado": "hit"}, c["hits"]), ({"resultado": "miss"}, c["misses"])]),
+        ("cache_payload_hit_ratio", "gauge", "Fração das consultas atendidas pelo cache", [({}, c["hit_ratio"])]),
+        ("cache_payload_entradas", "gauge", "Payloads no cache", [({}, c["entradas"])]),
+        ("cache_payload_bytes", "gauge", "Bytes ocupados pelo cache", [({}, c["bytes"])]),
+        ("arquivo_payload_consultas_total", "counter", "Consultas ao arquivo de payloads (cache L2 no Postgres)",
+         [({"resultado": "hit"}, a["hits"]), ({"resultado": "miss"}, a["misses"])]),
+        ("arquivo_payload_gravacoes_total", "counter", "Payloads arquivados: versão nova ou repetida (só buscado_em)",
+         [({"resultado": "nova"}, a["gravados"]), ({"resultado": "repetida"}, a["repetidos"])]),
+        ("historico_pontos_total", "counter", "Pontos de cisp_historico: gravados ou iguais ao anterior (não gravados)",
+         [({"resultado": "gravado"}, h["gravados"]), ({"resultado": "repetido"}, h["repetidos"])]),
+        ("historico_particoes", "gauge", "Partições mensais de cisp_historico conhecidas pelo processo", [({}, h["particoes"])]),
+        ("db_pool_conexoes", "gauge", "Conexões do pool por estado",
+         [({"estado": "em_uso"}, p["em_uso"]), ({"estado": "ociosas"}, p["ociosas"])]),
+        ("db_pool_maximo", "gauge", "Máximo de conexões do pool", [({}, p["maximo"])]),
+        ("db_pool_timeouts_total", "counter", "Esperas por conexão que estouraram o timeout", [({}, p["timeouts"])]),
+        ("waitress_threads", "gauge", "Threads do waitress (WAITRESS_THREADS)", [({}, WAITRESS_THREADS)]),
+        ("waitress_threads_ocupadas", "gauge", "Threads atendendo requisições", [({}, ocupadas)]),
+        ("waitress_saturacao", "gauge", "Threads ocupadas / threads do waitress",
+         [({}, round(ocupadas / WAITRESS_THREADS, 4) if WAITRESS_THREADS else 0.0)]),
+    ]
+
+@app.route('/metrics')
+def metrics():
+    return app.response_class(metricas.registro.exportar(), content_type=metricas.CONTENT_TYPE)
+
 @app.route('/api/health')
 def health():
     try:
-        conn = conectar_db()
-        conn.close()
-        return jsonify({'status': 'ok', 'database': 'conectado', 'timestamp': str(datetime.now())})
+        with conexao():
+            pass
+        return jsonify({'status': 'ok', 'database': 'conectado', 'pool': pool.estatisticas(), 'cache': cache_payload.estatisticas(), 'arquivo': arquivo_payload.estatisticas(), 'historico': historico_clientes.estatisticas(), 'cisp': cliente_cisp.estatisticas(), 'coalescencia': voo_unico.estatisticas(), 'esquema_versao': esquema.versao, 'timestamp': str(datetime.now())})
     except Exception as e:
-        return jsonify({'status': 'erro', 'database': 'desconectado', 'erro': str(e)}), 500
+        return jsonify({'status': 'erro', 'database': 'desconectado', 'pool': pool.estatisticas(), 'erro': str(e)}), 500
 
 
 # =============================================================================
@@ -690,5 +1259,5 @@ def pagina():
 
 
 if __name__ == '__main__':
-    print("🚀 Portal CISP rodando em: http://localhost:5000")
+    log.info("Portal CISP rodando em: http://localhost:5000")
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,191 @@
+"""
+ARQUIVO DOS PAYLOADS BRUTOS DA CISP (cisp_payload_raw) — CACHE L2 COMPARTILHADO
+
+Todo payload obtido da CISP é guardado inteiro, comprimido (zlib), com o
+sha256 do conteúdo. Nada do que a CISP devolve se perde no mapeamento
+(ratings, positivaSegmentos, informacoesComportamentaisSegmentos,
+chequeSemfundo, sintegras, indicadores...) e o arquivo serve de:
+
+- cache L2: cache_payload (L1, em memória) -> cisp_payload_raw -> CISP.
+  Uma raiz buscada por qualquer processo/container não é buscada de novo
+  pelos outros dentro de CISP_ARQUIVO_TTL segundos
+- fonte para reprocessar o mapeamento sem chamar a CISP
+
+Mesmo conteúdo da última versão da raiz (mesmo hash) só atualiza buscado_em:
+uma linha nova por mudança real, não por busca.
+
+Retenção: versões mais velhas que CISP_ARQUIVO_RETENCAO_DIAS são apagadas,
+mas a última versão de cada raiz é sempre mantida. A limpeza roda aos
+poucos junto das gravações (no máximo uma vez por hora por processo) e
+por completo com `python arquivo_cisp.py limpar`.
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import hashlib
+import threading
+
+from cache_cisp import CACHE_TTL
+
+TABELA_RAW = "cisp_payload_raw"
+
+ARQUIVO_ATIVO = os.environ.get('CISP_ARQUIVO', '1') not in ('0', 'false', 'False')
+ARQUIVO_TTL = float(os.environ.get('CISP_ARQUIVO_TTL', str(CACHE_TTL)))
+ARQUIVO_RETENCAO_DIAS = int(os.environ.get('CISP_ARQUIVO_RETENCAO_DIAS', '90'))
+ARQUIVO_NIVEL_ZLIB = int(os.environ.get('CISP_ARQUIVO_NIVEL_ZLIB', '6'))
+# linhas apagadas por limpeza incremental (a completa não tem limite)
+ARQUIVO_LIMPEZA_LOTE = int(os.environ.get('CISP_ARQUIVO_LIMPEZA_LOTE', '5000'))
+ARQUIVO_LIMPEZA_S = 3600
+
+SQL_CRIAR_TABELA = [
+    f"""
+    CREATE TABLE IF NOT EXISTS {TABELA_RAW} (
+        id bigserial PRIMARY KEY,
+        raiz text NOT NULL,
+        buscado_em timestamptz NOT NULL DEFAULT now(),
+        primeiro_em timestamptz NOT NULL DEFAULT now(),
+        hash char(64) NOT NULL,
+        tamanho integer NOT NULL,
+        corpo bytea NOT NULL
+    )
+    """,
+    f"CREATE INDEX IF NOT EXISTS {TABELA_RAW}_raiz_idx ON {TABELA_RAW} (raiz, buscado_em DESC)",
+    f"CREATE INDEX IF NOT EXISTS {TABELA_RAW}_buscado_idx ON {TABELA_RAW} (buscado_em)",
+    # o corpo já vem comprimido: sem nova tentativa de compressão no TOAST
+    f"ALTER TABLE {TABELA_RAW} ALTER COLUMN corpo SET STORAGE EXTERNAL",
+]
+
+# Mesmo hash da última versão -> só carimba buscado_em; senão, versão nova
+SQL_ARQUIVAR = f"""
+    WITH ultima AS (
+        SELECT id, hash FROM {TABELA_RAW} WHERE raiz = %(raiz)s ORDER BY buscado_em DESC LIMIT 1
+    ), repetida AS (
+        UPDATE {TABELA_RAW} r SET buscado_em = now() FROM ultima
+        WHERE r.id = ultima.id AND ultima.hash = %(hash)s RETURNING r.id
+    )
+    INSERT INTO {TABELA_RAW} (raiz, hash, tamanho, corpo)
+    SELECT %(raiz)s, %(hash)s, %(tamanho)s, %(corpo)s
+    WHERE NOT EXISTS (SELECT 1 FROM repetida)
+"""
+
+SQL_ULTIMA = f"""
+    SELECT extract(epoch FROM now() - buscado_em) AS idade, tamanho, corpo
+    FROM {TABELA_RAW} WHERE raiz = %s AND buscado_em >= now() - make_interval(secs => %s)
+    ORDER BY buscado_em DESC LIMIT 1
+"""
+
+# Versões antigas, nunca a última de cada raiz
+SQL_ANTIGAS = f"""
+    SELECT r.id FROM {TABELA_RAW} r
+    WHERE r.buscado_em < now() - make_interval(days => %(dias)s)
+      AND EXISTS (SELECT 1 FROM {TABELA_RAW} n WHERE n.raiz = r.raiz AND n.buscado_em > r.buscado_em)
+"""
+
+
+def serializar(payload):
+    """(json canônico em bytes, sha256) — chaves ordenadas: o hash não depende da ordem"""
+    texto = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return texto, hashlib.sha256(texto).hexdigest()
+
+
+def comprimir(texto):
+    return zlib.compress(texto, ARQUIVO_NIVEL_ZLIB)
+
+
+def descomprimir(corpo):
+    return json.loads(zlib.decompress(bytes(corpo)))
+
+
+def _coluna(row, nome, indice):
+    return row[nome] if isinstance(row, dict) else row[indice]
+
+
+class ArquivoPayload:
+    def __init__(self, ttl=ARQUIVO_TTL, retencao_dias=ARQUIVO_RETENCAO_DIAS):
+        self.ttl = ttl
+        self.retencao_dias = retencao_dias
+        self._ultima_limpeza = time.monotonic()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "gravados": 0, "repetidos": 0, "apagados": 0}
+
+    def _contar(self, chave, n=1):
+        with self._lock:
+            self._stats[chave] += n
+
+    def obter(self, cursor, raiz, max_age=None):
+        """(payload, idade em segundos, bytes do JSON) da última versão dentro de min(ttl, max_age), ou None"""
+        limite = self.ttl if max_age is None else min(self.ttl, max_age)
+        if limite <= 0:
+            return None
+        cursor.execute(SQL_ULTIMA, (raiz, limite))
+        row = cursor.fetchone()
+        if row is None:
+            self._contar("misses")
+            return None
+        self._contar("hits")
+        return descomprimir(_coluna(row, "corpo", 2)), float(_coluna(row, "idade", 0)), _coluna(row, "tamanho", 1)
+
+    def arquivar(self, cursor, raiz, payload):
+        """Guarda o payload na transação de quem chama; devolve True se criou versão nova"""
+        texto, h = serializar(payload)
+        cursor.execute(SQL_ARQUIVAR, {"raiz": raiz, "hash": h, "tamanho": len(texto), "corpo": comprimir(texto)})
+        nova = cursor.rowcount == 1
+        self._contar("gravados" if nova else "repetidos")
+        if time.monotonic() - self._ultima_limpeza > ARQUIVO_LIMPEZA_S:
+            self._ultima_limpeza = time.monotonic()
+            self.limpar(cursor, lote=ARQUIVO_LIMPEZA_LOTE)
+        return nova
+
+    def limpar(self, cursor, dias=None, lote=None):
+        """Apaga versões além da retenção (mantém a última de cada raiz); devolve quantas"""
+        dias = self.retencao_dias if dias is None else dias
+        sql = SQL_ANTIGAS + (f" LIMIT {int(lote)}" if lote else "")
+        cursor.execute(f"DELETE FROM {TABELA_RAW} WHERE id IN ({sql})", {"dias": int(dias)})
+        self._contar("apagados", cursor.rowcount)
+        return cursor.rowcount
+
+    def estatisticas(self):
+        with self._lock:
+            consultas = self._stats["hits"] + self._stats["misses"]
+            return {
+                "ativo": ARQUIVO_ATIVO,
+                "ttl_s": self.ttl,
+                "retencao_dias": self.retencao_dias,
+                "hit_ratio": round(self._stats["hits"] / consultas, 4) if consultas else 0.0,
+                **self._stats,
+            }
+
+
+def garantir_tabela(cursor):
+    """Cria tabela e índices só se a tabela não existir: com ela criada, nenhum lock é pedido
+    (CREATE INDEX IF NOT EXISTS/ALTER TABLE esperariam leituras longas, como as do reprocessar.py)"""
+    cursor.execute("SELECT to_regclass(%s) AS tabela", (TABELA_RAW,))
+    if _coluna(cursor.fetchone(), "tabela", 0) is not None:
+        return
+    for sql in SQL_CRIAR_TABELA:
+        cursor.execute(sql)
+
+
+arquivo_payload = ArquivoPayload()
+
+
+if __name__ == '__main__':
+    # python arquivo_cisp.py limpar [dias]
+    from banco import conexao
+
+    if len(sys.argv) < 2 or sys.argv[1] != "limpar":
+        print("uso: python arquivo_cisp.py limpar [dias]")
+        sys.exit(2)
+    dias = int(sys.argv[2]) if len(sys.argv) > 2 else ARQUIVO_RETENCAO_DIAS
+    with conexao() as conn:
+        cursor = conn.cursor()
+        try:
+            garantir_tabela(cursor)
+            apagados = arquivo_payload.limpar(cursor, dias)
+            conn.commit()
+        finally:
+            cursor.close()
+    print(f"{apagados} versão(ões) com mais de {dias} dias apagadas de {TABELA_RAW}")
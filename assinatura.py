@@ -0,0 +1,88 @@
+"""
+ASSINATURA (HASH) DAS SEÇÕES DO PAYLOAD
+
+Cada seção de tabela filha do payload da CISP (restritivas, alertas,
+consultas, associadas...) recebe um sha256 do seu conteúdo normalizado:
+JSON com chaves ordenadas, itens em ordem canônica e as colunas gravadas
+pelo mapeador. A assinatura fica em cisp_payload_hash (raiz, secao).
+
+Na sincronização, seção com a mesma assinatura da última gravação não é
+tocada (nem DELETE nem INSERT): menos WAL, menos bloat, menos autovacuum.
+Mudou o esquema (recarga com outras colunas)? A assinatura muda junto e a
+seção é regravada.
+
+Quem grava as tabelas filhas por outro caminho (CLI do integração.py,
+APIFLASK.py) chama esquecer() na mesma transação: sem assinatura, a próxima
+sincronização do app regrava todas as seções da raiz.
+
+Desligue com CISP_PULAR_INALTERADOS=0; ?forcar=1 na sincronização ignora as
+assinaturas de uma raiz (útil se alguém mexeu nas tabelas por fora).
+"""
+
+import os
+import json
+import hashlib
+
+from psycopg2.extras import execute_values
+
+TABELA_HASH = "cisp_payload_hash"
+
+PULAR_INALTERADOS = os.environ.get('CISP_PULAR_INALTERADOS', '1') not in ('0', 'false', 'False')
+
+SQL_CRIAR_TABELA = f"""
+    CREATE TABLE IF NOT EXISTS {TABELA_HASH} (
+        raiz text NOT NULL,
+        secao text NOT NULL,
+        hash char(64) NOT NULL,
+        atualizado_em timestamp NOT NULL DEFAULT now(),
+        PRIMARY KEY (raiz, secao)
+    )
+"""
+
+
+def _canonico(valor):
+    return json.dumps(valor, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def hash_secao(itens, colunas):
+    """sha256 da seção: independe da ordem das chaves e dos itens"""
+    h = hashlib.sha256()
+    h.update(_canonico(list(colunas)).encode("utf-8"))
+    for item in sorted(_canonico(i) for i in itens):
+        h.update(b"\n")
+        h.update(item.encode("utf-8"))
+    return h.hexdigest()
+
+
+def garantir_tabela(cursor):
+    cursor.execute(SQL_CRIAR_TABELA)
+
+
+def hashes_gravados(cursor, raiz):
+    """{secao: hash} da última gravação da raiz"""
+    cursor.execute(f"SELECT secao, hash FROM {TABELA_HASH} WHERE raiz = %s", (raiz,))
+    return {
+        (r["secao"] if isinstance(r, dict) else r[0]): (r["hash"] if isinstance(r, dict) else r[1])
+        for r in cursor.fetchall()
+    }
+
+
+def gravar_hashes(cursor, raiz, hashes):
+    if not hashes:
+        return
+    execute_values(
+        cursor,
+        f"INSERT INTO {TABELA_HASH} (raiz, secao, hash) VALUES %s "
+        f"ON CONFLICT (raiz, secao) DO UPDATE SET hash = EXCLUDED.hash, atualizado_em = now()",
+        [(raiz, secao, h) for secao, h in hashes.items()],
+    )
+
+
+def esquecer(cursor, raiz):
+    """Apaga as assinaturas da raiz (tabelas filhas gravadas sem passar por gravar_hashes)"""
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (TABELA_HASH,))
+    row = cursor.fetchone()
+    if not (list(row.values())[0] if isinstance(row, dict) else row[0]):
+        return 0
+    cursor.execute(f"DELETE FROM {TABELA_HASH} WHERE raiz = %s", (raiz,))
+    return cursor.rowcount
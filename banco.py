@@ -0,0 +1,257 @@
+"""
+POOL DE CONEXÕES POSTGRESQL
+
+Pool único por processo, thread-safe, dimensionado pelo número de threads do
+waitress. Toda rota e toda gravação pegam a conexão daqui:
+
+    with conexao() as conn:
+        cur = conn.cursor()
+        ...
+
+- conexões são validadas ao serem emprestadas (descarta as quebradas)
+- conexões mais velhas que DB_POOL_MAX_IDADE segundos são recicladas
+- estatisticas() alimenta o /api/health
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+import rastreio
+from metricas import DB_CONEXAO
+
+# Carrega .env automaticamente (opcional)
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except Exception:
+    pass
+
+DB_CONFIG = {
+    'host': os.environ.get('DB_HOST', '127.0.0.1'),
+    'port': os.environ.get('DB_PORT', '5432'),
+    'database': os.environ.get('DB_NAME', 'dbDataLakePrd'),
+    'user': os.environ.get('DB_USER', 'postgres'),
+    'password': os.environ.get('POSTGRES'),
+    'options': f"-c search_path={os.environ.get('DB_SCHEMA', 'scsilverlayer')}"
+}
+
+WAITRESS_THREADS = int(os.environ.get('WAITRESS_THREADS', '4'))
+POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+POOL_MAX = int(os.environ.get('DB_POOL_MAX', str(WAITRESS_THREADS)))
+POOL_MAX_IDADE = float(os.environ.get('DB_POOL_MAX_IDADE', '1800'))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+# Conexões ociosas há mais tempo que isso recebem um SELECT 1 antes de serem entregues
+POOL_VALIDAR_APOS = float(os.environ.get('DB_POOL_VALIDAR_APOS', '30'))
+
+
+class PoolEsgotado(Exception):
+    """Nenhuma conexão ficou livre dentro de DB_POOL_TIMEOUT segundos."""
+
+
+def conectar_db():
+    return psycopg2.connect(**DB_CONFIG)
+
+
+class _Entrada:
+    __slots__ = ("conn", "criada_em", "devolvida_em")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.criada_em = time.monotonic()
+        self.devolvida_em = self.criada_em
+
+
+class PoolConexoes:
+    def __init__(self, minimo=POOL_MIN, maximo=POOL_MAX, max_idade=POOL_MAX_IDADE,
+                 timeout=POOL_TIMEOUT, validar_apos=POOL_VALIDAR_APOS, fabrica=conectar_db):
+        self.minimo = max(0, minimo)
+        self.maximo = max(1, maximo)
+        self.max_idade = max_idade
+        self.timeout = timeout
+        self.validar_apos = validar_apos
+        self._fabrica = fabrica
+        self._ociosas = deque()
+        self._em_uso = {}
+        self._total = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._stats = {
+            "emprestimos": 0,
+            "criadas": 0,
+            "descartadas": 0,
+            "recicladas": 0,
+            "timeouts": 0,
+            "espera_total_s": 0.0,
+            "espera_max_s": 0.0,
+        }
+
+    # ------------------------------------------------------------------
+    def _abrir(self):
+        conn = self._fabrica()
+        with self._cond:
+            self._stats["criadas"] += 1
+        return _Entrada(conn)
+
+    def _fechar(self, entrada):
+        try:
+            entrada.conn.close()
+        except Exception:
+            pass
+
+    def _valida(self, entrada):
+        conn = entrada.conn
+        if conn.closed:
+            return False
+        if time.monotonic() - entrada.criada_em > self.max_idade:
+            with self._cond:
+                self._stats["recicladas"] += 1
+            return False
+        status = conn.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                return False
+        if time.monotonic() - entrada.devolvida_em > self.validar_apos:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except Exception:
+                return False
+        return True
+
+    # ------------------------------------------------------------------
+    def emprestar(self):
+        inicio = time.monotonic()
+        limite = inicio + self.timeout
+        while True:
+            entrada = None
+            criar = False
+            with self._cond:
+                while True:
+                    if self._ociosas:
+                        entrada = self._ociosas.pop()
+                        break
+                    if self._total < self.maximo:
+                        self._total += 1
+                        criar = True
+                        break
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolEsgotado(f"pool esgotado após {self.timeout:.1f}s ({self.maximo} conexões em uso)")
+                    self._cond.wait(restante)
+
+            if criar:
+                try:
+                    entrada = self._abrir()
+                except Exception:
+                    with self._cond:
+                        self._total -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._valida(entrada):
+                self._fechar(entrada)
+                with self._cond:
+                    self._total -= 1
+                    self._stats["descartadas"] += 1
+                    self._cond.notify()
+                continue
+
+            espera = time.monotonic() - inicio
+            DB_CONEXAO.observar(espera)
+            rastreio.registrar("pool", espera)
+            with self._cond:
+                self._em_uso[id(entrada.conn)] = entrada
+                self._stats["emprestimos"] += 1
+                self._stats["espera_total_s"] += espera
+                if espera > self._stats["espera_max_s"]:
+                    self._stats["espera_max_s"] = espera
+            return entrada.conn
+
+    def devolver(self, conn, descartar=False):
+        with self._cond:
+            entrada = self._em_uso.pop(id(conn), None)
+        if entrada is None:
+            return
+        if not descartar and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                descartar = True
+        if descartar or conn.closed or time.monotonic() - entrada.criada_em > self.max_idade:
+            self._fechar(entrada)
+            with self._cond:
+                self._total -= 1
+                self._stats["descartadas"] += 1
+                self._cond.notify()
+            return
+        entrada.devolvida_em = time.monotonic()
+        with self._cond:
+            self._ociosas.append(entrada)
+            self._cond.notify()
+
+    def aquecer(self):
+        """Abre POOL_MIN conexões antecipadamente (falhas são ignoradas)."""
+        conns = []
+        try:
+            for _ in range(self.minimo):
+                conns.append(self.emprestar())
+        except Exception:
+            pass
+        for c in conns:
+            self.devolver(c)
+
+    def fechar_tudo(self):
+        with self._cond:
+            ociosas = list(self._ociosas)
+            self._ociosas.clear()
+            self._total -= len(ociosas)
+        for e in ociosas:
+            self._fechar(e)
+
+    def estatisticas(self):
+        with self._cond:
+            emprestimos = self._stats["emprestimos"]
+            return {
+                "em_uso": len(self._em_uso),
+                "ociosas": len(self._ociosas),
+                "total": self._total,
+                "maximo": self.maximo,
+                "emprestimos": emprestimos,
+                "criadas": self._stats["criadas"],
+                "descartadas": self._stats["descartadas"],
+                "recicladas": self._stats["recicladas"],
+                "timeouts": self._stats["timeouts"],
+                "espera_media_ms": round(self._stats["espera_total_s"] / emprestimos * 1000, 3) if emprestimos else 0.0,
+                "espera_max_ms": round(self._stats["espera_max_s"] * 1000, 3),
+            }
+
+    @contextmanager
+    def conexao(self):
+        conn = self.emprestar()
+        quebrada = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            quebrada = True
+            raise
+        finally:
+            self.devolver(conn, descartar=quebrada)
+
+
+pool = PoolConexoes()
+
+
+def conexao():
+    """Atalho: with conexao() as conn: ..."""
+    return pool.conexao()
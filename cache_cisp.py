@@ -0,0 +1,101 @@
+"""
+CACHE EM MEMÓRIA DOS PAYLOADS DA CISP (avaliacao-analitica)
+
+Chave: raiz. Cada entrada guarda o payload já decodificado, o tamanho em bytes
+da resposta original e o instante em que foi obtida.
+
+- expira após CISP_CACHE_TTL segundos (ou antes, se a chamada pedir max_age menor)
+- LRU por quantidade de entradas (CISP_CACHE_MAX_ENTRADAS)
+  e por total de bytes (CISP_CACHE_MAX_BYTES)
+- contadores de hit/miss/expiração/evicção para o /api/health
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+CACHE_TTL = float(os.environ.get('CISP_CACHE_TTL', '900'))
+CACHE_MAX_ENTRADAS = int(os.environ.get('CISP_CACHE_MAX_ENTRADAS', '2000'))
+CACHE_MAX_BYTES = int(os.environ.get('CISP_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+
+class CacheTTL:
+    def __init__(self, ttl=CACHE_TTL, max_entradas=CACHE_MAX_ENTRADAS, max_bytes=CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self._dados = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "expirados": 0, "evictions": 0}
+
+    def _remover(self, chave):
+        _, tamanho, _ = self._dados.pop(chave)
+        self._bytes -= tamanho
+
+    def obter(self, chave, max_age=None):
+        """Devolve o valor se existir e tiver no máximo min(ttl, max_age) segundos; senão None"""
+        limite = self.ttl if max_age is None else min(self.ttl, max_age)
+        with self._lock:
+            entrada = self._dados.get(chave)
+            if entrada is None:
+                self._stats["misses"] += 1
+                return None
+            valor, _, guardado_em = entrada
+            idade = time.monotonic() - guardado_em
+            if idade > self.ttl:
+                self._remover(chave)
+                self._stats["expirados"] += 1
+                self._stats["misses"] += 1
+                return None
+            if idade > limite:
+                self._stats["misses"] += 1
+                return None
+            self._dados.move_to_end(chave)
+            self._stats["hits"] += 1
+            return valor
+
+    def idade(self, chave):
+        """Idade (s) da entrada, sem contar como hit/miss; None se não houver"""
+        with self._lock:
+            entrada = self._dados.get(chave)
+            return None if entrada is None else time.monotonic() - entrada[2]
+
+    def guardar(self, chave, valor, tamanho, idade=0.0):
+        """idade: segundos que o valor já tem (ex.: veio do arquivo no Postgres)"""
+        if self.ttl <= 0 or tamanho > self.max_bytes or idade >= self.ttl:
+            return
+        with self._lock:
+            if chave in self._dados:
+                self._remover(chave)
+            self._dados[chave] = (valor, tamanho, time.monotonic() - idade)
+            self._bytes += tamanho
+            while self._dados and (len(self._dados) > self.max_entradas or self._bytes > self.max_bytes):
+                antiga = next(iter(self._dados))
+                self._remover(antiga)
+                self._stats["evictions"] += 1
+
+    def invalidar(self, chave=None):
+        with self._lock:
+            if chave is None:
+                self._dados.clear()
+                self._bytes = 0
+            elif chave in self._dados:
+                self._remover(chave)
+
+    def estatisticas(self):
+        with self._lock:
+            consultas = self._stats["hits"] + self._stats["misses"]
+            return {
+                "entradas": len(self._dados),
+                "bytes": self._bytes,
+                "max_entradas": self.max_entradas,
+                "max_bytes": self.max_bytes,
+                "ttl_s": self.ttl,
+                "hit_ratio": round(self._stats["hits"] / consultas, 4) if consultas else 0.0,
+                **self._stats,
+            }
+
+
+cache_payload = CacheTTL()
@@ -0,0 +1,332 @@
+"""
+CLIENTE HTTP COMPARTILHADO DA API CISP (avaliacao-analitica)
+
+Usado por app.py, APIFLASK.py e integração.py. Uma única requests.Session por
+processo mantém as conexões TLS abertas (keep-alive) em vez de refazer o
+handshake a cada raiz.
+
+- timeouts separados de conexão e leitura (CISP_TIMEOUT_CONEXAO / CISP_TIMEOUT_LEITURA)
+- respostas comprimidas (Accept-Encoding: gzip, deflate)
+- pool de conexões do tamanho de CISP_POOL_CONEXOES
+
+Resiliência:
+
+- erros transitórios (timeout, conexão, 429, 500/502/503/504) são repetidos até
+  CISP_RETRY_MAX vezes com backoff exponencial com jitter, respeitando Retry-After
+- circuit breaker: após CISP_CB_FALHAS falhas transitórias seguidas o circuito
+  abre e as chamadas falham na hora por CISP_CB_ABERTO_S segundos; depois disso
+  uma chamada de teste decide se fecha de novo
+- prazo total por chamada (CISP_DEADLINE_S): tentativas, esperas e o timeout
+  de leitura cabem nele; estourou, a chamada falha com CISPTimeout em vez de
+  segurar a thread da requisição. A carga em massa usa CISP_DEADLINE_LOTE_S
+- cada falha vira uma exceção própria (ErroCISP e subclasses), nunca None
+"""
+
+import os
+import time
+import random
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+import rastreio
+from logs import obter as obter_log
+from metricas import CISP_UPSTREAM, classe_status
+
+log = obter_log("cisp")
+
+API_BASE_URL = os.environ.get('CISP_API_BASE_URL', "https://servicos.cisp.com.br/v1/avaliacao-analitica/raiz")
+TIMEOUT_CONEXAO = float(os.environ.get('CISP_TIMEOUT_CONEXAO', '5'))
+TIMEOUT_LEITURA = float(os.environ.get('CISP_TIMEOUT_LEITURA', '10'))
+POOL_CONEXOES = int(os.environ.get('CISP_POOL_CONEXOES', '16'))
+
+RETRY_MAX = int(os.environ.get('CISP_RETRY_MAX', '3'))
+RETRY_BASE = float(os.environ.get('CISP_RETRY_BASE', '0.5'))
+RETRY_TETO = float(os.environ.get('CISP_RETRY_TETO', '8'))
+RETRY_AFTER_MAX = float(os.environ.get('CISP_RETRY_AFTER_MAX', '30'))
+CB_FALHAS = int(os.environ.get('CISP_CB_FALHAS', '5'))
+CB_ABERTO_S = float(os.environ.get('CISP_CB_ABERTO_S', '30'))
+# Prazo total de buscar_json (retries e esperas incluídos); 0 = sem prazo
+DEADLINE_S = float(os.environ.get('CISP_DEADLINE_S', '20'))
+DEADLINE_LOTE_S = float(os.environ.get('CISP_DEADLINE_LOTE_S', '300'))
+
+STATUS_TRANSITORIOS = {429, 500, 502, 503, 504}
+
+
+# =============================================================================
+# ERROS
+# =============================================================================
+
+class ErroCISP(Exception):
+    """Falha ao consultar a CISP. `tipo` é estável e vai para as respostas JSON."""
+    tipo = "erro"
+    transitorio = False
+
+    def __init__(self, mensagem, raiz=None, status_http=None, retry_after=None):
+        super().__init__(mensagem)
+        self.raiz = raiz
+        self.status_http = status_http
+        self.retry_after = retry_after
+
+
+class CISPNaoEncontrada(ErroCISP):
+    tipo = "nao_encontrada"
+
+
+class CISPAutenticacao(ErroCISP):
+    tipo = "autenticacao"
+
+
+class CISPRespostaInvalida(ErroCISP):
+    tipo = "resposta_invalida"
+
+
+class CISPLimiteRequisicoes(ErroCISP):
+    tipo = "limite_requisicoes"
+    transitorio = True
+
+
+class CISPIndisponivel(ErroCISP):
+    tipo = "indisponivel"
+    transitorio = True
+
+
+class CISPTimeout(ErroCISP):
+    tipo = "timeout"
+    transitorio = True
+
+
+class CISPCircuitoAberto(ErroCISP):
+    tipo = "circuito_aberto"
+
+
+# Status HTTP devolvido ao cliente (app.py, APIFLASK.py) para cada tipo de falha da CISP
+STATUS_POR_ERRO_CISP = {
+    "nao_encontrada": 404,
+    "limite_requisicoes": 429,
+    "timeout": 504,
+    "indisponivel": 502,
+    "circuito_aberto": 503,
+    "autenticacao": 502,
+    "resposta_invalida": 502,
+}
+
+
+def _retry_after(valor):
+    """Retry-After em segundos (aceita número ou data HTTP)"""
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        quando = parsedate_to_datetime(valor)
+        return max(0.0, (quando - datetime.now(timezone.utc)).total_seconds())
+    except Exception:
+        return None
+
+
+def erro_por_status(raiz, status, retry_after=None):
+    if status == 404:
+        return CISPNaoEncontrada(f"raiz {raiz} não encontrada na CISP", raiz, status)
+    if status in (401, 403):
+        return CISPAutenticacao(f"CISP recusou as credenciais (HTTP {status})", raiz, status)
+    if status == 429:
+        return CISPLimiteRequisicoes("limite de requisições da CISP atingido", raiz, status, _retry_after(retry_after))
+    if status in STATUS_TRANSITORIOS:
+        return CISPIndisponivel(f"CISP indisponível (HTTP {status})", raiz, status, _retry_after(retry_after))
+    return CISPRespostaInvalida(f"resposta inesperada da CISP (HTTP {status})", raiz, status)
+
+
+# =============================================================================
+# CIRCUIT BREAKER + CONTADORES
+# =============================================================================
+
+class Resiliencia:
+    FECHADO = "fechado"
+    ABERTO = "aberto"
+    MEIO_ABERTO = "meio_aberto"
+
+    def __init__(self, retry_max=RETRY_MAX, base=RETRY_BASE, teto=RETRY_TETO,
+                 retry_after_max=RETRY_AFTER_MAX, limite_falhas=CB_FALHAS, aberto_s=CB_ABERTO_S):
+        self.retry_max = max(0, retry_max)
+        self.base = base
+        self.teto = teto
+        self.retry_after_max = retry_after_max
+        self.limite_falhas = max(1, limite_falhas)
+        self.aberto_s = aberto_s
+        self._estado = self.FECHADO
+        self._falhas_seguidas = 0
+        self._aberto_ate = 0.0
+        self._teste_em_andamento = False
+        self._lock = threading.Lock()
+        self._stats = {"chamadas": 0, "sucessos": 0, "retries": 0, "rejeitadas_circuito": 0, "aberturas": 0, "erros": {}}
+
+    def antes(self, raiz=None):
+        """Levanta CISPCircuitoAberto se o circuito não deixa a chamada passar"""
+        with self._lock:
+            self._stats["chamadas"] += 1
+            if self._estado == self.ABERTO:
+                if time.monotonic() < self._aberto_ate:
+                    self._stats["rejeitadas_circuito"] += 1
+                    restante = self._aberto_ate - time.monotonic()
+                    raise CISPCircuitoAberto("CISP instável: circuito aberto", raiz, retry_after=restante)
+                self._estado = self.MEIO_ABERTO
+                self._teste_em_andamento = False
+            if self._estado == self.MEIO_ABERTO:
+                if self._teste_em_andamento:
+                    self._stats["rejeitadas_circuito"] += 1
+                    raise CISPCircuitoAberto("CISP instável: aguardando chamada de teste", raiz, retry_after=1.0)
+                self._teste_em_andamento = True
+
+    def sucesso(self):
+        with self._lock:
+            self._stats["sucessos"] += 1
+            self._falhas_seguidas = 0
+            self._estado = self.FECHADO
+            self._teste_em_andamento = False
+
+    def falha(self, erro):
+        with self._lock:
+            self._stats["erros"][erro.tipo] = self._stats["erros"].get(erro.tipo, 0) + 1
+            if not erro.transitorio:
+                # 404/401/resposta inválida: a CISP respondeu, não indica instabilidade
+                if self._estado == self.MEIO_ABERTO:
+                    self._estado = self.FECHADO
+                    self._teste_em_andamento = False
+                self._falhas_seguidas = 0
+                return
+            self._falhas_seguidas += 1
+            if self._estado == self.MEIO_ABERTO or self._falhas_seguidas >= self.limite_falhas:
+                if self._estado != self.ABERTO:
+                    self._stats["aberturas"] += 1
+                self._estado = self.ABERTO
+                self._aberto_ate = time.monotonic() + self.aberto_s
+                self._teste_em_andamento = False
+
+    def espera(self, tentativa, erro):
+        """Segundos até a próxima tentativa, ou None se não deve repetir"""
+        if not erro.transitorio or tentativa >= self.retry_max:
+            return None
+        with self._lock:
+            if self._estado == self.ABERTO:
+                return None
+            self._stats["retries"] += 1
+        if erro.retry_after is not None:
+            if erro.retry_after > self.retry_after_max:
+                return None
+            return erro.retry_after
+        # full jitter: uniforme entre 0 e min(teto, base * 2^tentativa)
+        return random.uniform(0, min(self.teto, self.base * (2 ** tentativa)))
+
+    def estatisticas(self):
+        with self._lock:
+            estado = self._estado
+            if estado == self.ABERTO and time.monotonic() >= self._aberto_ate:
+                estado = self.MEIO_ABERTO
+            return {
+                "circuito": estado,
+                "falhas_seguidas": self._falhas_seguidas,
+                "aberto_por_s": round(max(0.0, self._aberto_ate - time.monotonic()), 1) if estado == self.ABERTO else 0.0,
+                **{k: (dict(v) if isinstance(v, dict) else v) for k, v in self._stats.items()},
+            }
+
+
+class ClienteCISP:
+    def __init__(self, base_url=API_BASE_URL, usuario=None, senha=None,
+                 timeout_conexao=TIMEOUT_CONEXAO, timeout_leitura=TIMEOUT_LEITURA,
+                 pool_conexoes=POOL_CONEXOES):
+        self.base_url = base_url.rstrip("/")
+        self.usuario = usuario if usuario is not None else os.environ.get('CISP_USERNAME')
+        self.senha = senha if senha is not None else os.environ.get('CISP_PASSWORD')
+        self.timeout = (timeout_conexao, timeout_leitura)
+        self.pool_conexoes = pool_conexoes
+        self.resiliencia = Resiliencia()
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    s = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_conexoes)
+                    s.mount("https://", adapter)
+                    s.mount("http://", adapter)
+                    s.auth = HTTPBasicAuth(self.usuario, self.senha)
+                    s.headers.update({"Accept": "application/json", "Accept-Encoding": "gzip, deflate"})
+                    self._session = s
+        return self._session
+
+    def url(self, raiz):
+        return f"{self.base_url}/{raiz}"
+
+    @staticmethod
+    def _medir_tentativa(inicio, classe):
+        """Métrica + span de uma chamada HTTP (retries aparecem como cisp.http "<classe> <n>x")"""
+        duracao = time.perf_counter() - inicio
+        CISP_UPSTREAM.observar(duracao, classe=classe)
+        rastreio.registrar("cisp.http", duracao, classe)
+
+    def _uma_tentativa(self, raiz, timeout):
+        inicio = time.perf_counter()
+        try:
+            response = self.session.get(self.url(raiz), timeout=timeout or self.timeout)
+        except requests.Timeout as e:
+            self._medir_tentativa(inicio, "timeout")
+            raise CISPTimeout(f"timeout ao consultar a CISP: {e}", raiz) from e
+        except requests.RequestException as e:
+            self._medir_tentativa(inicio, "conexao")
+            raise CISPIndisponivel(f"falha de conexão com a CISP: {e}", raiz) from e
+        self._medir_tentativa(inicio, classe_status(response.status_code))
+        if response.status_code != 200:
+            raise erro_por_status(raiz, response.status_code, response.headers.get("Retry-After"))
+        try:
+            with rastreio.span("cisp.json"):
+                return response.json(), len(response.content)
+        except ValueError as e:
+            raise CISPRespostaInvalida("CISP devolveu um corpo que não é JSON", raiz, 200) from e
+
+    def buscar_json(self, raiz, timeout=None, prazo=None):
+        """
+        (payload, bytes_da_resposta). Falhas levantam ErroCISP (ver subclasses).
+        prazo: segundos para a chamada inteira (padrão CISP_DEADLINE_S; 0 = sem prazo).
+        """
+        prazo = DEADLINE_S if prazo is None else prazo
+        limite = time.monotonic() + prazo if prazo > 0 else None
+        conexao, leitura = timeout or self.timeout
+        tentativa = 0
+        while True:
+            if limite is not None:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    raise CISPTimeout(f"prazo de {prazo:g}s para consultar a CISP esgotado", raiz)
+                timeout = (min(conexao, restante), min(leitura, restante))
+            self.resiliencia.antes(raiz)
+            try:
+                resultado = self._uma_tentativa(raiz, timeout)
+            except ErroCISP as e:
+                self.resiliencia.falha(e)
+                espera = self.resiliencia.espera(tentativa, e)
+                if espera is None:
+                    raise
+                if limite is not None and time.monotonic() + espera >= limite:
+                    # a espera sozinha já estoura o prazo: falha agora
+                    raise
+                time.sleep(espera)
+                tentativa += 1
+                continue
+            self.resiliencia.sucesso()
+            return resultado
+
+    def estatisticas(self):
+        return self.resiliencia.estatisticas()
+
+
+cliente_cisp = ClienteCISP()
@@ -0,0 +1,160 @@
+"""
+RATINGS, POSITIVAS POR SEGMENTO E MÉTRICAS DERIVADAS NO BANCO
+
+Seções do payload da CISP que antes só existiam na resposta ao vivo
+(complementar_documento no app.py) passam a ser gravadas na sincronização:
+
+- cisp_ratings             histórico de ratings (uma linha por data)
+- cisp_positivas           positivaSegmentos achatado: uma linha por associada
+                           de cada segmento (segmento sem positivas = uma linha
+                           com posicao NULL, para o segmento não sumir)
+- cisp_metricas_derivadas  uma linha por raiz com o que é calculado a partir do
+                           payload: maior acúmulo, última compra, rating atual e
+                           débito atual (informações comportamentais)
+
+As métricas são calculadas UMA vez, na gravação (derivar), e a leitura do
+documento (leitura.py) devolve tudo numa consulta: com estas tabelas, o
+documento lido só do banco é igual ao montado com o payload ao vivo.
+"""
+
+from datetime import datetime
+
+TABELA_RATINGS = "cisp_ratings"
+TABELA_POSITIVAS = "cisp_positivas"
+TABELA_DERIVADAS = "cisp_metricas_derivadas"
+TABELAS = (TABELA_RATINGS, TABELA_POSITIVAS, TABELA_DERIVADAS)
+
+SQL_CRIAR_TABELAS = [
+    f"""
+    CREATE TABLE IF NOT EXISTS {TABELA_RATINGS} (
+        raiz text NOT NULL,
+        data date,
+        classificacao text,
+        descricao_classificacao text
+    )
+    """,
+    f"CREATE INDEX IF NOT EXISTS {TABELA_RATINGS}_raiz_idx ON {TABELA_RATINGS} (raiz, data DESC)",
+    f"""
+    CREATE TABLE IF NOT EXISTS {TABELA_POSITIVAS} (
+        raiz text NOT NULL,
+        segmento text,
+        ordem_segmento smallint NOT NULL,
+        total_associadas_segmento integer,
+        valor_total_debito_segmento numeric,
+        posicao smallint,
+        codigo_associada integer,
+        razao_social text,
+        data_ultima_compra date,
+        data_maior_acumulo date,
+        valor_maior_acumulo numeric,
+        valor_debito_atual numeric,
+        valor_limite_credito numeric
+    )
+    """,
+    f"CREATE INDEX IF NOT EXISTS {TABELA_POSITIVAS}_raiz_idx ON {TABELA_POSITIVAS} (raiz)",
+    f"""
+    CREATE TABLE IF NOT EXISTS {TABELA_DERIVADAS} (
+        raiz text PRIMARY KEY,
+        rating_atual text,
+        descricao_rating text,
+        data_maior_acumulo date,
+        valor_maior_acumulo numeric,
+        data_ultima_compra date,
+        codigo_associada_ultima_compra integer,
+        total_debito_atual numeric,
+        calculado_em timestamp NOT NULL DEFAULT now()
+    )
+    """,
+]
+
+
+def garantir_tabela(cursor):
+    """Cria as tabelas que faltarem; se todas existem, não pede lock nenhum"""
+    cursor.execute("SELECT " + ", ".join(f"to_regclass('{t}') IS NOT NULL" for t in TABELAS))
+    row = cursor.fetchone()
+    if all(row.values() if isinstance(row, dict) else row):
+        return
+    for sql in SQL_CRIAR_TABELAS:
+        cursor.execute(sql)
+
+
+def _data(valor):
+    if not valor:
+        return None
+    try:
+        return datetime.strptime(str(valor)[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+def _numero(valor):
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return None
+
+
+def linhas_positivas(dados):
+    """positivaSegmentos -> itens planos (um por associada; segmento vazio vira um item sem associada)"""
+    itens = []
+    for i, seg in enumerate(dados.get('positivaSegmentos') or []):
+        base = {
+            "segmento": seg.get('descricaoSegmento'),
+            "ordem_segmento": i,
+            "total_associadas_segmento": seg.get('totalAssociadasSegmento'),
+            "valor_total_debito_segmento": seg.get('valorTotalDebitoSegmento'),
+        }
+        positivas = seg.get('positivas') or []
+        if not positivas:
+            itens.append({**base, "posicao": None})
+        for j, pos in enumerate(positivas):
+            itens.append({
+                **base,
+                "posicao": j,
+                "codigo_associada": pos.get('codigoAssociada'),
+                "razao_social": pos.get('razaoSocial'),
+                "data_ultima_compra": pos.get('dataUltimaCompra'),
+                "data_maior_acumulo": pos.get('dataMaiorAcumulo'),
+                "valor_maior_acumulo": pos.get('valorMaiorAcumulo'),
+                "valor_debito_atual": pos.get('valorDebitoAtual'),
+                "valor_limite_credito": pos.get('valorLimiteCredito'),
+            })
+    return itens
+
+
+def derivar(dados):
+    """
+    Métricas calculadas a partir do payload (uma passada por positivaSegmentos):
+    maior acúmulo (valor e data), última compra (data e associada), rating
+    atual e débito atual (total das informações comportamentais, se houver)
+    """
+    maior_valor = maior_data = None
+    ultima_data = ultima_codigo = None
+    for seg in dados.get('positivaSegmentos') or []:
+        for pos in seg.get('positivas') or []:
+            v = _numero(pos.get('valorMaiorAcumulo'))
+            d_maior = _data(pos.get('dataMaiorAcumulo'))
+            if v is not None and d_maior and (maior_valor is None or v > maior_valor):
+                maior_valor, maior_data = v, d_maior
+            d_ult = _data(pos.get('dataUltimaCompra'))
+            if d_ult and (ultima_data is None or d_ult > ultima_data):
+                ultima_data = d_ult
+                ultima_codigo = pos.get('codigoAssociada')
+
+    ratings = dados.get('ratings') or []
+    rating = ratings[0] if ratings else {}
+    debito = (dados.get('informacaoSuporte') or {}).get('valorTotalDebitoAtual')
+    comportamentais = dados.get('informacoesComportamentaisSegmentos')
+    if isinstance(comportamentais, list) and comportamentais and isinstance(comportamentais[0], dict) \
+            and comportamentais[0].get('total') is not None:
+        debito = comportamentais[0]['total']
+
+    return {
+        "rating_atual": rating.get('classificacao'),
+        "descricao_rating": rating.get('descricaoClassificacao'),
+        "data_maior_acumulo": maior_data,
+        "valor_maior_acumulo": maior_valor,
+        "data_ultima_compra": ultima_data,
+        "codigo_associada_ultima_compra": ultima_codigo,
+        "total_debito_atual": debito,
+    }
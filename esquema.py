@@ -0,0 +1,283 @@
+"""
+MAPEAMENTO DE ESQUEMA DAS TABELAS cisp_*
+
+As tabelas do data lake variam de nome de coluna entre ambientes (raiz vs
+raiz_cnpj, total_debito_atual vs valor_total_debito_atual, ...). Em vez de
+procurar a coluna certa a cada linha gravada, este módulo:
+
+1. lê o catálogo (colunas, tipos, índices únicos) UMA vez (na inicialização ou em
+   POST /api/esquema/recarregar) para todas as tabelas cisp_*
+2. resolve cada spec registrado (colunas candidatas + extrator) contra as
+   colunas reais e gera um MapeadorTabela imutável com o SQL já pronto
+3. prepara (PREPARE) os statements de upsert/delete em cada conexão na
+   primeira vez que ela grava, para o servidor não replanejar a cada raiz
+
+O snapshot é trocado atomicamente; quem já pegou o anterior termina com ele.
+"""
+
+import os
+import threading
+import weakref
+from dataclasses import dataclass
+from datetime import datetime
+
+import mesclagem
+
+OPCOES_RAIZ = ("raiz", "raizcnpj", "raiz_cnpj", "raizCnpj")
+
+# Desligue (0) atrás de pgbouncer em modo transaction, que não mantém PREPARE entre transações
+USAR_PREPARED = os.environ.get('DB_PREPARED_STATEMENTS', '1') not in ('0', 'false', 'False')
+
+
+@dataclass(frozen=True)
+class MapeadorTabela:
+    tabela: str
+    colunas: tuple          # colunas gravadas, na mesma ordem de `extratores`
+    extratores: tuple       # fn(raiz, item) -> valor
+    col_raiz: str
+    conflito: str           # coluna do ON CONFLICT (None = sem upsert)
+    sql_insert_lote: str    # "INSERT ... VALUES %s" para execute_values
+    sql_upsert: str         # uma linha, placeholders %s (sem prepared)
+    sql_delete: str         # DELETE da raiz, placeholder %s (sem prepared)
+    nome_upsert: str
+    nome_delete: str
+    sql_prepare_upsert: str
+    sql_prepare_delete: str
+    sql_execute_upsert: str
+    sql_execute_delete: str
+    chave: tuple            # chave natural (fora a raiz); vazia = sem merge
+    indices_chave: tuple    # posição de cada coluna da chave em `colunas`
+    sql_merge: str          # diff-and-merge por chave natural (mesclagem.py)
+
+    def linha(self, raiz, item):
+        return tuple(fn(raiz, item) for fn in self.extratores)
+
+
+def _escolher(colunas, opcoes):
+    for c in opcoes:
+        if c in colunas:
+            return c
+    return None
+
+
+def _compilar(versao, tabela, spec, chave_spec, colunas, unicos, tipos):
+    mapa = {}
+    for opcoes, extrator in spec:
+        col = _escolher(colunas, opcoes)
+        if col is not None:
+            mapa[col] = extrator
+    cols = tuple(mapa)
+    col_raiz = _escolher(colunas, OPCOES_RAIZ)
+    conflito = col_raiz if col_raiz and (col_raiz,) in unicos else None
+
+    nomes = ", ".join(cols)
+    fmt = ", ".join(["%s"] * len(cols))
+    numerados = ", ".join(f"${i}" for i in range(1, len(cols) + 1))
+    if conflito:
+        sets = [f"{c} = EXCLUDED.{c}" for c in cols if c != conflito]
+        acao = f"DO UPDATE SET {', '.join(sets)}" if sets else "DO NOTHING"
+        sufixo = f" ON CONFLICT ({conflito}) {acao}"
+    else:
+        sufixo = ""
+
+    chave = tuple(_escolher(colunas, opcoes) for opcoes in chave_spec)
+    if not chave or None in chave or col_raiz not in cols or not set(chave) <= set(cols):
+        chave = ()
+    sql_merge = mesclagem.compilar(tabela, cols, chave, col_raiz, tipos) if chave else None
+
+    nome_upsert = f"cisp_v{versao}_ups_{tabela}"[:63]
+    nome_delete = f"cisp_v{versao}_del_{tabela}"[:63]
+    return MapeadorTabela(
+        tabela=tabela,
+        colunas=cols,
+        extratores=tuple(mapa.values()),
+        col_raiz=col_raiz,
+        conflito=conflito,
+        sql_insert_lote=f"INSERT INTO {tabela} ({nomes}) VALUES %s" if cols else None,
+        sql_upsert=f"INSERT INTO {tabela} ({nomes}) VALUES ({fmt}){sufixo}" if cols else None,
+        sql_delete=f"DELETE FROM {tabela} WHERE {col_raiz} = %s" if col_raiz else None,
+        nome_upsert=nome_upsert,
+        nome_delete=nome_delete,
+        sql_prepare_upsert=f"PREPARE {nome_upsert} AS INSERT INTO {tabela} ({nomes}) VALUES ({numerados}){sufixo}" if cols else None,
+        sql_prepare_delete=f"PREPARE {nome_delete} AS DELETE FROM {tabela} WHERE {col_raiz} = $1" if col_raiz else None,
+        sql_execute_upsert=f"EXECUTE {nome_upsert} ({fmt})" if cols else None,
+        sql_execute_delete=f"EXECUTE {nome_delete} (%s)" if col_raiz else None,
+        chave=chave,
+        indices_chave=tuple(cols.index(c) for c in chave),
+        sql_merge=sql_merge,
+    )
+
+
+class Esquema:
+    """Snapshot imutável: colunas, índices únicos e mapeadores de cada tabela cisp_*"""
+
+    def __init__(self, versao, colunas, unicos, mapeadores, tipos=None):
+        self.versao = versao
+        self.colunas = colunas          # {tabela: (col, ...)} na ordem do banco
+        self.tipos = tipos or {}        # {tabela: {col: tipo SQL}}
+        self.unicos = unicos            # {tabela: {(col, ...), ...}}
+        self.mapeadores = mapeadores    # {tabela: MapeadorTabela}
+        self.carregado_em = datetime.now()
+
+    def colunas_de(self, tabela):
+        return self.colunas.get(tabela, ())
+
+    def tipos_de(self, tabela):
+        return self.tipos.get(tabela, {})
+
+    def existe(self, tabela):
+        return tabela in self.colunas
+
+    def resumo(self):
+        return {
+            "versao": self.versao,
+            "carregado_em": self.carregado_em.isoformat(),
+            "prepared_statements": USAR_PREPARED,
+            "tabelas": {
+                t: {
+                    "colunas": len(self.colunas[t]),
+                    "mapeadas": list(self.mapeadores[t].colunas) if t in self.mapeadores else None,
+                    "coluna_raiz": self.mapeadores[t].col_raiz if t in self.mapeadores else None,
+                    "on_conflict": self.mapeadores[t].conflito if t in self.mapeadores else None,
+                    "chave_natural": list(self.mapeadores[t].chave) if t in self.mapeadores else None,
+                }
+                for t in sorted(self.colunas)
+            },
+        }
+
+
+class RegistroEsquema:
+    def __init__(self):
+        self._specs = {}
+        self._atual = None
+        self._versao = 0
+        self._lock = threading.Lock()
+        self._preparados = weakref.WeakKeyDictionary()   # conexão -> versão já preparada
+
+    def registrar(self, tabela, spec, chave=()):
+        """
+        spec: [(colunas candidatas, extrator(raiz, item)), ...]
+        chave: [colunas candidatas, ...] da chave natural das linhas de uma raiz (habilita o merge)
+        """
+        with self._lock:
+            self._specs[tabela] = (tuple(spec), tuple(chave))
+            self._atual = None
+
+    def carregar(self, cursor):
+        """Lê o catálogo e compila um novo snapshot (também usado para recarregar)"""
+        cursor.execute(r"""
+            SELECT c.relname, a.attname::text, format_type(a.atttypid, a.atttypmod)
+            FROM pg_attribute a
+            JOIN pg_class c ON c.oid = a.attrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = current_schema()
+              AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+              AND NOT c.relispartition
+              AND c.relname LIKE 'cisp\_%'
+              AND a.attnum > 0 AND NOT a.attisdropped
+            ORDER BY c.relname, a.attnum
+        """)
+        colunas = {}
+        tipos = {}
+        for row in cursor.fetchall():
+            tabela, coluna, tipo = row.values() if isinstance(row, dict) else row
+            colunas.setdefault(tabela, []).append(coluna)
+            tipos.setdefault(tabela, {})[coluna] = tipo
+        cursor.execute(r"""
+            SELECT c.relname, array_agg(a.attname::text ORDER BY k.ord)
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, ord)
+            JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = k.attnum
+            WHERE n.nspname = current_schema()
+              AND c.relname LIKE 'cisp\_%'
+              AND NOT c.relispartition
+              AND i.indisunique AND i.indpred IS NULL
+              AND k.ord <= i.indnkeyatts
+            GROUP BY i.indexrelid, c.relname
+        """)
+        unicos = {}
+        for row in cursor.fetchall():
+            tabela, cols = (row["relname"], row["array_agg"]) if isinstance(row, dict) else row
+            unicos.setdefault(tabela, set()).add(tuple(cols))
+
+        with self._lock:
+            self._versao += 1
+            versao = self._versao
+            specs = dict(self._specs)
+        colunas = {t: tuple(c) for t, c in colunas.items()}
+        mapeadores = {
+            t: _compilar(versao, t, spec, chave, colunas[t], unicos.get(t, set()), tipos[t])
+            for t, (spec, chave) in specs.items() if t in colunas
+        }
+        novo = Esquema(versao, colunas, unicos, mapeadores, tipos)
+        with self._lock:
+            self._atual = novo
+        return novo
+
+    def atual(self, cursor=None):
+        """Snapshot corrente; carrega com o cursor dado se ainda não houver"""
+        snap = self._atual
+        if snap is None:
+            if cursor is None:
+                raise RuntimeError("esquema ainda não carregado")
+            snap = self.carregar(cursor)
+        return snap
+
+    @property
+    def versao(self):
+        snap = self._atual
+        return snap.versao if snap else None
+
+    def invalidar(self):
+        with self._lock:
+            self._atual = None
+
+    # ------------------------------------------------------------------
+    def _garantir_preparados(self, cursor, snap):
+        """
+        PREPARE não é desfeito com a transação: até o último dar certo a conexão
+        fica marcada (None) para o DEALLOCATE ALL da próxima vez, e uma falha volta
+        ao savepoint para não deixar abortada a transação de quem chamou
+        """
+        conn = cursor.connection
+        if self._preparados.get(conn) == snap.versao:
+            return
+        sujo = conn in self._preparados
+        self._preparados[conn] = None
+        cursor.execute("SAVEPOINT cisp_prepare")
+        try:
+            if sujo:
+                cursor.execute("DEALLOCATE ALL")
+            for m in snap.mapeadores.values():
+                if m.sql_prepare_upsert:
+                    cursor.execute(m.sql_prepare_upsert)
+                if m.sql_prepare_delete:
+                    cursor.execute(m.sql_prepare_delete)
+        except Exception:
+            cursor.execute("ROLLBACK TO SAVEPOINT cisp_prepare")
+            raise
+        cursor.execute("RELEASE SAVEPOINT cisp_prepare")
+        self._preparados[conn] = snap.versao
+
+    def upsert(self, cursor, snap, mapeador, valores):
+        if USAR_PREPARED:
+            self._garantir_preparados(cursor, snap)
+            cursor.execute(mapeador.sql_execute_upsert, valores)
+        else:
+            cursor.execute(mapeador.sql_upsert, valores)
+
+    def apagar_raiz(self, cursor, snap, mapeador, raiz):
+        """DELETE das linhas da raiz; devolve quantas foram apagadas"""
+        if mapeador.col_raiz is None:
+            return 0
+        if USAR_PREPARED:
+            self._garantir_preparados(cursor, snap)
+            cursor.execute(mapeador.sql_execute_delete, (raiz,))
+        else:
+            cursor.execute(mapeador.sql_delete, (raiz,))
+        return cursor.rowcount
+
+
+esquema = RegistroEsquema()
@@ -0,0 +1,360 @@
+"""
+EXPORTAÇÃO EM MASSA (Power BI / cargas)
+
+GET/POST /api/exportar devolve uma tabela cisp_* inteira, ou filtrada, em
+NDJSON, CSV ou Parquet, com Transfer-Encoding chunked:
+
+- lê com cursor nomeado (server-side): o Postgres entrega EXPORT_TAMANHO_LOTE
+  linhas por vez e cada lote é escrito na resposta antes do próximo
+- memória constante, independente do número de linhas
+- filtros: raizes, uf, rating, desde/ate (data_atualizacao); nas tabelas
+  filhas uf/rating/datas filtram pelas raízes da tabela principal
+- Parquet exige pyarrow (opcional): um row group por lote
+
+No máximo EXPORT_MAX_SIMULTANEAS exportações por processo, para não prender
+o pool de conexões da API.
+"""
+
+import os
+import io
+import csv
+import uuid
+import threading
+from datetime import datetime, date, time as dtime
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet fica indisponível; NDJSON/CSV seguem funcionando
+    pa = None
+    pq = None
+
+from esquema import OPCOES_RAIZ
+from lote import normalizar_raiz
+from frescor import COLUNAS_ATUALIZACAO
+from leitura import TABELA_PRINCIPAL, LISTAS, CONTAGENS
+
+EXPORT_TAMANHO_LOTE = int(os.environ.get('EXPORT_TAMANHO_LOTE', '2000'))
+EXPORT_MAX_SIMULTANEAS = int(os.environ.get('EXPORT_MAX_SIMULTANEAS', '2'))
+
+FORMATOS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+TABELAS_EXPORTAVEIS = [TABELA_PRINCIPAL] + [t for _, t, _ in LISTAS] + [t for _, t in CONTAGENS]
+
+OPCOES_RATING = ("rating_atual", "classificacao_atual_cisp", "classificacao_cisp_atual", "classificacao")
+
+_vagas = threading.BoundedSemaphore(max(1, EXPORT_MAX_SIMULTANEAS))
+
+
+class ExportacaoOcupada(Exception):
+    pass
+
+
+def _lista(valor):
+    """"a,b" | ["a", "b"] -> ["a", "b"] (vazios descartados)"""
+    if valor is None:
+        return []
+    if isinstance(valor, str):
+        valor = valor.split(",")
+    return [str(v).strip() for v in valor if str(v).strip()]
+
+
+def _momento(valor, nome):
+    if not valor:
+        return None
+    try:
+        return datetime.fromisoformat(str(valor))
+    except ValueError:
+        raise ValueError(f"{nome} inválido (use AAAA-MM-DD ou AAAA-MM-DDTHH:MM:SS)")
+
+
+def filtros_de(params):
+    """Normaliza os filtros vindos da query string e/ou do corpo JSON"""
+    raizes = []
+    for r in _lista(params.get("raizes") or params.get("raiz")):
+        n = normalizar_raiz(r)
+        if n is None:
+            raise ValueError(f"raiz inválida: {r}")
+        raizes.append(n)
+    return {
+        "raizes": raizes,
+        "uf": [u.upper() for u in _lista(params.get("uf"))],
+        "rating": _lista(params.get("rating")),
+        "desde": _momento(params.get("desde"), "desde"),
+        "ate": _momento(params.get("ate"), "ate"),
+    }
+
+
+def _escolher(colunas, opcoes):
+    for c in opcoes:
+        if c in colunas:
+            return c
+    return None
+
+
+def montar_consulta(snap, tabela, filtros):
+    """(colunas, sql, parâmetros) para a tabela e filtros pedidos"""
+    if tabela not in TABELAS_EXPORTAVEIS:
+        raise ValueError(f"tabela não exportável: {tabela}")
+    if not snap.existe(tabela):
+        raise ValueError(f"tabela inexistente: {tabela}")
+    colunas = snap.colunas_de(tabela)
+    raiz_t = _escolher(colunas, OPCOES_RAIZ)
+
+    cols_p = snap.colunas_de(TABELA_PRINCIPAL)
+    raiz_p = _escolher(cols_p, OPCOES_RAIZ)
+    cond_p = []   # condições sobre a tabela principal, com o alias em {a}
+    params = {}
+    if filtros["uf"]:
+        if "uf" not in cols_p:
+            raise ValueError("filtro uf indisponível: coluna uf ausente")
+        cond_p.append("{a}.uf = ANY(%(uf)s)")
+        params["uf"] = filtros["uf"]
+    if filtros["rating"]:
+        col = _escolher(cols_p, OPCOES_RATING)
+        if col is None:
+            raise ValueError("filtro rating indisponível: coluna de rating ausente")
+        cond_p.append(f"{{a}}.{col} = ANY(%(rating)s)")
+        params["rating"] = filtros["rating"]
+    if filtros["desde"] or filtros["ate"]:
+        col = _escolher(cols_p, COLUNAS_ATUALIZACAO)
+        if col is None:
+            raise ValueError("filtro de data indisponível: coluna data_atualizacao ausente")
+        if filtros["desde"]:
+            cond_p.append(f"{{a}}.{col} >= %(desde)s")
+            params["desde"] = filtros["desde"]
+        if filtros["ate"]:
+            cond_p.append(f"{{a}}.{col} <= %(ate)s")
+            params["ate"] = filtros["ate"]
+
+    cond = []
+    if filtros["raizes"]:
+        if raiz_t is None:
+            raise ValueError(f"filtro raizes indisponível em {tabela}")
+        cond.append(f"t.{raiz_t} = ANY(%(raizes)s)")
+        params["raizes"] = filtros["raizes"]
+    if cond_p:
+        if tabela == TABELA_PRINCIPAL:
+            cond.extend(c.format(a="t") for c in cond_p)
+        else:
+            if raiz_t is None or raiz_p is None:
+                raise ValueError(f"filtros uf/rating/data indisponíveis em {tabela}")
+            cond.append(
+                f"t.{raiz_t} IN (SELECT p.{raiz_p} FROM {TABELA_PRINCIPAL} p WHERE {' AND '.join(c.format(a='p') for c in cond_p)})"
+            )
+
+    where = f" WHERE {' AND '.join(cond)}" if cond else ""
+    ordem = f" ORDER BY t.{raiz_t}" if raiz_t else ""
+    sql = f"SELECT {', '.join('t.' + c for c in colunas)} FROM {tabela} t{where}{ordem}"
+    return list(colunas), sql, params
+
+
+# ----------------------------------------------------------------------
+# Escritores: cada um recebe lotes de linhas e devolve bytes para a resposta
+
+def _texto(v):
+    if v is None:
+        return ""
+    if isinstance(v, (datetime, date, dtime)):
+        return v.isoformat()
+    return str(v)
+
+
+class _EscritorCSV:
+    consulta_json = False
+
+    def __init__(self, colunas):
+        self.colunas = colunas
+
+    def inicio(self):
+        return self._linhas([self.colunas])
+
+    def lote(self, linhas, descricao):
+        return self._linhas([[_texto(v) for v in linha] for linha in linhas])
+
+    def fim(self):
+        return b""
+
+    def _linhas(self, linhas):
+        buf = io.StringIO()
+        csv.writer(buf, lineterminator="\n").writerows(linhas)
+        return buf.getvalue().encode("utf-8")
+
+
+class _EscritorNDJSON:
+    # o próprio Postgres serializa cada linha (row_to_json); aqui só se junta o texto
+    consulta_json = True
+
+    def __init__(self, colunas):
+        pass
+
+    def inicio(self):
+        return b""
+
+    def lote(self, linhas, descricao):
+        return ("\n".join(l[0] for l in linhas) + "\n").encode("utf-8")
+
+    def fim(self):
+        return b""
+
+
+class _Coletor(io.RawIOBase):
+    """Arquivo só de escrita que acumula bytes até serem drenados para a resposta"""
+
+    def __init__(self):
+        self._partes = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._partes.append(bytes(b))
+        return len(b)
+
+    def drenar(self):
+        dados = b"".join(self._partes)
+        self._partes = []
+        return dados
+
+
+# OID do tipo no Postgres -> tipo Arrow (o resto vira string)
+_TIPOS_ARROW = {
+    16: "bool_", 20: "int64", 21: "int64", 23: "int64",
+    700: "float64", 701: "float64", 1700: "float64",
+    1082: "date32", 1114: "timestamp", 1184: "timestamptz",
+}
+
+
+class _EscritorParquet:
+    consulta_json = False
+
+    def __init__(self, colunas):
+        if pa is None:
+            raise ValueError("formato parquet indisponível: instale pyarrow")
+        self.colunas = colunas
+        self._coletor = _Coletor()
+        self._writer = None
+        self._schema = None
+
+    def _montar_schema(self, descricao):
+        campos = []
+        for col in descricao:
+            nome = _TIPOS_ARROW.get(col.type_code)
+            if nome == "timestamp":
+                tipo = pa.timestamp("us")
+            elif nome == "timestamptz":
+                tipo = pa.timestamp("us", tz="UTC")
+            elif nome:
+                tipo = getattr(pa, nome)()
+            else:
+                tipo = pa.string()
+            campos.append(pa.field(col.name, tipo))
+        return pa.schema(campos)
+
+    def inicio(self):
+        return b""
+
+    def lote(self, linhas, descricao):
+        if self._writer is None:
+            self._schema = self._montar_schema(descricao)
+            self._writer = pq.ParquetWriter(self._coletor, self._schema, compression="snappy")
+        colunas = []
+        for i, campo in enumerate(self._schema):
+            valores = [linha[i] for linha in linhas]
+            if pa.types.is_string(campo.type):
+                valores = [None if v is None else _texto(v) for v in valores]
+            elif pa.types.is_floating(campo.type):
+                valores = [None if v is None else float(v) for v in valores]
+            colunas.append(pa.array(valores, type=campo.type))
+        self._writer.write_table(pa.Table.from_arrays(colunas, schema=self._schema))
+        return self._coletor.drenar()
+
+    def fim(self):
+        if self._writer is None:
+            # nenhuma linha: arquivo válido com as colunas como string
+            self._schema = pa.schema([pa.field(c, pa.string()) for c in self.colunas])
+            self._writer = pq.ParquetWriter(self._coletor, self._schema)
+        self._writer.close()
+        return self._coletor.drenar()
+
+
+ESCRITORES = {"ndjson": _EscritorNDJSON, "csv": _EscritorCSV, "parquet": _EscritorParquet}
+
+
+def preparar(snap, tabela, filtros, formato):
+    """Valida tudo antes de abrir a resposta: (escritor, sql, parâmetros)"""
+    if formato not in ESCRITORES:
+        raise ValueError(f"formato inválido: {formato} (use {', '.join(FORMATOS)})")
+    colunas, sql, params = montar_consulta(snap, tabela, filtros)
+    escritor = ESCRITORES[formato](colunas)
+    if escritor.consulta_json:
+        sql = f"SELECT row_to_json(x)::text FROM ({sql}) x"
+    return escritor, sql, params
+
+
+class Exportacao:
+    """
+    Iterável dos bytes da resposta. Reserva uma vaga ao ser criado e segura
+    uma conexão do pool enquanto é lido; close() (chamado pelo servidor ao
+    fim da resposta ou na desconexão do cliente) libera as duas.
+    """
+
+    def __init__(self, pool, escritor, sql, params):
+        if not _vagas.acquire(blocking=False):
+            raise ExportacaoOcupada(f"limite de {EXPORT_MAX_SIMULTANEAS} exportações simultâneas atingido")
+        self._liberada = False
+        self._gen = self._gerar(pool, escritor, sql, params)
+
+    def __iter__(self):
+        return self._gen
+
+    def close(self):
+        try:
+            self._gen.close()
+        finally:
+            self._liberar()
+
+    def _liberar(self):
+        if not self._liberada:
+            self._liberada = True
+            _vagas.release()
+
+    def _gerar(self, pool, escritor, sql, params):
+        conn = None
+        descartar = False
+        try:
+            conn = pool.emprestar()
+            with conn.cursor() as c:
+                c.execute("SET TRANSACTION READ ONLY")
+            cursor = conn.cursor(name=f"exportar_{uuid.uuid4().hex[:12]}")
+            try:
+                cursor.execute(sql, params)
+                yield escritor.inicio()
+                while True:
+                    linhas = cursor.fetchmany(EXPORT_TAMANHO_LOTE)
+                    if not linhas:
+                        break
+                    yield escritor.lote(linhas, cursor.description)
+                yield escritor.fim()
+            finally:
+                try:
+                    cursor.close()
+                except Exception:
+                    descartar = True
+        except GeneratorExit:
+            raise
+        except Exception:
+            descartar = True
+            raise
+        finally:
+            if conn is not None:
+                try:
+                    conn.rollback()
+                except Exception:
+                    descartar = True
+                pool.devolver(conn, descartar=descartar)
+            self._liberar()
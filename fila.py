@@ -0,0 +1,401 @@
+"""
+FILA DE SINCRONIZAÇÃO NO POSTGRES (cisp_sync_jobs)
+
+Em vez de chamar a CISP e gravar dentro da requisição HTTP, a API pode só
+enfileirar a raiz (POST /api/fila ou /api/sincronizar/<raiz>?assincrono=1)
+e responder 202 com o job_id. Workers (`python fila.py`, quantos containers
+forem precisos) consomem a fila:
+
+- cada worker reserva jobs com SELECT ... FOR UPDATE SKIP LOCKED: dois
+  workers nunca pegam o mesmo job e não esperam um pelo outro
+- job reservado tem prazo (FILA_PRAZO_S); se o worker morrer, o job volta
+  para a fila quando o prazo vencer
+- falha (CISP fora, timeout, erro no banco) volta para a fila com espera
+  exponencial; Retry-After da CISP é respeitado
+- depois de FILA_MAX_TENTATIVAS o job vai para "falhou" (dead-letter) e
+  pode ser reprocessado por POST /api/fila/<id>/reprocessar
+- cada conclusão, nova tentativa e dead-letter é registrada em
+  cisp_log_sincronizacao, como na integração (integração.py)
+
+Estados: pendente -> executando -> ok | nao_encontrada | falhou.
+"""
+
+import os
+import json
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+
+from cliente_cisp import ErroCISP, CISPNaoEncontrada
+from lote import deduplicar
+from logs import obter as obter_log
+
+log = obter_log("fila")
+
+TABELA_JOBS = "cisp_sync_jobs"
+TABELA_LOG = "cisp_log_sincronizacao"
+
+FILA_WORKERS = int(os.environ.get('FILA_WORKERS', '4'))
+FILA_MAX_TENTATIVAS = int(os.environ.get('FILA_MAX_TENTATIVAS', '5'))
+FILA_ESPERA_BASE_S = float(os.environ.get('FILA_ESPERA_BASE_S', '30'))
+FILA_ESPERA_MAX_S = float(os.environ.get('FILA_ESPERA_MAX_S', '3600'))
+FILA_PRAZO_S = float(os.environ.get('FILA_PRAZO_S', '300'))
+FILA_OCIOSO_S = float(os.environ.get('FILA_OCIOSO_S', '1'))
+FILA_RETENCAO_DIAS = float(os.environ.get('FILA_RETENCAO_DIAS', '7'))
+FILA_MAX_RAIZES = int(os.environ.get('FILA_MAX_RAIZES', '20000'))
+
+PENDENTE = "pendente"
+EXECUTANDO = "executando"
+OK = "ok"
+NAO_ENCONTRADA = "nao_encontrada"
+FALHOU = "falhou"
+
+SQL_CRIAR_TABELA = f"""
+    CREATE TABLE IF NOT EXISTS {TABELA_JOBS} (
+        id bigserial PRIMARY KEY,
+        raiz text NOT NULL,
+        forcar boolean NOT NULL DEFAULT false,
+        estado text NOT NULL DEFAULT '{PENDENTE}',
+        tentativas integer NOT NULL DEFAULT 0,
+        max_tentativas integer NOT NULL,
+        disponivel_em timestamp NOT NULL DEFAULT now(),
+        prazo_em timestamp,
+        criado_em timestamp NOT NULL DEFAULT now(),
+        iniciado_em timestamp,
+        finalizado_em timestamp,
+        worker text,
+        ultimo_erro text,
+        resultado jsonb
+    );
+    CREATE INDEX IF NOT EXISTS {TABELA_JOBS}_pendentes_idx ON {TABELA_JOBS} (disponivel_em, id) WHERE estado = '{PENDENTE}';
+    CREATE INDEX IF NOT EXISTS {TABELA_JOBS}_executando_idx ON {TABELA_JOBS} (prazo_em) WHERE estado = '{EXECUTANDO}';
+    CREATE INDEX IF NOT EXISTS {TABELA_JOBS}_raiz_idx ON {TABELA_JOBS} (raiz, estado)
+"""
+
+_COLUNAS_JOB = (
+    "id", "raiz", "forcar", "estado", "tentativas", "max_tentativas", "disponivel_em",
+    "criado_em", "iniciado_em", "finalizado_em", "worker", "ultimo_erro", "resultado",
+)
+
+
+def garantir_tabela(cursor):
+    """Cria tabela e índices só se a tabela não existir (CREATE INDEX IF NOT EXISTS pede lock mesmo sem criar)"""
+    cursor.execute("SELECT to_regclass(%s) AS tabela", (TABELA_JOBS,))
+    row = cursor.fetchone()
+    if (row["tabela"] if isinstance(row, dict) else row[0]) is not None:
+        return
+    cursor.execute(SQL_CRIAR_TABELA)
+
+
+def registrar_log(cursor, raiz, status, mensagem):
+    """Uma linha em cisp_log_sincronizacao (mesmo formato da integração)"""
+    cursor.execute(
+        f"INSERT INTO {TABELA_LOG} (raiz, data_hora, status, mensagem) VALUES (%s, %s, %s, %s)",
+        (raiz, datetime.now(), status, mensagem),
+    )
+
+
+def _job(row):
+    job = dict(zip(_COLUNAS_JOB, row))
+    for c in ("disponivel_em", "criado_em", "iniciado_em", "finalizado_em"):
+        if job[c] is not None:
+            job[c] = job[c].isoformat()
+    return job
+
+
+# ----------------------------------------------------------------------
+# API: enfileirar e consultar
+
+def enfileirar(cursor, raizes, forcar=False, max_tentativas=None):
+    """
+    Cria um job pendente por raiz; raiz que já tem job pendente reaproveita
+    o existente. Devolve [{raiz, job_id, novo}] na ordem das raízes.
+    """
+    raizes = deduplicar(raizes)
+    if not raizes:
+        raise ValueError("nenhuma raiz válida informada")
+    if len(raizes) > FILA_MAX_RAIZES:
+        raise ValueError(f"máximo de {FILA_MAX_RAIZES} raízes por chamada")
+    max_tentativas = max(1, int(max_tentativas or FILA_MAX_TENTATIVAS))
+    novos = execute_values(
+        cursor,
+        f"INSERT INTO {TABELA_JOBS} (raiz, forcar, max_tentativas) "
+        f"SELECT n.raiz, n.forcar, n.max_tentativas FROM (VALUES %s) AS n (raiz, forcar, max_tentativas) "
+        f"WHERE NOT EXISTS (SELECT 1 FROM {TABELA_JOBS} j WHERE j.raiz = n.raiz AND j.estado = '{PENDENTE}' "
+        f"AND (j.forcar OR NOT n.forcar)) RETURNING raiz, id",
+        [(r, bool(forcar), max_tentativas) for r in raizes],
+        fetch=True, page_size=max(1, len(raizes)),
+    )
+    ids = {r: i for r, i in novos}
+    restantes = [r for r in raizes if r not in ids]
+    existentes = {}
+    if restantes:
+        cursor.execute(
+            f"SELECT raiz, min(id) FROM {TABELA_JOBS} WHERE raiz = ANY(%s) AND estado = '{PENDENTE}' GROUP BY raiz",
+            (restantes,),
+        )
+        existentes = dict(cursor.fetchall())
+    return [
+        {"raiz": r, "job_id": ids.get(r, existentes.get(r)), "novo": r in ids}
+        for r in raizes
+    ]
+
+
+def obter(cursor, job_id):
+    cursor.execute(f"SELECT {', '.join(_COLUNAS_JOB)} FROM {TABELA_JOBS} WHERE id = %s", (job_id,))
+    row = cursor.fetchone()
+    return _job(row) if row else None
+
+
+def listar(cursor, estado=None, raiz=None, limite=100):
+    cond, params = [], []
+    if estado:
+        cond.append("estado = %s")
+        params.append(estado)
+    if raiz:
+        cond.append("raiz = %s")
+        params.append(raiz)
+    where = f" WHERE {' AND '.join(cond)}" if cond else ""
+    cursor.execute(
+        f"SELECT {', '.join(_COLUNAS_JOB)} FROM {TABELA_JOBS}{where} ORDER BY id DESC LIMIT %s",
+        params + [limite],
+    )
+    return [_job(r) for r in cursor.fetchall()]
+
+
+def resumo(cursor):
+    """Jobs por estado, atraso do pendente mais antigo e vazão da última hora"""
+    cursor.execute(f"SELECT estado, count(*) FROM {TABELA_JOBS} GROUP BY estado")
+    por_estado = dict(cursor.fetchall())
+    cursor.execute(
+        f"SELECT extract(epoch FROM now() - min(disponivel_em)) FROM {TABELA_JOBS} "
+        f"WHERE estado = '{PENDENTE}' AND disponivel_em <= now()"
+    )
+    atraso = cursor.fetchone()[0]
+    cursor.execute(
+        f"SELECT count(*) FROM {TABELA_JOBS} WHERE finalizado_em > now() - interval '1 hour' AND estado = '{OK}'"
+    )
+    return {
+        "por_estado": por_estado,
+        "atraso_s": round(float(atraso), 1) if atraso is not None else 0.0,
+        "concluidos_ultima_hora": cursor.fetchone()[0],
+    }
+
+
+def reprocessar(cursor, job_id):
+    """Devolve à fila um job em dead-letter (ou concluído), zerando as tentativas"""
+    cursor.execute(
+        f"UPDATE {TABELA_JOBS} SET estado = '{PENDENTE}', tentativas = 0, disponivel_em = now(), "
+        f"prazo_em = NULL, finalizado_em = NULL, ultimo_erro = NULL "
+        f"WHERE id = %s AND estado <> '{EXECUTANDO}' AND estado <> '{PENDENTE}' RETURNING id",
+        (job_id,),
+    )
+    return cursor.fetchone() is not None
+
+
+# ----------------------------------------------------------------------
+# Worker
+
+def espera_retentativa(tentativas, retry_after=None):
+    """Espera exponencial com jitter; Retry-After da CISP vale como mínimo"""
+    espera = min(FILA_ESPERA_MAX_S, FILA_ESPERA_BASE_S * 2 ** max(0, tentativas - 1))
+    espera *= random.uniform(0.8, 1.2)
+    if retry_after:
+        espera = max(espera, retry_after)
+    return espera
+
+
+class WorkerFila:
+    """
+    sincronizar(raiz, forcar) -> resultado da gravação (dict; None = falhou);
+                                 falhas da CISP levantam ErroCISP
+    conexao()                    (context manager do pool)
+    """
+
+    def __init__(self, sincronizar, conexao, workers=FILA_WORKERS, nome=None):
+        self.sincronizar = sincronizar
+        self.conexao = conexao
+        self.workers = max(1, workers)
+        self.nome = nome or f"{socket.gethostname()}:{os.getpid()}"
+        self._parar = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {"ok": 0, "nao_encontradas": 0, "retentativas": 0, "dead_letter": 0}
+        self._ultima_limpeza = 0.0
+
+    def estatisticas(self):
+        with self._lock:
+            return {"worker": self.nome, "workers": self.workers, **self._stats}
+
+    def _contar(self, chave):
+        with self._lock:
+            self._stats[chave] += 1
+
+    def _reservar(self, cursor, n):
+        cursor.execute(
+            f"UPDATE {TABELA_JOBS} j SET estado = '{EXECUTANDO}', tentativas = j.tentativas + 1, "
+            f"iniciado_em = now(), prazo_em = now() + make_interval(secs => %s), worker = %s "
+            f"FROM (SELECT id FROM {TABELA_JOBS} WHERE estado = '{PENDENTE}' AND disponivel_em <= now() "
+            f"ORDER BY disponivel_em, id LIMIT %s FOR UPDATE SKIP LOCKED) c "
+            f"WHERE j.id = c.id RETURNING j.id, j.raiz, j.forcar, j.tentativas, j.max_tentativas",
+            (FILA_PRAZO_S, self.nome, n),
+        )
+        return cursor.fetchall()
+
+    def _manutencao(self, cursor):
+        """
+        Jobs de workers que morreram (prazo vencido) voltam à fila, ou viram falhou
+        se já gastaram as tentativas; apaga os antigos já concluídos
+        """
+        cursor.execute(
+            f"UPDATE {TABELA_JOBS} SET "
+            f"estado = CASE WHEN tentativas >= max_tentativas THEN '{FALHOU}' ELSE '{PENDENTE}' END, "
+            f"finalizado_em = CASE WHEN tentativas >= max_tentativas THEN now() END, "
+            f"prazo_em = NULL, disponivel_em = now(), "
+            f"ultimo_erro = 'prazo vencido (worker ' || coalesce(worker, '?') || ')' "
+            f"WHERE estado = '{EXECUTANDO}' AND prazo_em < now() "
+            f"RETURNING id, raiz, estado, tentativas, ultimo_erro"
+        )
+        vencidos = cursor.fetchall()
+        desistidos = [j for j in vencidos if j[2] == FALHOU]
+        if len(vencidos) > len(desistidos):
+            log.warning("%d job(s) com prazo vencido voltaram para a fila", len(vencidos) - len(desistidos))
+        for job_id, raiz, _, tentativas, erro in desistidos:
+            self._contar("dead_letter")
+            log.warning("Job %s (%s) desistiu após %d tentativas: %s", job_id, raiz, tentativas, erro)
+            cursor.execute("SAVEPOINT fila_log")
+            try:
+                registrar_log(cursor, raiz, "ERROR", f"Job {job_id} desistiu após {tentativas} tentativas: {erro}")
+                cursor.execute("RELEASE SAVEPOINT fila_log")
+            except Exception as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT fila_log")
+                log.warning("Log de %s não registrado: %s", raiz, e)
+        if time.monotonic() - self._ultima_limpeza > 3600:
+            self._ultima_limpeza = time.monotonic()
+            cursor.execute(
+                f"DELETE FROM {TABELA_JOBS} WHERE estado IN ('{OK}', '{NAO_ENCONTRADA}') "
+                f"AND finalizado_em < now() - make_interval(days => %s)",
+                (int(FILA_RETENCAO_DIAS),),
+            )
+
+    def _finalizar(self, job_id, raiz, estado, resultado=None, erro=None, espera=None, registro=None):
+        with self.conexao() as conn:
+            cursor = conn.cursor()
+            try:
+                if estado == PENDENTE:
+                    cursor.execute(
+                        f"UPDATE {TABELA_JOBS} SET estado = '{PENDENTE}', prazo_em = NULL, ultimo_erro = %s, "
+                        f"disponivel_em = now() + make_interval(secs => %s) WHERE id = %s",
+                        (erro, espera, job_id),
+                    )
+                else:
+                    cursor.execute(
+                        f"UPDATE {TABELA_JOBS} SET estado = %s, prazo_em = NULL, finalizado_em = now(), "
+                        f"ultimo_erro = %s, resultado = %s WHERE id = %s",
+                        (estado, erro, json.dumps(resultado, default=str) if resultado is not None else None, job_id),
+                    )
+                if registro:
+                    # sem a tabela de log o job segue sendo atualizado
+                    cursor.execute("SAVEPOINT fila_log")
+                    try:
+                        registrar_log(cursor, raiz, *registro)
+                        cursor.execute("RELEASE SAVEPOINT fila_log")
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO SAVEPOINT fila_log")
+                        log.warning("Log de %s não registrado: %s", raiz, e)
+                conn.commit()
+            finally:
+                cursor.close()
+
+    def _processar(self, job):
+        job_id, raiz, forcar, tentativas, max_tentativas = job
+        retry_after = None
+        try:
+            resultado = self.sincronizar(raiz, forcar)
+            if resultado is not None:
+                self._contar("ok")
+                self._finalizar(job_id, raiz, OK, resultado=resultado,
+                                registro=("SUCCESS", f"Sincronização concluída (job {job_id})"))
+                return
+            erro = "falha ao gravar no PostgreSQL"
+        except CISPNaoEncontrada as e:
+            self._contar("nao_encontradas")
+            self._finalizar(job_id, raiz, NAO_ENCONTRADA, erro=str(e),
+                            registro=("ERROR", f"Raiz não encontrada na CISP (job {job_id})"))
+            return
+        except ErroCISP as e:
+            erro, retry_after = f"{e.tipo}: {e}", e.retry_after
+        except Exception as e:
+            erro = str(e)
+
+        if tentativas >= max_tentativas:
+            self._contar("dead_letter")
+            self._finalizar(job_id, raiz, FALHOU, erro=erro,
+                            registro=("ERROR", f"Job {job_id} desistiu após {tentativas} tentativas: {erro}"))
+        else:
+            self._contar("retentativas")
+            espera = espera_retentativa(tentativas, retry_after)
+            self._finalizar(job_id, raiz, PENDENTE, erro=erro, espera=espera,
+                            registro=("RETRY", f"Tentativa {tentativas}/{max_tentativas} do job {job_id} falhou "
+                                          f"({erro}); nova tentativa em {espera:.0f}s"))
+
+    def _executar_job(self, job, vagas):
+        try:
+            self._processar(job)
+        except Exception as e:
+            # nem o estado foi gravado: o prazo vence e o job volta para a fila
+            log.error("Job %s (%s) sem estado final: %s", job[0], job[1], e)
+        finally:
+            vagas.release()
+
+    def executar(self):
+        """Laço do worker (bloqueia até parar())"""
+        self._parar.clear()
+        vagas = threading.Semaphore(self.workers)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="fila") as executor:
+            while not self._parar.is_set():
+                # quantas threads estão livres agora
+                livres = 0
+                while vagas.acquire(blocking=False):
+                    livres += 1
+                jobs = []
+                if livres:
+                    try:
+                        with self.conexao() as conn:
+                            cursor = conn.cursor()
+                            try:
+                                self._manutencao(cursor)
+                                jobs = self._reservar(cursor, livres)
+                                conn.commit()
+                            finally:
+                                cursor.close()
+                    except Exception as e:
+                        log.warning("Falha ao reservar jobs: %s", e)
+                for job in jobs:
+                    executor.submit(self._executar_job, job, vagas)
+                for _ in range(livres - len(jobs)):
+                    vagas.release()
+                if len(jobs) < livres or not livres:
+                    self._parar.wait(FILA_OCIOSO_S)
+
+    def parar(self):
+        self._parar.set()
+
+
+if __name__ == "__main__":
+    # Worker em processo separado: mesma gravação da API (app.py), sem servir HTTP
+    import app
+
+    worker = WorkerFila(
+        sincronizar=lambda raiz, forcar: app.sincronizar_raiz(raiz, max_age=0, gravar_do_cache=True, forcar=forcar)[2],
+        conexao=app.conexao,
+    )
+    print(f"📥 Worker da fila {TABELA_JOBS}: {worker.nome}, {worker.workers} threads")
+    try:
+        worker.executar()
+    except KeyboardInterrupt:
+        worker.parar()
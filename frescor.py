@@ -0,0 +1,42 @@
+"""
+POLÍTICA DE FRESCOR DOS DADOS
+
+Antes de consultar a CISP, olha quando a raiz foi gravada pela última vez em
+cisp_avaliacao_analitica (data_atualizacao / ultima_atualizacao). Se o registro
+for mais novo que o limite, a consulta é atendida só pelo Postgres.
+
+Limite padrão: CISP_FRESCOR_MAX_SEGUNDOS (0 desliga a política).
+Uma requisição pode apertar ou afrouxar o limite com ?max_age=<segundos>.
+A idade vem junto do documento, na mesma consulta (leitura.py).
+"""
+
+import os
+from datetime import datetime, timezone
+
+FRESCOR_MAX_SEGUNDOS = float(os.environ.get('CISP_FRESCOR_MAX_SEGUNDOS', '900'))
+
+# Valores de origem usados no header X-Dados-Origem e no campo "origem"
+ORIGEM_CISP = "cisp"
+ORIGEM_CACHE = "cache"
+ORIGEM_BANCO = "banco"
+
+COLUNAS_ATUALIZACAO = ("data_atualizacao", "ultima_atualizacao")
+
+
+def idade_em_segundos(momento):
+    if momento is None:
+        return None
+    if isinstance(momento, datetime):
+        agora = datetime.now(timezone.utc) if momento.tzinfo else datetime.now()
+        return max(0.0, (agora - momento).total_seconds())
+    return None
+
+
+def limite_frescor(max_age=None):
+    return FRESCOR_MAX_SEGUNDOS if max_age is None else max_age
+
+
+def esta_fresco(idade, max_age=None):
+    limite = limite_frescor(max_age)
+    return idade is not None and limite > 0 and idade <= limite
+
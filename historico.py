@@ -0,0 +1,326 @@
+"""
+HISTÓRICO DOS CLIENTES (cisp_historico) — SÉRIES NO TEMPO
+
+cisp_avaliacao_analitica guarda só a última foto de cada raiz. cisp_historico
+guarda, só acrescentando, um ponto por sincronização em que algo mudou:
+rating, débito atual, faixas de vencido (5/15/30 dias), limite de crédito e
+maior acúmulo. Ponto igual ao anterior da raiz não é gravado (a comparação
+é feita no próprio INSERT, sem ida extra ao banco).
+
+- particionada por mês (cisp_historico_pAAAAMM): consultas de um período só
+  leem as partições do período
+- a chave primária (raiz, capturado_em) INCLUDE (colunas das séries) cobre a
+  consulta de /api/cliente/<raiz>/historico: index-only scan, sem ler a tabela
+- partições dos próximos HISTORICO_MESES_FUTUROS meses são criadas antes de
+  precisar; as mais velhas que HISTORICO_RETENCAO_MESES são desanexadas
+  (DETACH: a tabela continua no banco, fora das consultas) e, com
+  HISTORICO_APAGAR_DESANEXADAS=1, apagadas
+
+A manutenção roda na migração 4 (migracoes.py), junto das gravações (na
+primeira de cada processo e depois no máximo uma vez por dia) e com
+`python historico.py manter`.
+"""
+
+import os
+import sys
+import time
+import threading
+from datetime import date, datetime, timedelta
+
+TABELA_HISTORICO = "cisp_historico"
+
+HISTORICO_ATIVO = os.environ.get('CISP_HISTORICO', '1') not in ('0', 'false', 'False')
+HISTORICO_MESES_FUTUROS = int(os.environ.get('HISTORICO_MESES_FUTUROS', '3'))
+# 0 = nunca desanexa
+HISTORICO_RETENCAO_MESES = int(os.environ.get('HISTORICO_RETENCAO_MESES', '36'))
+HISTORICO_APAGAR_DESANEXADAS = os.environ.get('HISTORICO_APAGAR_DESANEXADAS', '0') in ('1', 'true', 'True')
+HISTORICO_MANUTENCAO_S = 86400
+# DDL da manutenção não fica na fila de locks atrás de leituras longas
+HISTORICO_LOCK_TIMEOUT = os.environ.get('HISTORICO_LOCK_TIMEOUT', '2s')
+
+# (coluna, tipo): o que cada ponto guarda, na ordem das séries
+SERIES = [
+    ("rating", "text"),
+    ("debito_atual", "numeric"),
+    ("debito_vencido_05", "numeric"),
+    ("debito_vencido_15", "numeric"),
+    ("debito_vencido_30", "numeric"),
+    ("limite_credito", "numeric"),
+    ("maior_acumulo", "numeric"),
+    ("qtd_associadas_debito_atual", "integer"),
+]
+COLUNAS = [c for c, _ in SERIES]
+
+SQL_CRIAR_TABELA = f"""
+    CREATE TABLE IF NOT EXISTS {TABELA_HISTORICO} (
+        raiz text NOT NULL,
+        capturado_em timestamp NOT NULL,
+        {", ".join(f"{c} {t}" for c, t in SERIES)},
+        PRIMARY KEY (raiz, capturado_em) INCLUDE ({", ".join(COLUNAS)})
+    ) PARTITION BY RANGE (capturado_em)
+"""
+
+# Partições só recebem INSERT: vacuum cedo mantém o visibility map em dia (index-only scan)
+SQL_CRIAR_PARTICAO = (
+    "CREATE TABLE IF NOT EXISTS {particao} PARTITION OF " + TABELA_HISTORICO +
+    " FOR VALUES FROM ('{inicio}') TO ('{fim}')"
+    " WITH (autovacuum_vacuum_insert_scale_factor = 0.05, fillfactor = 100)"
+)
+
+SQL_PARTICOES = """
+    SELECT c.relname FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = to_regclass(%s)
+"""
+
+# Ponto novo só se diferente do último anterior a ele (reprocessar.py grava pontos antigos)
+SQL_REGISTRAR = f"""
+    INSERT INTO {TABELA_HISTORICO} (raiz, capturado_em, {", ".join(COLUNAS)})
+    SELECT v.* FROM (VALUES (%(raiz)s::text, %(capturado_em)s::timestamp,
+        {", ".join(f"%({c})s::{t}" for c, t in SERIES)})) v (raiz, capturado_em, {", ".join(COLUNAS)})
+    WHERE NOT EXISTS (
+        SELECT 1 FROM (
+            SELECT {", ".join(COLUNAS)} FROM {TABELA_HISTORICO}
+            WHERE raiz = %(raiz)s AND capturado_em <= %(capturado_em)s
+            ORDER BY capturado_em DESC LIMIT 1
+        ) u
+        WHERE ({", ".join(f"u.{c}" for c in COLUNAS)}) IS NOT DISTINCT FROM ({", ".join(f"v.{c}" for c in COLUNAS)})
+    )
+    ON CONFLICT DO NOTHING
+"""
+
+# Último ponto de cada dia/semana/mês (DISTINCT ON) ou todos; só colunas do índice
+AGRUPAMENTOS = {"dia": "day", "semana": "week", "mes": "month"}
+SQL_SERIE = f"""
+    SELECT capturado_em, {", ".join(COLUNAS)} FROM {TABELA_HISTORICO}
+    WHERE raiz = %(raiz)s AND capturado_em >= %(desde)s AND capturado_em < %(ate)s
+    ORDER BY capturado_em
+"""
+SQL_SERIE_AGRUPADA = f"""
+    SELECT * FROM (
+        SELECT DISTINCT ON (date_trunc('{{unidade}}', capturado_em)) capturado_em, {", ".join(COLUNAS)}
+        FROM {TABELA_HISTORICO}
+        WHERE raiz = %(raiz)s AND capturado_em >= %(desde)s AND capturado_em < %(ate)s
+        ORDER BY date_trunc('{{unidade}}', capturado_em), capturado_em DESC
+    ) p ORDER BY capturado_em
+"""
+
+PERIODO_PADRAO_DIAS = 365
+PERIODO_MAXIMO_DIAS = 366 * 5
+
+
+def _mes(momento):
+    return date(momento.year, momento.month, 1)
+
+
+def _somar_meses(mes, n):
+    total = mes.year * 12 + mes.month - 1 + n
+    return date(total // 12, total % 12 + 1, 1)
+
+
+def nome_particao(mes):
+    return f"{TABELA_HISTORICO}_p{mes:%Y%m}"
+
+
+def _mes_da_particao(nome):
+    """cisp_historico_p202610 -> date(2026, 10, 1); None se não seguir o padrão"""
+    try:
+        return datetime.strptime(nome[len(TABELA_HISTORICO) + 2:], "%Y%m").date()
+    except ValueError:
+        return None
+
+
+def ponto(dados, metricas):
+    """Valores do ponto a partir do payload; débito atual como em cisp_metricas_derivadas"""
+    info_sup = dados.get('informacaoSuporte') or {}
+    return {
+        "rating": metricas.get("rating_atual"),
+        "debito_atual": metricas.get("total_debito_atual"),
+        "debito_vencido_05": info_sup.get('valorTotalDebitoVencidoMais05Dias'),
+        "debito_vencido_15": info_sup.get('valorTotalDebitoVencidoMais15Dias'),
+        "debito_vencido_30": info_sup.get('valorTotalDebitoVencidoMais30Dias'),
+        "limite_credito": info_sup.get('valorTotalLimiteCredito'),
+        "maior_acumulo": info_sup.get('valorTotalMaiorAcumulo'),
+        "qtd_associadas_debito_atual": info_sup.get('quantidadeAssociadasDebitoAtual'),
+    }
+
+
+def _data_param(texto, padrao):
+    if not texto:
+        return padrao
+    try:
+        return datetime.fromisoformat(texto)
+    except ValueError:
+        raise ValueError(f"data inválida: {texto!r} (use AAAA-MM-DD)")
+
+
+def _valor(v):
+    return float(v) if v is not None and not isinstance(v, (int, float, str)) else v
+
+
+class HistoricoClientes:
+    def __init__(self, retencao_meses=HISTORICO_RETENCAO_MESES, meses_futuros=HISTORICO_MESES_FUTUROS):
+        self.retencao_meses = retencao_meses
+        self.meses_futuros = meses_futuros
+        self._particoes = set()      # meses com partição conhecida neste processo
+        self._ultima_manutencao = time.monotonic()
+        self._lock = threading.Lock()
+        self._stats = {"gravados": 0, "repetidos": 0, "particoes_criadas": 0, "desanexadas": 0}
+
+    def _contar(self, chave, n=1):
+        with self._lock:
+            self._stats[chave] += n
+
+    def _limite_retencao(self, hoje=None):
+        if not self.retencao_meses:
+            return None
+        return _somar_meses(_mes(hoje or date.today()), -self.retencao_meses)
+
+    # ------------------------------------------------------------------
+    # Partições
+
+    def _ler_particoes(self, cursor):
+        cursor.execute(SQL_PARTICOES, (TABELA_HISTORICO,))
+        nomes = [row["relname"] if isinstance(row, dict) else row[0] for row in cursor.fetchall()]
+        meses = {m for m in map(_mes_da_particao, nomes) if m}
+        self._particoes = meses
+        return meses
+
+    def _criar_particao(self, cursor, mes):
+        cursor.execute(SQL_CRIAR_PARTICAO.format(
+            particao=nome_particao(mes), inicio=mes.isoformat(), fim=_somar_meses(mes, 1).isoformat(),
+        ))
+        self._particoes.add(mes)
+        self._contar("particoes_criadas")
+
+    def manter(self, cursor, hoje=None, incluir=()):
+        """
+        Cria as partições que faltarem (mês atual, próximos meses e os meses em
+        `incluir`) e desanexa (ou apaga) as mais velhas que a retenção. Sem nada
+        a fazer, só lê o catálogo. Devolve {"criadas": [...], "desanexadas": [...]}.
+        """
+        hoje = hoje or date.today()
+        existentes = self._ler_particoes(cursor)
+        atual = _mes(hoje)
+        desejadas = {_somar_meses(atual, i) for i in range(self.meses_futuros + 1)} | set(incluir)
+        faltando = sorted(m for m in desejadas if m not in existentes)
+        limite = self._limite_retencao(hoje)
+        velhas = sorted(m for m in existentes if limite and m < limite)
+        if not (faltando or velhas):
+            return {"criadas": [], "desanexadas": []}
+        cursor.execute(
+            "SELECT current_setting('lock_timeout') AS antes, set_config('lock_timeout', %s, true)",
+            (HISTORICO_LOCK_TIMEOUT,),
+        )
+        row = cursor.fetchone()
+        antes = row["antes"] if isinstance(row, dict) else row[0]
+        for mes in faltando:
+            self._criar_particao(cursor, mes)
+        for mes in velhas:
+            cursor.execute(f"ALTER TABLE {TABELA_HISTORICO} DETACH PARTITION {nome_particao(mes)}")
+            if HISTORICO_APAGAR_DESANEXADAS:
+                cursor.execute(f"DROP TABLE {nome_particao(mes)}")
+            self._particoes.discard(mes)
+            self._contar("desanexadas")
+        cursor.execute("SELECT set_config('lock_timeout', %s, true)", (antes,))
+        return {"criadas": [nome_particao(m) for m in faltando], "desanexadas": [nome_particao(m) for m in velhas]}
+
+    def _manter_junto(self, cursor, incluir=()):
+        """manter() dentro da transação de quem chama, num SAVEPOINT: falha (lock_timeout) não derruba a gravação"""
+        cursor.execute("SAVEPOINT historico_manter")
+        try:
+            self.manter(cursor, incluir=incluir)
+            cursor.execute("RELEASE SAVEPOINT historico_manter")
+        except Exception:
+            cursor.execute("ROLLBACK TO SAVEPOINT historico_manter")
+            self._particoes = set()   # o que foi criado voltou atrás: relê na próxima
+
+    # ------------------------------------------------------------------
+
+    def registrar(self, cursor, raiz, capturado_em, valores):
+        """Grava o ponto na transação de quem chama; True se era diferente do anterior"""
+        mes = _mes(capturado_em)
+        limite = self._limite_retencao()
+        if limite and mes < limite:
+            return False
+        if mes not in self._particoes or time.monotonic() - self._ultima_manutencao > HISTORICO_MANUTENCAO_S:
+            # incluir: mês fora da janela da manutenção (ex.: reprocessamento de payload antigo)
+            self._ultima_manutencao = time.monotonic()
+            self._manter_junto(cursor, incluir=(mes,))
+            if mes not in self._particoes:
+                return False
+        cursor.execute(SQL_REGISTRAR, {"raiz": raiz, "capturado_em": capturado_em, **valores})
+        novo = cursor.rowcount == 1
+        self._contar("gravados" if novo else "repetidos")
+        return novo
+
+    def serie(self, cursor, raiz, desde=None, ate=None, agrupar=None):
+        """
+        Pontos da raiz em [desde, ate) em colunas: {"data": [...], "rating": [...], ...}.
+        desde/ate: texto AAAA-MM-DD[THH:MM] (padrão: os últimos 365 dias);
+        agrupar: dia | semana | mes (último ponto de cada período)
+        """
+        ate = _data_param(ate, datetime.now())
+        desde = _data_param(desde, ate - timedelta(days=PERIODO_PADRAO_DIAS))
+        if desde >= ate:
+            raise ValueError("desde deve ser anterior a ate")
+        if (ate - desde).days > PERIODO_MAXIMO_DIAS:
+            raise ValueError(f"período máximo: {PERIODO_MAXIMO_DIAS} dias")
+        if agrupar and agrupar not in AGRUPAMENTOS:
+            raise ValueError(f"agrupar deve ser um de: {', '.join(AGRUPAMENTOS)}")
+        sql = SQL_SERIE_AGRUPADA.format(unidade=AGRUPAMENTOS[agrupar]) if agrupar else SQL_SERIE
+        cursor.execute(sql, {"raiz": raiz, "desde": desde, "ate": ate})
+        series = {"data": []}
+        series.update({c: [] for c in COLUNAS})
+        for row in cursor.fetchall():
+            valores = list(row.values()) if isinstance(row, dict) else list(row)
+            series["data"].append(valores[0].isoformat(timespec="seconds"))
+            for c, v in zip(COLUNAS, valores[1:]):
+                series[c].append(_valor(v))
+        return {
+            "raiz": raiz,
+            "desde": desde.isoformat(timespec="seconds"),
+            "ate": ate.isoformat(timespec="seconds"),
+            "agrupar": agrupar,
+            "pontos": len(series["data"]),
+            "series": series,
+        }
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                "ativo": HISTORICO_ATIVO,
+                "retencao_meses": self.retencao_meses,
+                "particoes": len(self._particoes),
+                **self._stats,
+            }
+
+
+historico_clientes = HistoricoClientes()
+
+
+def garantir_tabela(cursor):
+    """Cria a tabela particionada se não existir e roda a manutenção das partições (ver manter)"""
+    cursor.execute("SELECT to_regclass(%s) AS tabela", (TABELA_HISTORICO,))
+    row = cursor.fetchone()
+    if (row["tabela"] if isinstance(row, dict) else row[0]) is None:
+        cursor.execute(SQL_CRIAR_TABELA)
+    return historico_clientes.manter(cursor)
+
+
+if __name__ == '__main__':
+    # python historico.py manter
+    from banco import conexao
+
+    if len(sys.argv) < 2 or sys.argv[1] != "manter":
+        print("uso: python historico.py manter")
+        sys.exit(2)
+    with conexao() as conn:
+        cursor = conn.cursor()
+        try:
+            feito = garantir_tabela(cursor)
+            conn.commit()
+        finally:
+            cursor.close()
+    print(f"{TABELA_HISTORICO}: {historico_clientes.estatisticas()['particoes']} partições | "
+          f"criadas: {', '.join(feito['criadas']) or '-'} | desanexadas: {', '.join(feito['desanexadas']) or '-'}")
@@ -1,15 +1,46 @@
 import os
-import requests
+import time
+import queue
+import argparse
+import threading
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
-from datetime import datetime
-from requests.auth import HTTPBasicAuth
+from datetime import datetime, timedelta
+
+from cliente_cisp import cliente_cisp, ErroCISP, CISPNaoEncontrada, DEADLINE_LOTE_S
+from lote import raizes_de_csv, deduplicar, limitador_host
+from esquema import esquema
+import assinatura
+import fila
+import arquivo_cisp
+import derivados
+import historico
+from historico import historico_clientes
+from arquivo_cisp import arquivo_payload
+
+_app = None
+
+
+def _gravacao():
+    """
+    app.py importado sob demanda (sem agendador): specs e mapeadores das tabelas,
+    gravar_principal e gravar_filhas. O CLI grava as mesmas colunas que a API,
+    seja qual for o esquema do banco (o criado por migracoes.py ou um já existente).
+    """
+    global _app
+    if _app is None:
+        os.environ["AGENDA_NO_PROCESSO"] = "0"
+        import app
+        _app = app
+    return _app
+
 
 class CISPIntegration:
-    def __init__(self):
-        # Configuração da API
-        self.api_base_url = "https://servicos.cisp.com.br/v1/avaliacao-analitica/raiz"
-        self.api_username = os.environ.get('CISP_USERNAME')
-        self.api_password = os.environ.get('CISP_PASSWORD')
+    def __init__(self, transacao_externa=False, verboso=True):
+        # Configuração da API (cliente HTTP compartilhado, com keep-alive)
+        self.cisp = cliente_cisp
+        self.api_base_url = cliente_cisp.base_url
         
         # Configuração do banco
         self.db_config = {
@@ -23,12 +54,37 @@ class CISPIntegration:
         
         self.conn = None
         self.cursor = None
+        # transacao_externa=True: quem chama faz o commit (um por raiz ou por lote);
+        # cada tabela fica num SAVEPOINT, e a falha de uma não desfaz as outras
+        self.transacao_externa = transacao_externa
+        self.verboso = verboso
+
+    def _print(self, *args, **kwargs):
+        if self.verboso:
+            print(*args, **kwargs)
+
+    def _iniciar(self):
+        if self.transacao_externa:
+            self.cursor.execute("SAVEPOINT integracao")
+
+    def _confirmar(self):
+        if self.transacao_externa:
+            self.cursor.execute("RELEASE SAVEPOINT integracao")
+        else:
+            self.conn.commit()
+
+    def _desfazer(self):
+        if self.transacao_externa:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT integracao")
+            self.cursor.execute("RELEASE SAVEPOINT integracao")
+        else:
+            self.conn.rollback()
     
     def conectar_db(self):
         try:
             self.conn = psycopg2.connect(**self.db_config)
             self.cursor = self.conn.cursor()
-            print("✓ Conectado ao PostgreSQL (schema: scsilverlayer)")
+            self._print("✓ Conectado ao PostgreSQL (schema: scsilverlayer)")
             return True
         except Exception as e:
             print(f"✗ Erro ao conectar: {e}")
@@ -39,423 +95,511 @@ class CISPIntegration:
             self.cursor.close()
         if self.conn:
             self.conn.close()
-        print("✓ Desconectado do PostgreSQL")
+        self._print("✓ Desconectado do PostgreSQL")
     
     def obter_dados_api(self, raiz):
         try:
             url = f"{self.api_base_url}/{raiz}"
-            print(f"📡 Buscando dados da API: {url}")
+            self._print(f"📡 Buscando dados da API: {url}")
             
-            response = requests.get(
-                url,
-                auth=HTTPBasicAuth(self.api_username, self.api_password),
-                timeout=120
-            )
-            
-            if response.status_code == 200:
-                print("✓ Dados obtidos com sucesso!")
-                return response.json()
-            else:
-                print(f"✗ Erro na API: Status {response.status_code}")
-                return None
-                
+            dados, _ = self.cisp.buscar_json(raiz, timeout=(self.cisp.timeout[0], 120), prazo=DEADLINE_LOTE_S)
+            self._print("✓ Dados obtidos com sucesso!")
+            return dados
+
+        except ErroCISP as e:
+            status = f" (HTTP {e.status_http})" if e.status_http else ""
+            print(f"✗ Erro na API [{e.tipo}]{status}: {e}")
+            return None
         except Exception as e:
             print(f"✗ Erro ao buscar dados: {e}")
             return None
     
-    def converter_data(self, data_str):
-        if not data_str or data_str == '':
-            return None
-        try:
-            return datetime.strptime(data_str, '%Y-%m-%d').date()
-        except:
-            return None
-    
+    def _snapshot(self):
+        return esquema.atual(self.cursor)
+
     def inserir_avaliacao_analitica(self, raiz, dados):
         try:
-            cliente = dados.get('cliente', {})
-            info_sup = dados.get('informacaoSuporte', {})
-            receita = dados.get('receitaFederal', {})
-
-            sql = """
-                INSERT INTO cisp_avaliacao_analitica (
-                    raiz, cnpj, razao_social, nome_fantasia,
-                    situacao_receita_federal,
-                    tipo_logradouro, logradouro, numero, complemento,
-                    bairro, municipio, uf, cep, telefone, email,
-                    valor_total_debito_atual, qtd_associadas_debito_atual,
-                    valor_total_debito_vencido_5dias, percentual_debito_vencido_5dias,
-                    qtd_associadas_debito_vencido_5dias,
-                    valor_total_debito_vencido_15dias, percentual_debito_vencido_15dias,
-                    qtd_associadas_debito_vencido_15dias,
-                    valor_total_debito_vencido_30dias, percentual_debito_vencido_30dias,
-                    qtd_associadas_debito_vencido_30dias,
-                    valor_total_limite_credito, qtd_associadas_limite_credito,
-                    valor_total_maior_acumulo, qtd_associadas_maior_acumulo,
-                    qtd_associadas_informacoes_negociais,
-                    qtd_associadas_vendas_ultimos_2meses,
-                    ultima_atualizacao
-                ) VALUES (
-                    %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                    %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                    %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                    %s, %s, %s
-                )
-                ON CONFLICT (raiz) DO UPDATE SET
-                    cnpj = EXCLUDED.cnpj,
-                    razao_social = EXCLUDED.razao_social,
-                    nome_fantasia = EXCLUDED.nome_fantasia,
-                    situacao_receita_federal = EXCLUDED.situacao_receita_federal,
-                    tipo_logradouro = EXCLUDED.tipo_logradouro,
-                    logradouro = EXCLUDED.logradouro,
-                    numero = EXCLUDED.numero,
-                    complemento = EXCLUDED.complemento,
-                    bairro = EXCLUDED.bairro,
-                    municipio = EXCLUDED.municipio,
-                    uf = EXCLUDED.uf,
-                    cep = EXCLUDED.cep,
-                    telefone = EXCLUDED.telefone,
-                    email = EXCLUDED.email,
-                    valor_total_debito_atual = EXCLUDED.valor_total_debito_atual,
-                    qtd_associadas_debito_atual = EXCLUDED.qtd_associadas_debito_atual,
-                    valor_total_debito_vencido_5dias = EXCLUDED.valor_total_debito_vencido_5dias,
-                    percentual_debito_vencido_5dias = EXCLUDED.percentual_debito_vencido_5dias,
-                    qtd_associadas_debito_vencido_5dias = EXCLUDED.qtd_associadas_debito_vencido_5dias,
-                    valor_total_debito_vencido_15dias = EXCLUDED.valor_total_debito_vencido_15dias,
-                    percentual_debito_vencido_15dias = EXCLUDED.percentual_debito_vencido_15dias,
-                    qtd_associadas_debito_vencido_15dias = EXCLUDED.qtd_associadas_debito_vencido_15dias,
-                    valor_total_debito_vencido_30dias = EXCLUDED.valor_total_debito_vencido_30dias,
-                    percentual_debito_vencido_30dias = EXCLUDED.percentual_debito_vencido_30dias,
-                    qtd_associadas_debito_vencido_30dias = EXCLUDED.qtd_associadas_debito_vencido_30dias,
-                    valor_total_limite_credito = EXCLUDED.valor_total_limite_credito,
-                    qtd_associadas_limite_credito = EXCLUDED.qtd_associadas_limite_credito,
-                    valor_total_maior_acumulo = EXCLUDED.valor_total_maior_acumulo,
-                    qtd_associadas_maior_acumulo = EXCLUDED.qtd_associadas_maior_acumulo,
-                    qtd_associadas_informacoes_negociais = EXCLUDED.qtd_associadas_informacoes_negociais,
-                    qtd_associadas_vendas_ultimos_2meses = EXCLUDED.qtd_associadas_vendas_ultimos_2meses,
-                    ultima_atualizacao = EXCLUDED.ultima_atualizacao
-            """
-
-            self.cursor.execute(sql, (
-                raiz,
-                cliente.get('identificacaoCliente'),
-                cliente.get('razaoSocial'),
-                cliente.get('nomeFantasia'),
-                receita.get('situacaoCadastral'),
-                cliente.get('tipoLogradouro'),
-                cliente.get('logradouro'),
-                cliente.get('numero'),
-                cliente.get('complemento'),
-                cliente.get('bairro'),
-                cliente.get('municipio'),
-                cliente.get('uf'),
-                cliente.get('cep'),
-                cliente.get('telefone'),
-                cliente.get('email'),
-                info_sup.get('valorTotalDebitoAtual'),
-                info_sup.get('quantidadeAssociadasDebitoAtual'),
-                info_sup.get('valorTotalDebitoVencidoMais05Dias'),
-                info_sup.get('percentualDebitoVencidoMais05Dias'),
-                info_sup.get('quantidadeAssociadasDebitoVencidoMais05Dias'),
-                info_sup.get('valorTotalDebitoVencidoMais15Dias'),
-                info_sup.get('percentualDebitoVencidoMais15Dias'),
-                info_sup.get('quantidadeAssociadasDebitoVencidoMais15Dias'),
-                info_sup.get('valorTotalDebitoVencidoMais30Dias'),
-                info_sup.get('percentualDebitoVencidoMais30Dias'),
-                info_sup.get('quantidadeAssociadasDebitoVencidoMais30Dias'),
-                info_sup.get('valorTotalLimiteCredito'),
-                info_sup.get('quantidadeAssociadasLimiteCredito'),
-                info_sup.get('valorTotalMaiorAcumulo'),
-                info_sup.get('quantidadeAssociadasMaiorAcumulo'),
-                info_sup.get('quantidadeAssociadasInformacoesNegociais'),
-                info_sup.get('quantidadeAssociadasVendasUltimos2Meses'),
-                datetime.now()
-            ))
-            
-            self.conn.commit()
-            print("✓ Tabela cisp_avaliacao_analitica atualizada")
+            self._iniciar()
+            gravacao = _gravacao()
+            gravacao.gravar_principal(self.cursor, self._snapshot(), raiz, gravacao._contexto_principal(dados))
+            self._confirmar()
+            self._print("✓ Tabela cisp_avaliacao_analitica atualizada")
             return True
             
         except Exception as e:
             print(f"✗ Erro ao inserir avaliacao_analitica: {e}")
-            self.conn.rollback()
+            self._desfazer()
             return False
     
+    def esquecer_assinaturas(self, raiz):
+        """As tabelas filhas vão ser regravadas aqui: o app não pode pular seções pela assinatura antiga"""
+        try:
+            self._iniciar()
+            assinatura.esquecer(self.cursor, raiz)
+            self._confirmar()
+            return True
+
+        except Exception as e:
+            print(f"✗ Erro ao apagar assinaturas: {e}")
+            self._desfazer()
+            return False
+
+    def _gravar_filhas(self, tabela, raiz, itens):
+        """
+        Deixa as linhas da raiz iguais aos itens com o mapeador da tabela (as
+        mesmas colunas e o mesmo merge por chave natural do app.py)
+        """
+        return _gravacao().gravar_filhas(self.cursor, self._snapshot(), tabela, raiz, itens)
+
+    def _resumo(self, n):
+        return f"+{n['inseridas']} ~{n['atualizadas']} -{n['apagadas']}"
+
     def inserir_restritivas(self, raiz, dados):
         try:
-            restritivas = dados.get('restritivas', [])
-            
-            if not restritivas:
-                print("⚠ Nenhuma restritiva encontrada")
-                return True
-            
-            # Deleta restritivas antigas
-            self.cursor.execute("DELETE FROM cisp_restritivas WHERE raiz = %s", (raiz,))
-            
-            sql = """
-                INSERT INTO cisp_restritivas (
-                    raiz, codigo_associada, razao_social, codigo_primeira_restritiva,
-                    descricao_primeira_restritiva, codigo_segunda_restritiva,
-                    descricao_segunda_restritiva, data_ocorrencia, data_informacao
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
+            self._iniciar()
+            restritivas = dados.get('restritivas') or []
             
-            count = 0
-            for rest in restritivas:
-                # Manter timestamp em milissegundos (bigint)
-                data_ocorrencia = rest.get('dataOcorrencia')
-
-                self.cursor.execute(sql, (
-                    raiz,
-                    rest.get('codigoAssociada'),
-                    rest.get('razaoSocial'),
-                    rest.get('codigoPrimeiraRestritiva'),
-                    rest.get('descricaoPrimeiraRestritiva'),
-                    rest.get('codigoSegundaRestritiva'),
-                    rest.get('descricaoSegundaRestritiva'),
-                    data_ocorrencia,
-                    self.converter_data(rest.get('dataInformacao'))
-                ))
-                count += 1
+            n = self._gravar_filhas("cisp_restritivas", raiz, restritivas)
             
-            self.conn.commit()
-            print(f"✓ {count} restritivas inseridas")
+            self._confirmar()
+            self._print(f"✓ {len(restritivas)} restritivas ({self._resumo(n)})")
             return True
             
         except Exception as e:
             print(f"✗ Erro ao inserir restritivas: {e}")
-            self.conn.rollback()
+            self._desfazer()
             return False
     
     def inserir_alertas(self, raiz, dados):
         try:
-            alertas = dados.get('alertas', [])
-
-            if not alertas:
-                print("⚠ Nenhum alerta encontrado")
-                return True
-
-            # Deleta alertas antigos
-            self.cursor.execute("DELETE FROM cisp_alertas WHERE raiz = %s", (raiz,))
-
-            sql = """
-                INSERT INTO cisp_alertas (
-                    raiz, identificacao_cliente, codigo_alerta, descricao_alerta,
-                    associada_informante, razao_social
-                ) VALUES (%s, %s, %s, %s, %s, %s)
-            """
-
-            count = 0
-            for alerta in alertas:
-                self.cursor.execute(sql, (
-                    raiz,
-                    alerta.get('identificacaoCliente'),
-                    alerta.get('codigoAlerta'),
-                    alerta.get('descricaoAlerta'),
-                    alerta.get('associadaInformante'),
-                    alerta.get('razaoSocial')
-                ))
-                count += 1
+            self._iniciar()
+            alertas = dados.get('alertas') or []
+
+            n = self._gravar_filhas("cisp_alertas", raiz, alertas)
             
-            self.conn.commit()
-            print(f"✓ {count} alertas inseridos")
+            self._confirmar()
+            self._print(f"✓ {len(alertas)} alertas ({self._resumo(n)})")
             return True
             
         except Exception as e:
             print(f"✗ Erro ao inserir alertas: {e}")
-            self.conn.rollback()
+            self._desfazer()
             return False
     
     def inserir_consultas_mensais(self, raiz, dados):
         try:
-            consultas = dados.get('quantidadeConsultasUltimos12Meses', [])
+            self._iniciar()
+            consultas = dados.get('quantidadeConsultasUltimos12Meses') or []
             
-            if not consultas:
-                print("⚠ Nenhuma consulta mensal encontrada")
-                return True
+            n = self._gravar_filhas("cisp_consultas_mensais", raiz, consultas)
             
-            # Deleta consultas antigas
-            self.cursor.execute("DELETE FROM cisp_consultas_mensais WHERE raiz = %s", (raiz,))
-            
-            sql = """
-                INSERT INTO cisp_consultas_mensais (
-                    raiz, mes, quantidade_consultas
-                ) VALUES (%s, %s, %s)
-            """
-            
-            count = 0
-            for consulta in consultas:
-                self.cursor.execute(sql, (
-                    raiz,
-                    consulta.get('data'),
-                    consulta.get('consultas')
-                ))
-                count += 1
-            
-            self.conn.commit()
-            print(f"✓ {count} consultas mensais inseridas")
+            self._confirmar()
+            self._print(f"✓ {len(consultas)} consultas mensais ({self._resumo(n)})")
             return True
             
         except Exception as e:
             print(f"✗ Erro ao inserir consultas mensais: {e}")
-            self.conn.rollback()
+            self._desfazer()
             return False
     
     def inserir_associadas_consultaram(self, raiz, dados):
         try:
-            associadas = dados.get('associadaConsultaUltimos30Dias', [])
-            
-            if not associadas:
-                print("⚠ Nenhuma associada consultou")
-                return True
-            
-            # Deleta associadas antigas
-            self.cursor.execute("DELETE FROM cisp_associadas_consultaram WHERE raiz = %s", (raiz,))
+            self._iniciar()
+            associadas = dados.get('associadaConsultaUltimos30Dias') or []
             
-            sql = """
-                INSERT INTO cisp_associadas_consultaram (
-                    raiz, codigo_associada, razao_social
-                ) VALUES (%s, %s, %s)
-            """
+            n = self._gravar_filhas("cisp_associadas_consultaram", raiz, associadas)
             
-            count = 0
-            for associada in associadas:
-                self.cursor.execute(sql, (
-                    raiz,
-                    associada.get('codigoAssociada'),
-                    associada.get('razaoSocial')
-                ))
-                count += 1
-            
-            self.conn.commit()
-            print(f"✓ {count} associadas que consultaram inseridas")
+            self._confirmar()
+            self._print(f"✓ {len(associadas)} associadas que consultaram ({self._resumo(n)})")
             return True
             
         except Exception as e:
             print(f"✗ Erro ao inserir associadas consultaram: {e}")
-            self.conn.rollback()
+            self._desfazer()
             return False
     
     def inserir_associadas_nao_concederam(self, raiz, dados):
         try:
-            associadas = dados.get('associadaNaoConcederamCredito', [])
-            
-            if not associadas:
-                print("⚠ Nenhuma associada negou crédito")
-                return True
-            
-            # Deleta associadas antigas
-            self.cursor.execute("DELETE FROM cisp_associadas_nao_concederam_credito WHERE raiz = %s", (raiz,))
-            
-            sql = """
-                INSERT INTO cisp_associadas_nao_concederam_credito (
-                    raiz, codigo_associada, razao_social
-                ) VALUES (%s, %s, %s)
-            """
+            self._iniciar()
+            associadas = dados.get('associadaNaoConcederamCredito') or []
             
-            count = 0
-            for associada in associadas:
-                self.cursor.execute(sql, (
-                    raiz,
-                    associada.get('codigoAssociada'),
-                    associada.get('razaoSocial')
-                ))
-                count += 1
+            n = self._gravar_filhas("cisp_associadas_nao_concederam_credito", raiz, associadas)
             
-            self.conn.commit()
-            print(f"✓ {count} associadas que negaram crédito inseridas")
+            self._confirmar()
+            self._print(f"✓ {len(associadas)} associadas que negaram crédito ({self._resumo(n)})")
             return True
             
         except Exception as e:
             print(f"✗ Erro ao inserir associadas não concederam: {e}")
-            self.conn.rollback()
+            self._desfazer()
             return False
     
+    def inserir_derivados(self, raiz, dados):
+        """Ratings, positivas por segmento e métricas derivadas (ver derivados.py); tabela ausente é pulada"""
+        try:
+            self._iniciar()
+            gravacao = _gravacao()
+            snap = self._snapshot()
+            ratings = dados.get('ratings') or []
+            positivas = derivados.linhas_positivas(dados)
+            n_ratings = self._gravar_filhas(derivados.TABELA_RATINGS, raiz, ratings)
+            n_positivas = self._gravar_filhas(derivados.TABELA_POSITIVAS, raiz, positivas)
+            gravacao.gravar_principal(self.cursor, snap, raiz, gravacao._contexto_principal(dados), derivados.TABELA_DERIVADAS)
+            self._confirmar()
+            self._print(f"✓ {len(ratings)} ratings ({self._resumo(n_ratings)}), "
+                        f"{len(positivas)} positivas ({self._resumo(n_positivas)}) e métricas derivadas")
+            return True
+
+        except Exception as e:
+            print(f"✗ Erro ao inserir ratings/positivas/métricas derivadas: {e}")
+            self._desfazer()
+            return False
+
+    def registrar_historico(self, raiz, dados):
+        """Ponto em cisp_historico se algo mudou desde o anterior (ver historico.py)"""
+        if not historico.HISTORICO_ATIVO or not esquema.atual(self.cursor).existe(historico.TABELA_HISTORICO):
+            return True
+        try:
+            self._iniciar()
+            novo = historico_clientes.registrar(
+                self.cursor, raiz, datetime.now(), historico.ponto(dados, derivados.derivar(dados)),
+            )
+            self._confirmar()
+            self._print(f"✓ Histórico: {'ponto novo' if novo else 'sem mudanças'}")
+            return True
+
+        except Exception as e:
+            print(f"✗ Erro ao registrar histórico: {e}")
+            self._desfazer()
+            return False
+
     def registrar_log(self, raiz, status, mensagem):
         try:
-            sql = """
-                INSERT INTO cisp_log_sincronizacao (
-                    raiz, data_hora, status, mensagem
-                ) VALUES (%s, %s, %s, %s)
-            """
-            
-            self.cursor.execute(sql, (
-                raiz,
-                datetime.now(),
-                status,
-                mensagem
-            ))
-            
-            self.conn.commit()
+            self._iniciar()
+            fila.registrar_log(self.cursor, raiz, status, mensagem)
+            self._confirmar()
             
         except Exception as e:
             print(f"✗ Erro ao registrar log: {e}")
+            self._desfazer()
     
-    def sincronizar_raiz(self, raiz):
-        print(f"\n{'='*60}")
-        print(f"SINCRONIZANDO RAIZ: {raiz}")
-        print(f"{'='*60}")
-        
-        # Busca dados da API
-        dados = self.obter_dados_api(raiz)
-        
-        if not dados:
-            self.registrar_log(raiz, 'ERROR', 'Falha ao obter dados da API')
-            return False
-        
-        # Insere em todas as tabelas
+    def arquivar_payload(self, raiz, dados):
+        """Payload bruto em cisp_payload_raw (ver arquivo_cisp.py); falha aqui não falha a raiz"""
+        if not arquivo_cisp.ARQUIVO_ATIVO or not esquema.atual(self.cursor).existe(arquivo_cisp.TABELA_RAW):
+            return
+        try:
+            self._iniciar()
+            nova = arquivo_payload.arquivar(self.cursor, raiz, dados)
+            self._confirmar()
+            self._print(f"✓ Payload arquivado ({'versão nova' if nova else 'sem mudanças'})")
+        except Exception as e:
+            print(f"✗ Erro ao arquivar payload: {e}")
+            self._desfazer()
+
+    def _travar_raiz(self, raiz):
+        """
+        O mesmo advisory lock por raiz de app.gravar_payload: API, agendador,
+        fila e CLI não intercalam gravações da mesma raiz. Na transação externa
+        vale até o commit do lote; com um commit por tabela é de sessão (até
+        _liberar_raiz).
+        """
+        gravacao = _gravacao()
+        if self.transacao_externa:
+            gravacao.travar_raiz(self.cursor, raiz)
+        else:
+            self.cursor.execute("SELECT pg_advisory_lock(%s, hashtext(%s))", (gravacao.LOCK_CLASSE_RAIZ, str(raiz)))
+            self.conn.commit()
+
+    def _liberar_raiz(self, raiz):
+        if not self.transacao_externa:
+            self.cursor.execute("SELECT pg_advisory_unlock(%s, hashtext(%s))", (_gravacao().LOCK_CLASSE_RAIZ, str(raiz)))
+            self.conn.commit()
+
+    def gravar_dados(self, raiz, dados):
+        """Grava o payload em todas as tabelas e registra o log; True se nenhuma falhou"""
         sucesso = True
         
-        sucesso &= self.inserir_avaliacao_analitica(raiz, dados)
-        sucesso &= self.inserir_restritivas(raiz, dados)
-        sucesso &= self.inserir_alertas(raiz, dados)
-        sucesso &= self.inserir_consultas_mensais(raiz, dados)
-        sucesso &= self.inserir_associadas_consultaram(raiz, dados)
-        sucesso &= self.inserir_associadas_nao_concederam(raiz, dados)
+        self.arquivar_payload(raiz, dados)
+        self._travar_raiz(raiz)
+        try:
+            sucesso &= self.esquecer_assinaturas(raiz)
+            sucesso &= self.inserir_avaliacao_analitica(raiz, dados)
+            sucesso &= self.inserir_restritivas(raiz, dados)
+            sucesso &= self.inserir_alertas(raiz, dados)
+            sucesso &= self.inserir_consultas_mensais(raiz, dados)
+            sucesso &= self.inserir_associadas_consultaram(raiz, dados)
+            sucesso &= self.inserir_associadas_nao_concederam(raiz, dados)
+            sucesso &= self.inserir_derivados(raiz, dados)
+            sucesso &= self.registrar_historico(raiz, dados)
+        finally:
+            self._liberar_raiz(raiz)
         
         if sucesso:
             self.registrar_log(raiz, 'SUCCESS', 'Sincronização concluída com sucesso')
-            print(f"✅ Raiz {raiz} sincronizada com sucesso em TODAS as tabelas!")
+            self._print(f"✅ Raiz {raiz} sincronizada com sucesso em TODAS as tabelas!")
         else:
             self.registrar_log(raiz, 'ERROR', 'Erro em uma ou mais tabelas')
             print(f"⚠ Raiz {raiz} sincronizada com erros")
         
         return sucesso
 
+    def sincronizar_raiz(self, raiz):
+        self._print(f"\n{'='*60}")
+        self._print(f"SINCRONIZANDO RAIZ: {raiz}")
+        self._print(f"{'='*60}")
+        
+        # Busca dados da API
+        dados = self.obter_dados_api(raiz)
+        
+        if not dados:
+            self.registrar_log(raiz, 'ERROR', 'Falha ao obter dados da API')
+            return False
+        
+        return self.gravar_dados(raiz, dados)
+
 # =============================================================================
-# EXECUÇÃO PRINCIPAL
+# CARGA EM MASSA (CLI)
 # =============================================================================
+#
+# N buscadores chamam a CISP em paralelo e entregam os payloads a M
+# gravadores; cada gravador tem sua conexão e faz um commit a cada --lote
+# raízes. Raízes concluídas vão para o arquivo de checkpoint (após o commit):
+# rodar de novo com o mesmo --checkpoint continua de onde parou.
 
-if __name__ == "__main__":
-    # Lista de raízes para sincronizar
-    raizes = [
-        "37608058",  # Carrefour
-        # Adicione mais raízes aqui
-    ]
-    
-    integration = CISPIntegration()
-    
+RAIZES_PADRAO = [
+    "37608058",  # Carrefour
+]
+
+_FIM = object()
+
+
+def percentil(valores_ordenados, p):
+    if not valores_ordenados:
+        return None
+    i = min(len(valores_ordenados) - 1, max(0, int(round(p / 100 * (len(valores_ordenados) - 1)))))
+    return valores_ordenados[i]
+
+
+class Checkpoint:
+    """Arquivo com uma raiz concluída por linha (raiz<TAB>status); só cresce"""
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.feitas = set()
+        self._lock = threading.Lock()
+        self._arq = None
+        if caminho:
+            if os.path.exists(caminho):
+                with open(caminho, encoding="utf-8") as f:
+                    self.feitas = {linha.split("\t", 1)[0].strip() for linha in f if linha.strip()}
+            self._arq = open(caminho, "a", encoding="utf-8")
+
+    def marcar(self, itens):
+        if self._arq is None or not itens:
+            return
+        with self._lock:
+            self._arq.writelines(f"{raiz}\t{status}\n" for raiz, status in itens)
+            self._arq.flush()
+            os.fsync(self._arq.fileno())
+
+    def fechar(self):
+        if self._arq is not None:
+            self._arq.close()
+
+
+class Progresso:
+    def __init__(self, total):
+        self.total = total
+        self.inicio = time.monotonic()
+        self.contagem = {}
+        self.latencias = []
+        self._lock = threading.Lock()
+
+    def latencia(self, ms):
+        with self._lock:
+            self.latencias.append(ms)
+
+    def concluir(self, status):
+        with self._lock:
+            self.contagem[status] = self.contagem.get(status, 0) + 1
+
+    def linha(self):
+        with self._lock:
+            feitas = sum(self.contagem.values())
+            lat = sorted(self.latencias)
+            contagem = dict(self.contagem)
+        decorrido = time.monotonic() - self.inicio
+        taxa = feitas / decorrido if decorrido else 0.0
+        restante = (self.total - feitas) / taxa if taxa else None
+        pcts = " ".join(
+            f"p{p} {percentil(lat, p):.0f}ms" for p in (50, 95, 99) if lat
+        ) or "-"
+        eta = f"{restante / 60:.1f}min" if restante is not None else "-"
+        resumo = " ".join(f"{k}={v}" for k, v in sorted(contagem.items()))
+        return f"{feitas}/{self.total} | {taxa:.2f} raízes/s | CISP {pcts} | {resumo} | ETA {eta}"
+
+
+def raizes_da_consulta(sql):
+    integration = CISPIntegration(verboso=False)
     if not integration.conectar_db():
-        print("✗ Não foi possível conectar ao banco de dados")
-        exit(1)
-    
-    # Sincroniza cada raiz
-    total_sucesso = 0
-    total_erro = 0
-    
-    for raiz in raizes:
-        if integration.sincronizar_raiz(raiz):
-            total_sucesso += 1
-        else:
-            total_erro += 1
-    
-    integration.desconectar_db()
+        raise SystemExit(1)
+    try:
+        integration.cursor.execute(sql)
+        return [str(linha[0]) for linha in integration.cursor.fetchall()]
+    finally:
+        integration.desconectar_db()
+
+
+def _prazo(texto):
+    """"06:00" -> próximo instante com esse horário"""
+    if not texto:
+        return None
+    hora = datetime.strptime(texto, "%H:%M").time()
+    agora = datetime.now()
+    prazo = datetime.combine(agora.date(), hora)
+    return prazo if prazo > agora else prazo + timedelta(days=1)
+
+
+def carga_em_massa(raizes, buscadores=8, gravadores=2, lote=50, checkpoint=None, prazo=None, intervalo=10.0):
+    """Sincroniza as raízes com N buscadores e M gravadores; devolve a contagem por status"""
+    ck = Checkpoint(checkpoint)
+    pendentes = [r for r in raizes if r not in ck.feitas]
+    if len(pendentes) < len(raizes):
+        print(f"↩ Checkpoint {checkpoint}: {len(raizes) - len(pendentes)} raízes já concluídas, {len(pendentes)} restantes")
+    progresso = Progresso(len(pendentes))
+    fila_gravacao = queue.Queue(maxsize=max(1, gravadores * lote * 2))
+    parar = threading.Event()
+
+    def buscar(raiz):
+        if parar.is_set():
+            return
+        inicio = time.monotonic()
+        try:
+            with limitador_host(cliente_cisp.base_url):
+                dados, _ = cliente_cisp.buscar_json(raiz, timeout=(cliente_cisp.timeout[0], 120), prazo=DEADLINE_LOTE_S)
+            erro = None
+        except Exception as e:
+            dados, erro = None, e
+        progresso.latencia((time.monotonic() - inicio) * 1000)
+        fila_gravacao.put((raiz, dados, erro))
+
+    def gravar_lote(integration, itens):
+        concluidas = []
+        try:
+            for raiz, dados, erro in itens:
+                if erro is not None:
+                    tipo = getattr(erro, "tipo", "erro")
+                    print(f"✗ {raiz}: [{tipo}] {erro}")
+                    integration.registrar_log(raiz, 'ERROR', f'Falha ao obter dados da API: {erro}')
+                    # não encontrada é definitivo; as demais falhas ficam para a próxima execução
+                    concluidas.append((raiz, "nao_encontrada" if isinstance(erro, CISPNaoEncontrada) else None))
+                elif integration.gravar_dados(raiz, dados):
+                    concluidas.append((raiz, "ok"))
+                else:
+                    concluidas.append((raiz, None))
+            integration.conn.commit()
+        except Exception as e:
+            print(f"✗ Falha no commit do lote ({len(itens)} raízes): {e}")
+            integration.conn.rollback()
+            concluidas = [(raiz, None) for raiz, _, _ in itens]
+        ck.marcar([(raiz, status) for raiz, status in concluidas if status])
+        for _, status in concluidas:
+            progresso.concluir(status or "erro")
+
+    def gravador():
+        integration = CISPIntegration(transacao_externa=True, verboso=False)
+        conectado = integration.conectar_db()
+        itens = []
+        try:
+            while True:
+                try:
+                    item = fila_gravacao.get(timeout=1.0)
+                except queue.Empty:
+                    item = None
+                if item is _FIM:
+                    break
+                if item is not None:
+                    itens.append(item)
+                if itens and (item is None or len(itens) >= lote):
+                    if conectado:
+                        gravar_lote(integration, itens)
+                    else:
+                        for _ in itens:
+                            progresso.concluir("erro")
+                    itens = []
+            if itens and conectado:
+                gravar_lote(integration, itens)
+        finally:
+            if conectado:
+                integration.desconectar_db()
+
+    threads = [threading.Thread(target=gravador, name=f"gravador-{i}", daemon=True) for i in range(max(1, gravadores))]
+    for t in threads:
+        t.start()
+
+    executor = ThreadPoolExecutor(max_workers=max(1, buscadores), thread_name_prefix="buscador")
+    futuros = [executor.submit(buscar, r) for r in pendentes]
+    try:
+        while not all(f.done() for f in futuros):
+            concurrent.futures.wait(futuros, timeout=intervalo)
+            print(f"⏱ {progresso.linha()}")
+            if prazo and datetime.now() >= prazo and not parar.is_set():
+                print(f"⏹ Prazo {prazo:%H:%M} atingido: terminando as buscas em andamento")
+                parar.set()
+    except KeyboardInterrupt:
+        print("⏹ Interrompido: terminando as buscas em andamento (o checkpoint guarda o progresso)")
+        parar.set()
+    executor.shutdown(wait=True)
+    for _ in threads:
+        fila_gravacao.put(_FIM)
+    for t in threads:
+        t.join()
+    ck.fechar()
+    print(f"⏱ {progresso.linha()}")
+    return dict(progresso.contagem)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sincronização em massa de raízes CISP -> PostgreSQL")
+    parser.add_argument("raizes", nargs="*", help="raízes (ou CNPJs) a sincronizar")
+    parser.add_argument("--arquivo", help="arquivo texto/CSV com uma raiz por linha (primeira coluna)")
+    parser.add_argument("--consulta", help="SQL cuja primeira coluna traz as raízes")
+    parser.add_argument("--buscadores", type=int, default=8, help="chamadas simultâneas à CISP (padrão 8)")
+    parser.add_argument("--gravadores", type=int, default=2, help="conexões gravando no banco (padrão 2)")
+    parser.add_argument("--lote", type=int, default=50, help="raízes por commit (1 = commit por raiz; padrão 50)")
+    parser.add_argument("--checkpoint", help="arquivo de progresso; rodar de novo com ele continua de onde parou")
+    parser.add_argument("--prazo", help="HH:MM para parar de buscar (janela de manutenção)")
+    parser.add_argument("--intervalo", type=float, default=10.0, help="segundos entre as linhas de progresso")
+    args = parser.parse_args()
+
+    raizes = list(args.raizes)
+    if args.arquivo:
+        with open(args.arquivo, encoding="utf-8-sig") as f:
+            raizes += raizes_de_csv(f.read())
+    if args.consulta:
+        raizes += raizes_da_consulta(args.consulta)
+    if not (args.raizes or args.arquivo or args.consulta):
+        raizes = RAIZES_PADRAO
+    raizes = deduplicar(raizes)
+
+    print(f"\n{'='*60}")
+    print(f"SINCRONIZAÇÃO EM MASSA: {len(raizes)} raízes | {args.buscadores} buscadores | "
+          f"{args.gravadores} gravadores | commit a cada {args.lote}")
+    print(f"{'='*60}")
+    inicio = time.monotonic()
+    contagem = carga_em_massa(
+        raizes, buscadores=args.buscadores, gravadores=args.gravadores, lote=max(1, args.lote),
+        checkpoint=args.checkpoint, prazo=_prazo(args.prazo), intervalo=args.intervalo,
+    )
+    decorrido = time.monotonic() - inicio
     
     # Resumo
     print(f"\n{'='*60}")
     print("RESUMO DA SINCRONIZAÇÃO")
     print(f"{'='*60}")
-    print(f"✓ Sucesso: {total_sucesso}")
-    print(f"✗ Erro: {total_erro}")
-    print(f"Total: {len(raizes)}")
+    print(f"✓ Sucesso: {contagem.get('ok', 0)}")
+    print(f"∅ Não encontradas: {contagem.get('nao_encontrada', 0)}")
+    print(f"✗ Erro: {contagem.get('erro', 0)}")
+    print(f"Total: {len(raizes)} em {decorrido:.1f}s")
     print(f"{'='*60}\n")
+    exit(1 if contagem.get('erro') else 0)
@@ -0,0 +1,265 @@
+"""
+LEITURA DO DOCUMENTO DO CLIENTE EM UMA ÚNICA CONSULTA
+
+O documento de /api/cliente (principal + tabelas filhas + contagens extras)
+é montado pelo próprio Postgres com json_build_object/json_agg em subconsultas
+LATERAL: uma ida ao banco por requisição e o JSON chega pronto como texto.
+
+O SQL é compilado a partir do snapshot de esquema (esquema.py) e recompilado
+só quando a versão do snapshot muda. Colunas ausentes viram null e tabelas
+ausentes viram [] (ou somem de "extras"), como na leitura campo a campo.
+
+ratings, positivaSegmentos e as métricas derivadas vêm das tabelas de
+derivados.py, com as mesmas chaves do payload da CISP; com elas criadas
+(documento_completo), o documento do banco dispensa o payload ao vivo.
+"""
+
+import threading
+
+from esquema import OPCOES_RAIZ
+from frescor import COLUNAS_ATUALIZACAO
+from derivados import TABELA_RATINGS, TABELA_POSITIVAS, TABELA_DERIVADAS, TABELAS as TABELAS_DERIVADOS
+
+TABELA_PRINCIPAL = "cisp_avaliacao_analitica"
+
+# (campo no documento, colunas candidatas em ordem de preferência -> COALESCE)
+CAMPOS_PRINCIPAL = [
+    ("raiz", OPCOES_RAIZ),
+    ("cnpj", ("cnpj",)),
+    ("razao_social", ("razao_social",)),
+    ("nome_fantasia", ("nome_fantasia",)),
+    ("data_fundacao", ("data_fundacao",)),
+    ("endereco", ("endereco",)),
+    ("bairro", ("bairro",)),
+    ("cidade", ("cidade", "municipio")),
+    ("uf", ("uf",)),
+    ("cep", ("cep",)),
+    ("telefone", ("telefone",)),
+    ("email", ("email",)),
+    ("capital_social", ("capital_social",)),
+    ("cnae", ("cnae",)),
+    ("descricao_atividade_fiscal", ("descricao_atividade_fiscal",)),
+    ("situacao_receita_federal", ("situacao_receita_federal",)),
+    ("data_situacao_cadastral", ("data_situacao_cadastral",)),
+    ("rating_atual", ("rating_atual", "classificacao_atual_cisp", "classificacao_cisp_atual", "classificacao")),
+    ("descricao_rating", ("descricao_rating", "descricao_classificacao", "descricao_classificacao_atual")),
+    ("total_debito_atual", ("total_debito_atual", "valor_total_debito_atual")),
+    ("total_debito_vencido_05_dias", ("total_debito_vencido_05_dias", "valor_total_debito_vencido_05dias", "valor_total_debito_vencido_5dias")),
+    ("total_debito_vencido_15_dias", ("total_debito_vencido_15_dias", "valor_total_debito_vencido_15dias")),
+    ("total_debito_vencido_30_dias", ("total_debito_vencido_30_dias", "valor_total_debito_vencido_30dias")),
+    ("qtd_associadas_debito_atual", ("qtd_associadas_debito_atual",)),
+    ("qtd_associadas_vencido_05_dias", ("qtd_associadas_vencido_05_dias", "qtd_associadas_debito_vencido_05dias", "qtd_associadas_debito_vencido_5dias")),
+    ("total_limite_credito", ("total_limite_credito", "valor_total_limite_credito")),
+    ("total_maior_acumulo", ("total_maior_acumulo", "valor_total_maior_acumulo")),
+    ("qtd_associadas_informacoes", ("qtd_associadas_informacoes", "qtd_associadas_informacoes_negociais")),
+    ("qtd_associadas_limite_credito", ("qtd_associadas_limite_credito",)),
+    ("qtd_associadas_maior_acumulo", ("qtd_associadas_maior_acumulo",)),
+    ("qtd_associadas_vendas_ultimos_2meses", ("qtd_associadas_vendas_ultimos_2meses",)),
+    ("data_maior_acumulo", ("data_maior_acumulo",)),
+    ("data_ultima_compra", ("data_ultima_compra",)),
+    ("codigo_associada_ultima_compra", ("codigo_associada_ultima_compra",)),
+    ("data_inclusao_cisp", ("data_inclusao_cisp",)),
+    ("hora_modificacao", ("hora_modificacao",)),
+    ("usuario_modificacao", ("usuario_modificacao",)),
+    ("situacao_sintegra", ("situacao_sintegra",)),
+    ("data_atualizacao", ("data_atualizacao",)),
+]
+
+_ASSOCIADAS = ("codigo_associada", "razao_social")
+
+# (campo no documento, tabela, colunas)
+LISTAS = [
+    ("restritivas", "cisp_restritivas", (
+        "codigo_associada", "razao_social",
+        "codigo_primeira_restritiva", "descricao_primeira_restritiva",
+        "codigo_segunda_restritiva", "descricao_segunda_restritiva",
+        "data_ocorrencia", "data_informacao",
+    )),
+    ("alertas", "cisp_alertas", ("codigo_alerta", "descricao_alerta", "associada_informante", "razao_social", "data_atualizacao")),
+    ("consultas_mensais", "cisp_consultas_mensais", ("mes_ano", "quantidade_consultas")),
+    ("associadas_consultaram", "cisp_associadas_consultaram", _ASSOCIADAS),
+    ("associadas_nao_concederam", "cisp_associadas_nao_concederam_credito", _ASSOCIADAS),
+]
+
+# Campos da principal que vêm de cisp_metricas_derivadas: (campo, coluna, derivada tem prioridade)
+# total_debito_atual prefere o total das informações comportamentais, como na resposta ao vivo
+CAMPOS_DERIVADOS = [
+    ("rating_atual", "rating_atual", False),
+    ("descricao_rating", "descricao_rating", False),
+    ("data_maior_acumulo", "data_maior_acumulo", False),
+    ("data_ultima_compra", "data_ultima_compra", False),
+    ("codigo_associada_ultima_compra", "codigo_associada_ultima_compra", False),
+    ("total_debito_atual", "total_debito_atual", True),
+]
+
+SQL_RATINGS = (
+    f"LEFT JOIN LATERAL (SELECT json_agg(json_build_object("
+    f"'data', t.data, 'classificacao', t.classificacao, 'descricaoClassificacao', t.descricao_classificacao"
+    f") ORDER BY t.data DESC NULLS LAST) AS doc FROM {TABELA_RATINGS} t WHERE {{filtro}}) rt ON true"
+)
+
+# Segmentos na ordem do payload, com as positivas de cada um
+SQL_POSITIVAS = (
+    f"LEFT JOIN LATERAL (SELECT json_agg(json_build_object("
+    f"'descricaoSegmento', s.segmento, 'totalAssociadasSegmento', s.total_associadas, "
+    f"'valorTotalDebitoSegmento', s.valor_total_debito, 'positivas', s.positivas"
+    f") ORDER BY s.ordem) AS doc FROM ("
+    f"SELECT t.ordem_segmento AS ordem, max(t.segmento) AS segmento, "
+    f"max(t.total_associadas_segmento) AS total_associadas, max(t.valor_total_debito_segmento) AS valor_total_debito, "
+    f"COALESCE(json_agg(json_build_object("
+    f"'codigoAssociada', t.codigo_associada, 'razaoSocial', t.razao_social, "
+    f"'dataUltimaCompra', t.data_ultima_compra, 'dataMaiorAcumulo', t.data_maior_acumulo, "
+    f"'valorMaiorAcumulo', t.valor_maior_acumulo, 'valorDebitoAtual', t.valor_debito_atual, "
+    f"'valorLimiteCredito', t.valor_limite_credito"
+    f") ORDER BY t.posicao) FILTER (WHERE t.posicao IS NOT NULL), '[]'::json) AS positivas "
+    f"FROM {TABELA_POSITIVAS} t WHERE {{filtro}} GROUP BY t.ordem_segmento) s) ps ON true"
+)
+
+# (campo em "extras", tabela): contagem por raiz, só se a tabela existir
+CONTAGENS = [
+    ("tot_cheques_sem_fundo", "cisp_cheques_sem_fundo"),
+    ("tot_titulos_protesto", "cisp_titulos_protesto"),
+]
+
+
+def _raiz_col(snap, tabela):
+    cols = snap.colunas_de(tabela)
+    for c in OPCOES_RAIZ:
+        if c in cols:
+            return c
+    return "raiz"
+
+
+def _filtro_raiz(snap, tabela, alias="t"):
+    """alias.<coluna raiz> = k.raiz, com k.raiz (texto) no tipo da coluna se ela não for texto (ex.: raiz bigint)"""
+    col = _raiz_col(snap, tabela)
+    tipo = snap.tipos_de(tabela).get(col, "text")
+    if tipo.startswith(("text", "character")):
+        return f"{alias}.{col} = k.raiz"
+    return f"{alias}.{col} = k.raiz::{tipo}"
+
+
+def documento_completo(snap):
+    """True se o banco guarda tudo o que o documento ao vivo traz (tabelas de derivados.py)"""
+    return all(snap.existe(t) for t in TABELAS_DERIVADOS)
+
+
+def _objeto(cols_tabela, campos, derivados=None):
+    """
+    json_build_object('campo', COALESCE(t.a, t.b), ...) com as colunas que existirem.
+    derivados: {campo: (expressão, prioridade)} somados às candidatas (alias d)
+    """
+    derivados = derivados or {}
+    partes = []
+    for campo, candidatas in campos:
+        existentes = [f"t.{c}" for c in candidatas if c in cols_tabela]
+        if campo in derivados:
+            expr_d, prioridade = derivados[campo]
+            existentes = [expr_d] + existentes if prioridade else existentes + [expr_d]
+        if not existentes:
+            expr = "NULL"
+        elif len(existentes) == 1:
+            expr = existentes[0]
+        else:
+            expr = f"COALESCE({', '.join(existentes)})"
+        partes.append(f"'{campo}', {expr}")
+    return f"json_build_object({', '.join(partes)})"
+
+
+# Origem das raízes: uma só (parâmetro %(raiz)s) ou a que quem chama fornecer
+FONTE_UMA_RAIZ = "(SELECT %(raiz)s::text AS raiz) k"
+
+
+def compilar(snap, fonte=FONTE_UMA_RAIZ, colunas_fonte=(), ordem=None):
+    """
+    SQL de (colunas_fonte..., atualizado_em, documento::text) para cada raiz de
+    `fonte` (subconsulta com alias k e coluna k.raiz).
+    """
+    laterais = []
+
+    if snap.existe(TABELA_PRINCIPAL):
+        cols = snap.colunas_de(TABELA_PRINCIPAL)
+        atual = [f"t.{c}" for c in COLUNAS_ATUALIZACAO if c in cols]
+        atualizado = "NULL::timestamp" if not atual else atual[0] if len(atual) == 1 else f"GREATEST({', '.join(atual)})"
+        derivados, juncao = {}, ""
+        if snap.existe(TABELA_DERIVADAS):
+            cols_d = snap.colunas_de(TABELA_DERIVADAS)
+            tipos = snap.tipos_de(TABELA_PRINCIPAL)
+            candidatas = dict(CAMPOS_PRINCIPAL)
+            for campo, col, prioridade in CAMPOS_DERIVADOS:
+                if col not in cols_d:
+                    continue
+                # no tipo da coluna da principal (ex.: codigo_associada integer lá, text aqui)
+                tipo = next((tipos[c] for c in candidatas[campo] if c in cols and c in tipos), None)
+                derivados[campo] = (f"d.{col}::{tipo}" if tipo else f"d.{col}", prioridade)
+            juncao = f" LEFT JOIN {TABELA_DERIVADAS} d ON {_filtro_raiz(snap, TABELA_DERIVADAS, 'd')}"
+        laterais.append(
+            f"LEFT JOIN LATERAL (SELECT {_objeto(cols, CAMPOS_PRINCIPAL, derivados)} AS doc, {atualizado} AS atualizado_em "
+            f"FROM {TABELA_PRINCIPAL} t{juncao} WHERE {_filtro_raiz(snap, TABELA_PRINCIPAL)} LIMIT 1) p ON true"
+        )
+    else:
+        laterais.append("LEFT JOIN LATERAL (SELECT NULL::json AS doc, NULL::timestamp AS atualizado_em) p ON true")
+
+    campos = ["'success', true", "'raiz', k.raiz", "'principal', p.doc"]
+    for i, (campo, tabela, colunas) in enumerate(LISTAS):
+        if snap.existe(tabela):
+            obj = _objeto(snap.colunas_de(tabela), [(c, (c,)) for c in colunas])
+            laterais.append(
+                f"LEFT JOIN LATERAL (SELECT json_agg({obj}) AS doc FROM {tabela} t "
+                f"WHERE {_filtro_raiz(snap, tabela)}) l{i} ON true"
+            )
+            campos.append(f"'{campo}', COALESCE(l{i}.doc, '[]'::json)")
+        else:
+            campos.append(f"'{campo}', '[]'::json")
+    for campo, tabela, sql, alias in (("ratings", TABELA_RATINGS, SQL_RATINGS, "rt"),
+                                      ("positivaSegmentos", TABELA_POSITIVAS, SQL_POSITIVAS, "ps")):
+        if snap.existe(tabela):
+            laterais.append(sql.format(filtro=_filtro_raiz(snap, tabela)))
+            campos.append(f"'{campo}', COALESCE({alias}.doc, '[]'::json)")
+        else:
+            campos.append(f"'{campo}', '[]'::json")
+
+    extras = []
+    for i, (campo, tabela) in enumerate(CONTAGENS):
+        if snap.existe(tabela):
+            laterais.append(
+                f"LEFT JOIN LATERAL (SELECT COUNT(*) AS total FROM {tabela} t "
+                f"WHERE {_filtro_raiz(snap, tabela)}) c{i} ON true"
+            )
+            extras.append(f"'{campo}', c{i}.total")
+    campos.append(f"'extras', json_build_object({', '.join(extras)})")
+
+    selecao = [f"k.{c}" for c in colunas_fonte] + [
+        "p.atualizado_em", f"json_build_object({', '.join(campos)})::text AS documento",
+    ]
+    sql = f"SELECT {', '.join(selecao)}\nFROM {fonte}\n" + "\n".join(laterais)
+    if ordem:
+        sql += f"\nORDER BY {ordem}"
+    return sql
+
+
+class LeitorDocumento:
+    def __init__(self):
+        self._compilado = (None, None)   # (versão do esquema, sql)
+        self._lock = threading.Lock()
+
+    def sql(self, snap):
+        versao, sql = self._compilado
+        if versao != snap.versao:
+            with self._lock:
+                versao, sql = self._compilado
+                if versao != snap.versao:
+                    sql = compilar(snap)
+                    self._compilado = (snap.versao, sql)
+        return sql
+
+    def ler(self, cursor, snap, raiz):
+        """(atualizado_em, documento JSON em texto) da raiz, numa única consulta"""
+        cursor.execute(self.sql(snap), {"raiz": str(raiz)})
+        row = cursor.fetchone()
+        if isinstance(row, dict):
+            return row["atualizado_em"], row["documento"]
+        return row[0], row[1]
+
+
+leitor_documento = LeitorDocumento()
@@ -0,0 +1,82 @@
+"""
+LOGS COM NÍVEL (logging da biblioteca padrão)
+
+    from logs import obter
+    log = obter("app")
+    log.info("raiz %s gravada em %.1f ms", raiz, ms)   # formatação só se o nível estiver ligado
+
+- LOG_LEVEL   DEBUG | INFO | WARNING | ERROR (padrão INFO)
+- LOG_FORMATO texto | json (padrão texto): em json cada linha é um objeto
+
+O logger "cisp.requisicao" escreve sempre uma linha JSON pura por requisição
+(ver rastreio.py); desligue com LOG_REQUISICOES=0 ou LOG_LEVEL=WARNING.
+"""
+
+import os
+import sys
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMATO = os.environ.get('LOG_FORMATO', 'texto').lower()
+LOG_REQUISICOES = os.environ.get('LOG_REQUISICOES', '1') not in ('0', 'false', 'False')
+
+RAIZ = "cisp"
+REQUISICAO = f"{RAIZ}.requisicao"
+
+_configurado = False
+_lock = threading.Lock()
+
+
+def _agora_iso():
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+
+
+class FormatoJSON(logging.Formatter):
+    def format(self, record):
+        linha = {
+            "ts": _agora_iso(),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            linha["excecao"] = self.formatException(record.exc_info)
+        return json.dumps(linha, ensure_ascii=False, default=str)
+
+
+def configurar():
+    """Instala os handlers uma vez por processo (idempotente)"""
+    global _configurado
+    if _configurado:
+        return
+    with _lock:
+        if _configurado:
+            return
+        raiz = logging.getLogger(RAIZ)
+        raiz.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+        handler = logging.StreamHandler(sys.stderr)
+        if LOG_FORMATO == "json":
+            handler.setFormatter(FormatoJSON())
+        else:
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        raiz.addHandler(handler)
+        raiz.propagate = False
+
+        # a linha da requisição já é JSON: sai como está, sem prefixo
+        req = logging.getLogger(REQUISICAO)
+        if not LOG_REQUISICOES:
+            req.setLevel(logging.CRITICAL + 1)
+        saida = logging.StreamHandler(sys.stderr)
+        saida.setFormatter(logging.Formatter("%(message)s"))
+        req.addHandler(saida)
+        req.propagate = False
+        _configurado = True
+
+
+def obter(nome):
+    """Logger "cisp.<nome>" já configurado"""
+    configurar()
+    return logging.getLogger(f"{RAIZ}.{nome}")
@@ -0,0 +1,267 @@
+"""
+SINCRONIZAÇÃO EM LOTE
+
+POST /api/sincronizar/lote recebe uma lista de raízes e devolve um job_id.
+O job roda em segundo plano:
+
+- LOTE_WORKERS threads buscam na CISP em paralelo, limitadas por
+  CISP_MAX_CONCORRENCIA_HOST requisições simultâneas ao mesmo host
+- uma thread gravadora consome os payloads e grava LOTE_TAMANHO_TRANSACAO
+  raízes por transação (SAVEPOINT por raiz: uma falha não derruba o lote)
+- GET /api/sincronizar/lote/<job_id> mostra o progresso e o status por raiz
+
+Os jobs ficam em memória no processo (os últimos LOTE_MAX_JOBS).
+"""
+
+import os
+import csv
+import io
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlparse
+
+from cliente_cisp import ErroCISP, CISPNaoEncontrada
+from metricas import DB_COMMIT
+
+LOTE_WORKERS = int(os.environ.get('LOTE_WORKERS', '8'))
+LOTE_MAX_WORKERS = int(os.environ.get('LOTE_MAX_WORKERS', '32'))
+CISP_MAX_CONCORRENCIA_HOST = int(os.environ.get('CISP_MAX_CONCORRENCIA_HOST', '4'))
+LOTE_TAMANHO_TRANSACAO = int(os.environ.get('LOTE_TAMANHO_TRANSACAO', '50'))
+LOTE_MAX_RAIZES = int(os.environ.get('LOTE_MAX_RAIZES', '20000'))
+LOTE_MAX_JOBS = int(os.environ.get('LOTE_MAX_JOBS', '50'))
+
+# Status possíveis de cada raiz dentro do job
+PENDENTE = "pendente"
+BUSCANDO = "buscando"
+GRAVANDO = "gravando"
+OK = "ok"
+NAO_ENCONTRADA = "nao_encontrada"
+ERRO = "erro"
+
+_FIM = object()
+
+
+def normalizar_raiz(valor):
+    """Mantém só dígitos; CNPJ completo vira raiz (8 primeiros dígitos)"""
+    digitos = "".join(ch for ch in str(valor or "") if ch.isdigit())
+    if len(digitos) >= 8:
+        return digitos[:8]
+    return None
+
+
+def raizes_de_csv(texto):
+    """Primeira coluna de cada linha; cabeçalhos e linhas inválidas são ignorados"""
+    raizes = []
+    amostra = texto[:1024]
+    try:
+        dialeto = csv.Sniffer().sniff(amostra, delimiters=",;\t")
+    except csv.Error:
+        dialeto = csv.excel
+    for linha in csv.reader(io.StringIO(texto), dialeto):
+        if linha:
+            raizes.append(linha[0])
+    return raizes
+
+
+def deduplicar(raizes):
+    vistas = OrderedDict()
+    for r in raizes:
+        n = normalizar_raiz(r)
+        if n:
+            vistas[n] = None
+    return list(vistas)
+
+
+class _LimitadorHost:
+    """Um semáforo por host: nunca mais que N requisições simultâneas ao mesmo servidor"""
+
+    def __init__(self, limite):
+        self.limite = max(1, limite)
+        self._sems = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url):
+        host = urlparse(url).netloc or url
+        with self._lock:
+            sem = self._sems.get(host)
+            if sem is None:
+                sem = self._sems[host] = threading.BoundedSemaphore(self.limite)
+        return sem
+
+
+limitador_host = _LimitadorHost(CISP_MAX_CONCORRENCIA_HOST)
+
+
+class JobLote:
+    def __init__(self, raizes, workers):
+        self.id = uuid.uuid4().hex
+        self.workers = workers
+        self.criado_em = datetime.now()
+        self.iniciado_em = None
+        self.finalizado_em = None
+        self.estado = "na_fila"
+        self.status = OrderedDict((r, {"status": PENDENTE}) for r in raizes)
+        self._lock = threading.Lock()
+
+    def marcar(self, raiz, status, **extra):
+        with self._lock:
+            self.status[raiz] = {"status": status, **extra}
+
+    def resumo(self, detalhar=True):
+        with self._lock:
+            contagem = {}
+            for info in self.status.values():
+                contagem[info["status"]] = contagem.get(info["status"], 0) + 1
+            total = len(self.status)
+            concluidas = sum(contagem.get(s, 0) for s in (OK, NAO_ENCONTRADA, ERRO))
+            decorrido = None
+            if self.iniciado_em:
+                decorrido = ((self.finalizado_em or datetime.now()) - self.iniciado_em).total_seconds()
+            out = {
+                "job_id": self.id,
+                "estado": self.estado,
+                "workers": self.workers,
+                "total": total,
+                "concluidas": concluidas,
+                "progresso": round(concluidas / total, 4) if total else 1.0,
+                "contagem": contagem,
+                "criado_em": self.criado_em.isoformat(),
+                "iniciado_em": self.iniciado_em.isoformat() if self.iniciado_em else None,
+                "finalizado_em": self.finalizado_em.isoformat() if self.finalizado_em else None,
+                "decorrido_s": round(decorrido, 3) if decorrido is not None else None,
+                "raizes_por_s": round(concluidas / decorrido, 3) if decorrido else None,
+            }
+            if detalhar:
+                out["raizes"] = {r: dict(info) for r, info in self.status.items()}
+            return out
+
+
+class GerenciadorLotes:
+    """
+    buscar(raiz) -> payload                (chamada à CISP, já com cache; falhas levantam ErroCISP)
+    gravar(cursor, raiz, payload)          (grava sem commit; dict opcional vai para o status)
+    conexao()                              (context manager do pool)
+    url_base                               (para o limite por host)
+    """
+
+    def __init__(self, buscar, gravar, conexao, url_base):
+        self.buscar = buscar
+        self.gravar = gravar
+        self.conexao = conexao
+        self.url_base = url_base
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def criar(self, raizes, workers=None):
+        raizes = deduplicar(raizes)
+        if not raizes:
+            raise ValueError("nenhuma raiz válida informada")
+        if len(raizes) > LOTE_MAX_RAIZES:
+            raise ValueError(f"máximo de {LOTE_MAX_RAIZES} raízes por lote")
+        workers = max(1, min(int(workers or LOTE_WORKERS), LOTE_MAX_WORKERS))
+        job = JobLote(raizes, workers)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > LOTE_MAX_JOBS:
+                antigo_id, antigo = next(iter(self._jobs.items()))
+                if antigo.estado in ("na_fila", "executando"):
+                    break
+                del self._jobs[antigo_id]
+        threading.Thread(target=self._executar, args=(job,), name=f"lote-{job.id[:8]}", daemon=True).start()
+        return job
+
+    def obter(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def listar(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [j.resumo(detalhar=False) for j in reversed(jobs)]
+
+    # ------------------------------------------------------------------
+    def _buscar(self, job, raiz, fila):
+        job.marcar(raiz, BUSCANDO)
+        inicio = time.monotonic()
+        try:
+            with limitador_host(self.url_base):
+                payload = self.buscar(raiz)
+        except ErroCISP as e:
+            latencia_ms = round((time.monotonic() - inicio) * 1000, 1)
+            if isinstance(e, CISPNaoEncontrada):
+                job.marcar(raiz, NAO_ENCONTRADA, latencia_ms=latencia_ms)
+            else:
+                job.marcar(raiz, ERRO, erro_tipo=e.tipo, erro=str(e), latencia_ms=latencia_ms)
+            return
+        except Exception as e:
+            job.marcar(raiz, ERRO, erro=str(e))
+            return
+        latencia_ms = round((time.monotonic() - inicio) * 1000, 1)
+        if not payload:
+            job.marcar(raiz, NAO_ENCONTRADA, latencia_ms=latencia_ms)
+            return
+        job.marcar(raiz, GRAVANDO, latencia_ms=latencia_ms)
+        fila.put((raiz, payload, latencia_ms))
+
+    def _gravador(self, job, fila):
+        pendentes = []
+        terminou = False
+        while not terminou:
+            try:
+                item = fila.get(timeout=1.0)
+            except queue.Empty:
+                item = None
+            if item is _FIM:
+                terminou = True
+            elif item is not None:
+                pendentes.append(item)
+            if pendentes and (terminou or item is None or len(pendentes) >= LOTE_TAMANHO_TRANSACAO):
+                self._gravar_transacao(job, pendentes)
+                pendentes = []
+
+    def _gravar_transacao(self, job, itens):
+        try:
+            with self.conexao() as conn:
+                cursor = conn.cursor()
+                gravadas = []
+                try:
+                    # ordem fixa de raiz: dois lotes concorrentes pegam os advisory locks na mesma ordem
+                    for raiz, payload, latencia_ms in sorted(itens, key=lambda i: i[0]):
+                        cursor.execute("SAVEPOINT lote_raiz")
+                        try:
+                            resultado = self.gravar(cursor, raiz, payload)
+                            cursor.execute("RELEASE SAVEPOINT lote_raiz")
+                            gravadas.append((raiz, latencia_ms, resultado))
+                        except Exception as e:
+                            cursor.execute("ROLLBACK TO SAVEPOINT lote_raiz")
+                            job.marcar(raiz, ERRO, erro=str(e), latencia_ms=latencia_ms)
+                    with DB_COMMIT.medir(contexto="lote"):
+                        conn.commit()
+                finally:
+                    cursor.close()
+            for raiz, latencia_ms, resultado in gravadas:
+                job.marcar(raiz, OK, latencia_ms=latencia_ms, **(resultado or {}))
+        except Exception as e:
+            for raiz, _, latencia_ms in itens:
+                job.marcar(raiz, ERRO, erro=f"falha na transação: {e}", latencia_ms=latencia_ms)
+
+    def _executar(self, job):
+        job.estado = "executando"
+        job.iniciado_em = datetime.now()
+        fila = queue.Queue(maxsize=LOTE_TAMANHO_TRANSACAO * 4)
+        gravador = threading.Thread(target=self._gravador, args=(job, fila), name=f"lote-grava-{job.id[:8]}", daemon=True)
+        gravador.start()
+        try:
+            with ThreadPoolExecutor(max_workers=job.workers, thread_name_prefix=f"lote-{job.id[:8]}") as ex:
+                for raiz in list(job.status):
+                    ex.submit(self._buscar, job, raiz, fila)
+        finally:
+            fila.put(_FIM)
+            gravador.join()
+            job.finalizado_em = datetime.now()
+            job.estado = "concluido"
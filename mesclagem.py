@@ -0,0 +1,70 @@
+"""
+MESCLAGEM (MERGE) DAS TABELAS FILHAS POR CHAVE NATURAL
+
+Em vez de "DELETE de todas as linhas da raiz + INSERT de tudo", compara o
+conjunto novo com o gravado pela chave natural da tabela (ex.: restritivas:
+codigo_associada, codigo_primeira_restritiva, data_ocorrencia) e aplica só a
+diferença, num único statement por tabela:
+
+- apaga as linhas da raiz cuja chave não veio no payload
+- atualiza as que vieram com algum valor diferente
+- insere as chaves novas
+
+Linhas iguais não são tocadas: mantêm id/ctid e não geram WAL nem bloat.
+Se o payload trouxer a mesma chave duas vezes, quem chama volta para o
+DELETE + INSERT (a chave não identifica a linha).
+"""
+
+from psycopg2.extras import execute_values
+
+
+def compilar(tabela, colunas, chave, col_raiz, tipos):
+    """
+    SQL do merge para execute_values (um único %s para os VALUES).
+    colunas inclui col_raiz e a chave; tipos = {coluna: tipo SQL}.
+    """
+    chave = tuple(chave)
+    demais = [c for c in colunas if c != col_raiz and c not in chave]
+    cols = ", ".join(colunas)
+    casts = ", ".join(f"v.{c}::{tipos.get(c, 'text')} AS {c}" for c in colunas)
+    casa = " AND ".join(
+        [f"t.{col_raiz} = e.{col_raiz}"] + [f"t.{c} IS NOT DISTINCT FROM e.{c}" for c in chave]
+    )
+    if demais:
+        atualizadas = (
+            f"UPDATE {tabela} t SET {', '.join(f'{c} = e.{c}' for c in demais)} FROM e "
+            f"WHERE {casa} AND ({', '.join('t.' + c for c in demais)}) "
+            f"IS DISTINCT FROM ({', '.join('e.' + c for c in demais)}) RETURNING 1"
+        )
+    else:
+        atualizadas = "SELECT 1 WHERE false"
+    return (
+        f"WITH v ({cols}) AS (VALUES %s),\n"
+        f"e AS (SELECT {casts} FROM v),\n"
+        f"apagadas AS (DELETE FROM {tabela} t WHERE t.{col_raiz} IN (SELECT {col_raiz} FROM e) "
+        f"AND NOT EXISTS (SELECT 1 FROM e WHERE {casa}) RETURNING 1),\n"
+        f"atualizadas AS ({atualizadas}),\n"
+        f"inseridas AS (INSERT INTO {tabela} ({cols}) SELECT {cols} FROM e "
+        f"WHERE NOT EXISTS (SELECT 1 FROM {tabela} t WHERE {casa}) RETURNING 1)\n"
+        f"SELECT (SELECT count(*) FROM inseridas), (SELECT count(*) FROM atualizadas), (SELECT count(*) FROM apagadas)"
+    )
+
+
+def chaves_unicas(linhas, indices):
+    vistas = set()
+    for linha in linhas:
+        k = tuple(linha[i] for i in indices)
+        if k in vistas:
+            return False
+        vistas.add(k)
+    return True
+
+
+def mesclar(cursor, sql, linhas):
+    """Aplica o merge (todas as linhas de UMA raiz, num statement só): {inseridas, atualizadas, apagadas}"""
+    if not linhas:
+        # sem VALUES não há raiz no statement: quem chama apaga as linhas da raiz
+        return {"inseridas": 0, "atualizadas": 0, "apagadas": 0}
+    row = execute_values(cursor, sql, linhas, page_size=max(1, len(linhas)), fetch=True)[0]
+    inseridas, atualizadas, apagadas = row.values() if isinstance(row, dict) else row
+    return {"inseridas": inseridas, "atualizadas": atualizadas, "apagadas": apagadas}
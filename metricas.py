@@ -0,0 +1,232 @@
+"""
+MÉTRICAS NO FORMATO PROMETHEUS (GET /metrics)
+
+Contadores, medidores e histogramas em memória, por processo, exportados no
+formato texto do Prometheus (sem dependências). Os pontos quentes já estão
+instrumentados:
+
+- cisp_upstream_segundos        cada chamada HTTP à CISP, por classe de status
+- cisp_busca_segundos           buscar_api_cisp (cache ou CISP, com retries)
+- db_conexao_segundos           espera por uma conexão do pool
+- db_consulta_segundos          statements por tabela e operação
+- db_commit_segundos            COMMIT por contexto (gravacao, lote)
+- inserir_no_postgres_segundos  gravação completa de uma raiz
+- db_linhas_gravadas_total      linhas por tabela filha (inseridas/atualizadas/apagadas)
+- http_requisicao_segundos      requisições por rota, método e status
+- cliente_documento_segundos    /api/cliente por origem do dado (banco, cache, cisp)
+
+Valores que já existem em outros módulos (pool, cache, threads do waitress)
+entram por coletores, lidos só na hora da exportação.
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+LIMITES_PADRAO = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _rotulos(nomes, valores, extra=None):
+    pares = list(zip(nomes, valores)) + (list(extra.items()) if extra else [])
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{n}="{_escapar(v)}"' for n, v in pares) + "}"
+
+
+def _numero(v):
+    if v == math.inf:
+        return "+Inf"
+    if isinstance(v, float) and v.is_integer():
+        return repr(v)
+    return str(v)
+
+
+class _Metrica:
+    tipo = None
+
+    def __init__(self, nome, ajuda, rotulos=()):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.rotulos = tuple(rotulos)
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def _chave(self, rotulos):
+        return tuple(str(rotulos.get(r, "")) for r in self.rotulos)
+
+    def _cabecalho(self):
+        return [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} {self.tipo}"]
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def inc(self, valor=1, **rotulos):
+        chave = self._chave(rotulos)
+        with self._lock:
+            self._valores[chave] = self._valores.get(chave, 0) + valor
+
+    def exportar(self):
+        with self._lock:
+            itens = sorted(self._valores.items())
+        return self._cabecalho() + [f"{self.nome}{_rotulos(self.rotulos, k)} {_numero(v)}" for k, v in itens]
+
+
+class Medidor(_Metrica):
+    tipo = "gauge"
+
+    def set(self, valor, **rotulos):
+        with self._lock:
+            self._valores[self._chave(rotulos)] = valor
+
+    def inc(self, valor=1, **rotulos):
+        chave = self._chave(rotulos)
+        with self._lock:
+            self._valores[chave] = self._valores.get(chave, 0) + valor
+
+    def dec(self, valor=1, **rotulos):
+        self.inc(-valor, **rotulos)
+
+    def total(self):
+        with self._lock:
+            return sum(self._valores.values())
+
+    def exportar(self):
+        with self._lock:
+            itens = sorted(self._valores.items())
+        return self._cabecalho() + [f"{self.nome}{_rotulos(self.rotulos, k)} {_numero(v)}" for k, v in itens]
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nome, ajuda, rotulos=(), limites=LIMITES_PADRAO):
+        super().__init__(nome, ajuda, rotulos)
+        self.limites = tuple(sorted(limites)) + (math.inf,)
+
+    def observar(self, valor, **rotulos):
+        chave = self._chave(rotulos)
+        with self._lock:
+            serie = self._valores.get(chave)
+            if serie is None:
+                serie = self._valores[chave] = [[0] * len(self.limites), 0.0, 0]
+            for i, limite in enumerate(self.limites):
+                if valor <= limite:
+                    serie[0][i] += 1
+                    break
+            serie[1] += valor
+            serie[2] += 1
+
+    @contextmanager
+    def medir(self, **rotulos):
+        """with h.medir(tabela=...): observa o tempo do bloco (também quando ele levanta exceção)"""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - inicio, **rotulos)
+
+    def exportar(self):
+        with self._lock:
+            itens = sorted((k, (list(s[0]), s[1], s[2])) for k, s in self._valores.items())
+        linhas = self._cabecalho()
+        for chave, (baldes, soma, contagem) in itens:
+            acumulado = 0
+            for limite, n in zip(self.limites, baldes):
+                acumulado += n
+                linhas.append(f"{self.nome}_bucket{_rotulos(self.rotulos, chave, {'le': _numero(limite)})} {acumulado}")
+            linhas.append(f"{self.nome}_sum{_rotulos(self.rotulos, chave)} {_numero(soma)}")
+            linhas.append(f"{self.nome}_count{_rotulos(self.rotulos, chave)} {contagem}")
+        return linhas
+
+
+class Registro:
+    def __init__(self):
+        self._metricas = []
+        self._coletores = []
+        self._lock = threading.Lock()
+
+    def _registrar(self, metrica):
+        with self._lock:
+            self._metricas.append(metrica)
+        return metrica
+
+    def contador(self, nome, ajuda, rotulos=()):
+        return self._registrar(Contador(nome, ajuda, rotulos))
+
+    def medidor(self, nome, ajuda, rotulos=()):
+        return self._registrar(Medidor(nome, ajuda, rotulos))
+
+    def histograma(self, nome, ajuda, rotulos=(), limites=LIMITES_PADRAO):
+        return self._registrar(Histograma(nome, ajuda, rotulos, limites))
+
+    def coletor(self, funcao):
+        """
+        funcao() -> [(nome, tipo, ajuda, [(rotulos dict, valor), ...]), ...]
+        chamada a cada exportação; falhas do coletor não derrubam o /metrics
+        """
+        with self._lock:
+            self._coletores.append(funcao)
+        return funcao
+
+    def exportar(self):
+        with self._lock:
+            metricas = list(self._metricas)
+            coletores = list(self._coletores)
+        linhas = []
+        for m in metricas:
+            linhas.extend(m.exportar())
+        for coletor in coletores:
+            try:
+                familias = coletor()
+            except Exception as e:
+                linhas.append(f"# coletor {getattr(coletor, '__name__', '?')} falhou: {_escapar(e)}")
+                continue
+            for nome, tipo, ajuda, amostras in familias:
+                linhas.append(f"# HELP {nome} {ajuda}")
+                linhas.append(f"# TYPE {nome} {tipo}")
+                for rotulos, valor in amostras:
+                    linhas.append(f"{nome}{_rotulos(tuple(rotulos), tuple(rotulos.values()))} {_numero(valor)}")
+        return "\n".join(linhas) + "\n"
+
+
+registro = Registro()
+
+# ----------------------------------------------------------------------
+# Métricas da aplicação
+
+CISP_UPSTREAM = registro.histograma(
+    "cisp_upstream_segundos", "Duração de cada chamada HTTP à CISP", ("classe",))
+CISP_BUSCA = registro.histograma(
+    "cisp_busca_segundos", "buscar_api_cisp: payload do cache ou da CISP (com retries)", ("origem",))
+DB_CONEXAO = registro.histograma(
+    "db_conexao_segundos", "Espera por uma conexão do pool (inclui abrir e validar)",
+    limites=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0, 10.0))
+DB_CONSULTA = registro.histograma(
+    "db_consulta_segundos", "Duração dos statements por tabela e operação", ("tabela", "operacao"))
+DB_COMMIT = registro.histograma(
+    "db_commit_segundos", "Duração do COMMIT", ("contexto",))
+GRAVACAO = registro.histograma(
+    "inserir_no_postgres_segundos", "Gravação completa de uma raiz (transação inteira)", ("resultado",))
+LINHAS_GRAVADAS = registro.contador(
+    "db_linhas_gravadas_total", "Linhas gravadas nas tabelas filhas", ("tabela", "operacao"))
+SECOES_INALTERADAS = registro.contador(
+    "db_secoes_inalteradas_total", "Seções do payload puladas por não terem mudado", ("tabela",))
+HTTP_DURACAO = registro.histograma(
+    "http_requisicao_segundos", "Duração das requisições HTTP", ("rota", "metodo", "status"))
+HTTP_EM_ANDAMENTO = registro.medidor(
+    "http_requisicoes_em_andamento", "Requisições HTTP sendo atendidas", ("rota",))
+CLIENTE_DOCUMENTO = registro.histograma(
+    "cliente_documento_segundos", "/api/cliente por origem do dado", ("origem",))
+
+
+def classe_status(status_http):
+    """200 -> "2xx"; sem resposta -> None"""
+    return f"{status_http // 100}xx" if status_http else None
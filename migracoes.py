@@ -0,0 +1,503 @@
+"""
+MIGRAÇÕES VERSIONADAS DAS TABELAS cisp_*
+
+O app se adapta às colunas que existirem (esquema.py), mas não criava as
+tabelas principais nem os índices de que os caminhos quentes dependem:
+toda gravação e leitura de tabela filha filtra pela raiz (DELETE/merge por
+raiz, subconsultas do documento em leitura.py) e, sem índice, cada uma lê
+a tabela inteira. As migrações criam o que faltar e registram cada versão
+aplicada em cisp_schema_versao:
+
+    1  tabelas principais (se não existirem), com chave primária
+    2  índice por raiz nas tabelas filhas e no log de sincronização
+    3  índice único em cisp_avaliacao_analitica (raiz): alvo do ON CONFLICT
+       do upsert da principal (esquema.py, inserir_generico do APIFLASK.py,
+       integração.py)
+    4  tabelas de apoio (assinaturas, watchlist, fila, arquivo, derivados,
+       histórico); o app não cria tabelas, só avisa das migrações pendentes
+       (ou não sobe, com CISP_EXIGIR_MIGRACOES=1)
+    5  índice (data_atualizacao, raiz) do feed de alterações
+
+Tabela que já existe não é alterada: as migrações só acrescentam índices.
+Índice equivalente já existente (mesmas colunas iniciais) é reaproveitado.
+
+    python migracoes.py status
+    python migracoes.py aplicar [--ate N] [--concorrente]
+    python migracoes.py verificar [--min-linhas N]
+
+--concorrente cria os índices com CREATE INDEX CONCURRENTLY (sem bloquear
+gravações, fora de transação); índice inválido deixado por uma tentativa
+interrompida é refeito. verificar lista migrações pendentes, tabelas sem
+chave primária, sem índice por raiz ou sem o alvo do ON CONFLICT, índices
+inválidos e tabelas com mais leituras sequenciais que por índice
+(pg_stat_user_tables); sai com 1 se houver problema.
+"""
+
+import os
+import sys
+import argparse
+
+from esquema import OPCOES_RAIZ
+from frescor import COLUNAS_ATUALIZACAO
+
+TABELA_VERSAO = "cisp_schema_versao"
+
+MIGRACOES_LOCK_TIMEOUT = os.environ.get('MIGRACOES_LOCK_TIMEOUT', '5s')
+# tabelas menores que isso podem ser lidas inteiras sem problema
+VERIFICAR_MIN_LINHAS = int(os.environ.get('VERIFICAR_MIN_LINHAS', '10000'))
+
+TABELA_PRINCIPAL = "cisp_avaliacao_analitica"
+TABELA_LOG = "cisp_log_sincronizacao"
+
+# Filtradas pela raiz a cada gravação/leitura (TABELAS_FILHAS do app.py)
+TABELAS_FILHAS = [
+    "cisp_restritivas",
+    "cisp_alertas",
+    "cisp_consultas_mensais",
+    "cisp_associadas_consultaram",
+    "cisp_associadas_nao_concederam_credito",
+]
+# Contadas por raiz no documento (CONTAGENS de leitura.py), se existirem
+TABELAS_OPCIONAIS = ["cisp_cheques_sem_fundo", "cisp_titulos_protesto", TABELA_LOG]
+
+SQL_CRIAR_VERSAO = f"""
+    CREATE TABLE IF NOT EXISTS {TABELA_VERSAO} (
+        versao integer PRIMARY KEY,
+        nome text NOT NULL,
+        aplicada_em timestamp NOT NULL DEFAULT now()
+    )
+"""
+
+# Colunas com os nomes preferidos dos specs do app.py (primeira candidata de cada entrada)
+SQL_TABELAS_PRINCIPAIS = [
+    f"""
+    CREATE TABLE IF NOT EXISTS {TABELA_PRINCIPAL} (
+        raiz text PRIMARY KEY,
+        cnpj text,
+        razao_social text,
+        nome_fantasia text,
+        data_fundacao date,
+        data_inclusao_cisp date,
+        endereco text,
+        bairro text,
+        cidade text,
+        uf text,
+        cep text,
+        telefone text,
+        email text,
+        capital_social numeric,
+        cnae text,
+        descricao_atividade_fiscal text,
+        situacao_receita_federal text,
+        data_situacao_cadastral date,
+        rating_atual text,
+        descricao_rating text,
+        valor_total_debito_atual numeric,
+        valor_total_debito_vencido_05dias numeric,
+        valor_total_debito_vencido_15dias numeric,
+        valor_total_debito_vencido_30dias numeric,
+        qtd_associadas_debito_atual integer,
+        qtd_associadas_debito_vencido_05dias integer,
+        qtd_associadas_debito_vencido_15dias integer,
+        qtd_associadas_debito_vencido_30dias integer,
+        valor_total_limite_credito numeric,
+        valor_total_maior_acumulo numeric,
+        qtd_associadas_informacoes_negociais integer,
+        qtd_associadas_limite_credito integer,
+        qtd_associadas_maior_acumulo integer,
+        qtd_associadas_vendas_ultimos_2meses integer,
+        data_maior_acumulo date,
+        data_ultima_compra date,
+        codigo_associada_ultima_compra integer,
+        ultima_atualizacao timestamp,
+        data_atualizacao timestamp
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cisp_restritivas (
+        id bigserial PRIMARY KEY,
+        raiz text NOT NULL,
+        codigo_associada integer,
+        razao_social text,
+        codigo_primeira_restritiva integer,
+        descricao_primeira_restritiva text,
+        codigo_segunda_restritiva integer,
+        descricao_segunda_restritiva text,
+        data_ocorrencia date,
+        data_informacao date
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cisp_alertas (
+        id bigserial PRIMARY KEY,
+        raiz text NOT NULL,
+        codigo_alerta integer,
+        descricao_alerta text,
+        associada_informante text,
+        razao_social text,
+        data_atualizacao timestamp
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cisp_consultas_mensais (
+        id bigserial PRIMARY KEY,
+        raiz text NOT NULL,
+        mes_ano text,
+        quantidade_consultas integer
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cisp_associadas_consultaram (
+        id bigserial PRIMARY KEY,
+        raiz text NOT NULL,
+        codigo_associada integer,
+        razao_social text
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cisp_associadas_nao_concederam_credito (
+        id bigserial PRIMARY KEY,
+        raiz text NOT NULL,
+        codigo_associada integer,
+        razao_social text
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS {TABELA_LOG} (
+        id bigserial PRIMARY KEY,
+        raiz text,
+        data_hora timestamp NOT NULL DEFAULT now(),
+        status text,
+        mensagem text
+    )
+    """,
+]
+
+# Índices de cada tabela (nome -> válido?, colunas-chave, único?, parcial?)
+SQL_INDICES = """
+    SELECT ci.relname AS indice, i.indisvalid AS valido, i.indisunique AS unico,
+           i.indisprimary AS primaria, i.indpred IS NOT NULL AS parcial,
+           array_agg(a.attname::text ORDER BY k.ord) AS colunas
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indrelid
+    JOIN pg_class ci ON ci.oid = i.indexrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, ord)
+    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = k.attnum
+    WHERE n.nspname = current_schema() AND c.relname = %s AND k.ord <= i.indnkeyatts
+    GROUP BY ci.relname, i.indisvalid, i.indisunique, i.indisprimary, i.indpred
+"""
+
+SQL_COLUNAS = """
+    SELECT a.attname::text FROM pg_attribute a
+    WHERE a.attrelid = to_regclass(%s) AND a.attnum > 0 AND NOT a.attisdropped
+    ORDER BY a.attnum
+"""
+
+# Tabelas cisp_* (sem partições; a tabela particionada soma as suas) e o uso de índice
+SQL_ESTATISTICAS = r"""
+    SELECT c.relname AS tabela,
+           sum(s.seq_scan) AS seq_scan, sum(s.seq_tup_read) AS seq_tup_read,
+           sum(COALESCE(s.idx_scan, 0)) AS idx_scan, sum(s.n_live_tup) AS linhas
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_inherits h ON h.inhparent = c.oid
+    JOIN pg_stat_user_tables s ON s.relid = COALESCE(h.inhrelid, c.oid)
+    WHERE n.nspname = current_schema() AND c.relname LIKE 'cisp\_%' AND NOT c.relispartition
+      AND c.relkind IN ('r', 'p')
+    GROUP BY c.relname
+    ORDER BY sum(s.seq_tup_read) DESC
+"""
+
+
+class ErroMigracao(Exception):
+    pass
+
+
+def _linha(row, *nomes):
+    return tuple(row[n] for n in nomes) if isinstance(row, dict) else tuple(row)
+
+
+def existe(cursor, tabela):
+    cursor.execute("SELECT to_regclass(%s) AS tabela", (tabela,))
+    return _linha(cursor.fetchone(), "tabela")[0] is not None
+
+
+def colunas(cursor, tabela):
+    cursor.execute(SQL_COLUNAS, (tabela,))
+    return [_linha(r, "attname")[0] for r in cursor.fetchall()]
+
+
+def coluna_raiz(cursor, tabela):
+    cols = colunas(cursor, tabela)
+    return next((c for c in OPCOES_RAIZ if c in cols), None)
+
+
+def indices(cursor, tabela):
+    """[{"indice", "valido", "unico", "primaria", "parcial", "colunas"}] da tabela"""
+    cursor.execute(SQL_INDICES, (tabela,))
+    nomes = ("indice", "valido", "unico", "primaria", "parcial", "colunas")
+    return [dict(zip(nomes, _linha(r, *nomes))) for r in cursor.fetchall()]
+
+
+def indice_equivalente(lista, cols, unico=False):
+    """Índice válido e não parcial que começa pelas colunas (único: exatamente elas)"""
+    for ind in lista:
+        if not ind["valido"] or ind["parcial"]:
+            continue
+        if unico:
+            if ind["unico"] and list(ind["colunas"]) == list(cols):
+                return ind
+        elif list(ind["colunas"][:len(cols)]) == list(cols):
+            return ind
+    return None
+
+
+def criar_indice(cursor, tabela, cols, nome, unico=False, concorrente=False):
+    """
+    Cria o índice se não houver um equivalente; devolve True se criou.
+    Um índice inválido com o mesmo nome (CONCURRENTLY interrompido) é apagado e refeito.
+    """
+    lista = indices(cursor, tabela)
+    if indice_equivalente(lista, cols, unico):
+        return False
+    modo = "CONCURRENTLY " if concorrente else ""
+    if any(i["indice"] == nome and not i["valido"] for i in lista):
+        cursor.execute(f"DROP INDEX {modo}{nome}")
+    cursor.execute(f"CREATE {'UNIQUE ' if unico else ''}INDEX {modo}IF NOT EXISTS {nome} ON {tabela} ({', '.join(cols)})")
+    return True
+
+
+# ----------------------------------------------------------------------
+# Migrações: funcao(cursor, concorrente) -> lista do que foi feito
+
+def _tabelas_principais(cursor, concorrente):
+    feito = []
+    for sql in SQL_TABELAS_PRINCIPAIS:
+        tabela = sql.split("IF NOT EXISTS", 1)[1].split("(", 1)[0].strip()
+        if not existe(cursor, tabela):
+            cursor.execute(sql)
+            feito.append(f"criada {tabela}")
+    return feito
+
+
+def _indices_raiz(cursor, concorrente):
+    feito = []
+    for tabela in TABELAS_FILHAS + TABELAS_OPCIONAIS:
+        if not existe(cursor, tabela):
+            continue
+        col = coluna_raiz(cursor, tabela)
+        if col and criar_indice(cursor, tabela, [col], f"{tabela}_raiz_idx", concorrente=concorrente):
+            feito.append(f"índice {tabela} ({col})")
+    return feito
+
+
+def _alvo_conflito_principal(cursor, concorrente):
+    if not existe(cursor, TABELA_PRINCIPAL):
+        return []
+    col = coluna_raiz(cursor, TABELA_PRINCIPAL)
+    if not col or indice_equivalente(indices(cursor, TABELA_PRINCIPAL), [col], unico=True):
+        return []
+    cursor.execute(
+        f"SELECT count(*) FROM (SELECT 1 FROM {TABELA_PRINCIPAL} GROUP BY {col} HAVING count(*) > 1) d"
+    )
+    repetidas = _linha(cursor.fetchone(), "count")[0]
+    if repetidas:
+        raise ErroMigracao(
+            f"{TABELA_PRINCIPAL} tem {repetidas} raízes repetidas: apague as linhas duplicadas "
+            f"(mantendo a de data_atualizacao mais recente) e rode de novo"
+        )
+    criar_indice(cursor, TABELA_PRINCIPAL, [col], f"{TABELA_PRINCIPAL}_raiz_key", unico=True, concorrente=concorrente)
+    return [f"índice único {TABELA_PRINCIPAL} ({col})"]
+
+
+def _tabelas_de_apoio(cursor, concorrente):
+    # a DDL fica em cada módulo (garantir_tabela); só esta migração a executa
+    import assinatura
+    import agendador
+    import fila
+    import arquivo_cisp
+    import derivados
+    import historico
+
+    feito = []
+    for modulo, tabelas in (
+        (assinatura, [assinatura.TABELA_HASH]),
+        (agendador, [agendador.TABELA_WATCHLIST]),
+        (fila, [fila.TABELA_JOBS]),
+        (arquivo_cisp, [arquivo_cisp.TABELA_RAW]),
+        (derivados, derivados.TABELAS),
+        (historico, [historico.TABELA_HISTORICO]),
+    ):
+        faltando = [t for t in tabelas if not existe(cursor, t)]
+        modulo.garantir_tabela(cursor)
+        feito.extend(f"criada {t}" for t in faltando)
+    return feito
+
+
+def _indice_alteracoes(cursor, concorrente):
+    if not existe(cursor, TABELA_PRINCIPAL):
+        return []
+    cols = colunas(cursor, TABELA_PRINCIPAL)
+    col_data = next((c for c in COLUNAS_ATUALIZACAO if c in cols), None)
+    col_raiz = coluna_raiz(cursor, TABELA_PRINCIPAL)
+    if not (col_data and col_raiz):
+        return []
+    if criar_indice(cursor, TABELA_PRINCIPAL, [col_data, col_raiz], f"{TABELA_PRINCIPAL}_alteracoes_idx", concorrente=concorrente):
+        return [f"índice {TABELA_PRINCIPAL} ({col_data}, {col_raiz})"]
+    return []
+
+
+# (versão, nome, função, transacional); não transacional = pode usar CREATE INDEX CONCURRENTLY
+MIGRACOES = [
+    (1, "tabelas principais", _tabelas_principais, True),
+    (2, "índice por raiz nas tabelas filhas", _indices_raiz, False),
+    (3, "índice único da raiz na principal (alvo do ON CONFLICT)", _alvo_conflito_principal, False),
+    (4, "tabelas de apoio", _tabelas_de_apoio, True),
+    (5, "índice do feed de alterações", _indice_alteracoes, False),
+]
+VERSAO_ATUAL = MIGRACOES[-1][0]
+
+
+def aplicadas(cursor):
+    """{versão: aplicada_em}"""
+    if not existe(cursor, TABELA_VERSAO):
+        return {}
+    cursor.execute(f"SELECT versao, aplicada_em FROM {TABELA_VERSAO}")
+    return dict(_linha(r, "versao", "aplicada_em") for r in cursor.fetchall())
+
+
+def pendentes(cursor):
+    feitas = aplicadas(cursor)
+    return [m for m in MIGRACOES if m[0] not in feitas]
+
+
+def aplicar(conn, ate=None, concorrente=False, saida=print):
+    """
+    Aplica as migrações pendentes em ordem, uma transação por versão (as de
+    índice em autocommit com concorrente=True). Um advisory lock impede duas
+    execuções ao mesmo tempo. Devolve as versões aplicadas.
+    """
+    cursor = conn.cursor()
+    feitas = []
+    try:
+        cursor.execute("SELECT pg_advisory_lock(hashtext(%s))", (TABELA_VERSAO,))
+        cursor.execute("SET lock_timeout = %s", (MIGRACOES_LOCK_TIMEOUT,))
+        cursor.execute(SQL_CRIAR_VERSAO)
+        conn.commit()
+        ja = aplicadas(cursor)
+        conn.commit()
+        for versao, nome, funcao, transacional in MIGRACOES:
+            if versao in ja or (ate is not None and versao > ate):
+                continue
+            usar_concorrente = concorrente and not transacional
+            conn.autocommit = usar_concorrente
+            try:
+                feito = funcao(cursor, usar_concorrente)
+                cursor.execute(f"INSERT INTO {TABELA_VERSAO} (versao, nome) VALUES (%s, %s)", (versao, nome))
+                if not usar_concorrente:
+                    conn.commit()
+            except Exception:
+                if not usar_concorrente:
+                    conn.rollback()
+                raise
+            finally:
+                conn.autocommit = False
+            feitas.append(versao)
+            saida(f"✓ {versao:>3} {nome}" + (f": {'; '.join(feito)}" if feito else " (nada a criar)"))
+    finally:
+        conn.rollback()
+        cursor.execute("RESET lock_timeout")
+        cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))", (TABELA_VERSAO,))
+        conn.commit()
+        cursor.close()
+    return feitas
+
+
+# ----------------------------------------------------------------------
+# Verificação
+
+def verificar(cursor, min_linhas=VERIFICAR_MIN_LINHAS):
+    """[(nível, mensagem)] com nível "erro" (falta algo) ou "aviso" (vale olhar)"""
+    achados = []
+    for versao, nome, _, _ in pendentes(cursor):
+        achados.append(("erro", f"migração {versao} pendente: {nome}"))
+
+    for tabela in [TABELA_PRINCIPAL] + TABELAS_FILHAS + TABELAS_OPCIONAIS:
+        if not existe(cursor, tabela):
+            if tabela not in TABELAS_OPCIONAIS:
+                achados.append(("erro", f"{tabela} não existe"))
+            continue
+        lista = indices(cursor, tabela)
+        col = coluna_raiz(cursor, tabela)
+        for ind in lista:
+            if not ind["valido"]:
+                achados.append(("erro", f"{tabela}: índice {ind['indice']} inválido (CONCURRENTLY interrompido?)"))
+        if not any(i["primaria"] for i in lista):
+            achados.append(("aviso", f"{tabela} sem chave primária"))
+        if col is None:
+            achados.append(("erro", f"{tabela} sem coluna raiz ({', '.join(OPCOES_RAIZ)})"))
+        elif tabela == TABELA_PRINCIPAL:
+            if not indice_equivalente(lista, [col], unico=True):
+                achados.append(("erro", f"{tabela} sem índice único em ({col}): sem alvo para o ON CONFLICT, o upsert vira insert"))
+        elif not indice_equivalente(lista, [col]):
+            achados.append(("erro", f"{tabela} sem índice por {col}: cada DELETE/consulta da raiz lê a tabela inteira"))
+
+    cursor.execute(SQL_ESTATISTICAS)
+    for row in cursor.fetchall():
+        tabela, seq, lidas, idx, linhas = _linha(row, "tabela", "seq_scan", "seq_tup_read", "idx_scan", "linhas")
+        if linhas is not None and linhas >= min_linhas and seq and seq > (idx or 0):
+            achados.append((
+                "aviso",
+                f"{tabela}: {seq} leituras sequenciais x {idx or 0} por índice "
+                f"({int(lidas / seq)} linhas por leitura, {linhas} linhas na tabela)",
+            ))
+    return achados
+
+
+if __name__ == '__main__':
+    from banco import conexao
+
+    parser = argparse.ArgumentParser(description="Migrações versionadas das tabelas cisp_*")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    sub.add_parser("status", help="versões aplicadas e pendentes")
+    p_aplicar = sub.add_parser("aplicar", help="aplica as migrações pendentes")
+    p_aplicar.add_argument("--ate", type=int, help="aplica só até esta versão")
+    p_aplicar.add_argument("--concorrente", action="store_true",
+                           help="cria índices com CREATE INDEX CONCURRENTLY (não bloqueia gravações)")
+    p_verificar = sub.add_parser("verificar", help="índices faltando e leituras sequenciais (pg_stat_user_tables)")
+    p_verificar.add_argument("--min-linhas", type=int, default=VERIFICAR_MIN_LINHAS,
+                             help=f"ignora tabelas menores que isso nas estatísticas (padrão {VERIFICAR_MIN_LINHAS})")
+    args = parser.parse_args()
+
+    with conexao() as conn:
+        if args.comando == "aplicar":
+            try:
+                feitas = aplicar(conn, ate=args.ate, concorrente=args.concorrente)
+            except Exception as e:
+                print(f"✗ {e}")
+                sys.exit(1)
+            print(f"{len(feitas)} migração(ões) aplicada(s); versão atual do código: {VERSAO_ATUAL}")
+            sys.exit(0)
+
+        cursor = conn.cursor()
+        try:
+            if args.comando == "status":
+                feitas = aplicadas(cursor)
+                for versao, nome, _, _ in MIGRACOES:
+                    quando = feitas.get(versao)
+                    print(f"{'✓' if quando else '·'} {versao:>3} {nome}" + (f" ({quando:%Y-%m-%d %H:%M})" if quando else " — pendente"))
+                codigo = 0
+            else:
+                achados = verificar(cursor, args.min_linhas)
+                for nivel, mensagem in achados:
+                    print(f"{'✗' if nivel == 'erro' else '⚠'} {mensagem}")
+                if any("leituras sequenciais" in m for _, m in achados):
+                    print("  (contadores de pg_stat_user_tables acumulados desde o último pg_stat_reset())")
+                erros = sum(1 for nivel, _ in achados if nivel == "erro")
+                print(f"{erros} problema(s), {len(achados) - erros} aviso(s)" if achados else "✓ esquema em dia")
+                codigo = 1 if erros else 0
+        finally:
+            cursor.close()
+            conn.rollback()
+    sys.exit(codigo)
@@ -0,0 +1,194 @@
+"""
+RASTREIO POR REQUISIÇÃO (Server-Timing + log estruturado)
+
+Cada requisição ganha um id (X-Request-Id recebido, ou um novo) e uma lista
+de spans medidos no caminho quente:
+
+- pool               espera por conexão (banco.py)
+- cisp               buscar_api_cisp: cache ou CISP, com retries (desc = origem)
+- sincronizar        busca + gravação sob o single-flight (inclui espera por outra thread)
+- gravar             transação inteira; gravar.lock, gravar.principal,
+                     gravar.<seção> por tabela filha, gravar.hash, gravar.commit
+- ler                documento do banco (principal + listas numa consulta, ver leitura.py)
+- json.ler / json    decodificação do documento / serialização da resposta
+
+Na resposta:  Server-Timing: cisp;dur=812.4;desc="cisp", gravar;dur=35.1, ..., total;dur=860.2
+No log:       uma linha JSON por requisição no logger cisp.requisicao (ver logs.py)
+
+Spans com o mesmo nome são somados (desc ganha "<n>x"). Threads fora da
+requisição (lotes, agendador, fila) não têm rastreio ativo e span() é um
+no-op. RASTREIO=0 desliga tudo: span() devolve um contexto nulo compartilhado.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import contextvars
+from contextlib import nullcontext
+from datetime import datetime, timezone
+
+from logs import REQUISICAO, configurar
+
+RASTREIO = os.environ.get('RASTREIO', '1') not in ('0', 'false', 'False')
+
+HEADER_ID = "X-Request-Id"
+_ID_VALIDO = re.compile(r"^[A-Za-z0-9._:-]{1,64}$")
+
+_atual = contextvars.ContextVar("rastreio", default=None)
+_NULO = nullcontext()
+
+configurar()
+log_requisicao = logging.getLogger(REQUISICAO)
+
+
+class Rastreio:
+    __slots__ = ("id", "inicio", "spans", "atributos")
+
+    def __init__(self, id_requisicao):
+        self.id = id_requisicao
+        self.inicio = time.perf_counter()
+        self.spans = []
+        self.atributos = {}
+
+    def registrar(self, nome, segundos, desc=None):
+        self.spans.append((nome, segundos, desc))
+
+    def agregados(self):
+        """[(nome, ms, desc)] na ordem do primeiro span de cada nome"""
+        por_nome = {}
+        for nome, segundos, desc in self.spans:
+            atual = por_nome.get(nome)
+            if atual is None:
+                por_nome[nome] = [segundos, 1, desc]
+            else:
+                atual[0] += segundos
+                atual[1] += 1
+        saida = []
+        for nome, (segundos, n, desc) in por_nome.items():
+            if n > 1:
+                desc = f"{n}x" if desc is None else f"{desc} {n}x"
+            saida.append((nome, round(segundos * 1000, 1), desc))
+        return saida
+
+    def total_ms(self):
+        return round((time.perf_counter() - self.inicio) * 1000, 1)
+
+
+class _Span:
+    __slots__ = ("rastreio", "nome", "desc", "inicio")
+
+    def __init__(self, rastreio, nome, desc):
+        self.rastreio = rastreio
+        self.nome = nome
+        self.desc = desc
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc):
+        self.rastreio.registrar(self.nome, time.perf_counter() - self.inicio, self.desc)
+        return False
+
+
+def atual():
+    return _atual.get()
+
+
+def span(nome, desc=None):
+    """with span("gravar"): ... — no-op fora de uma requisição rastreada"""
+    r = _atual.get()
+    if r is None:
+        return _NULO
+    return _Span(r, nome, desc)
+
+
+def registrar(nome, segundos, desc=None):
+    """Span já medido por quem chama (ex.: junto de uma métrica)"""
+    r = _atual.get()
+    if r is not None:
+        r.registrar(nome, segundos, desc)
+
+
+def anotar(**atributos):
+    """Campos extras na linha de log da requisição (ex.: origem do dado)"""
+    r = _atual.get()
+    if r is not None:
+        r.atributos.update(atributos)
+
+
+def _id_recebido(valor):
+    return valor if valor and _ID_VALIDO.match(valor) else None
+
+
+def iniciar(id_requisicao=None):
+    r = Rastreio(_id_recebido(id_requisicao) or uuid.uuid4().hex)
+    return r, _atual.set(r)
+
+
+def encerrar(token):
+    _atual.reset(token)
+
+
+def _desc(texto):
+    return '"' + str(texto).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def server_timing(r, total_ms=None):
+    partes = []
+    for nome, ms, desc in r.agregados():
+        partes.append(f"{nome};dur={ms}" + (f";desc={_desc(desc)}" if desc else ""))
+    partes.append(f"total;dur={r.total_ms() if total_ms is None else total_ms}")
+    return ", ".join(partes)
+
+
+def linha_log(r, request, resp, total_ms):
+    linha = {
+        "ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+        "request_id": r.id,
+        "metodo": request.method,
+        "caminho": request.path,
+        "rota": request.url_rule.rule if request.url_rule is not None else None,
+        "status": resp.status_code,
+        "duracao_ms": total_ms,
+        "bytes": resp.content_length,
+        "spans": {nome: ms for nome, ms, _ in r.agregados()},
+    }
+    if request.view_args:
+        linha.update({k: v for k, v in request.view_args.items() if k not in linha})
+    linha.update(r.atributos)
+    return json.dumps(linha, ensure_ascii=False, default=str)
+
+
+def instalar(app):
+    """Registra os hooks do Flask: id + spans por requisição, Server-Timing e linha de log"""
+    if not RASTREIO:
+        return app
+    from flask import g, request
+
+    @app.before_request
+    def _rastreio_inicio():
+        g.rastreio, g.rastreio_token = iniciar(request.headers.get(HEADER_ID))
+
+    @app.after_request
+    def _rastreio_fim(resp):
+        r = g.get("rastreio")
+        if r is None:
+            return resp
+        total = r.total_ms()
+        resp.headers[HEADER_ID] = r.id
+        resp.headers["Server-Timing"] = server_timing(r, total)
+        if log_requisicao.isEnabledFor(logging.INFO):
+            log_requisicao.info(linha_log(r, request, resp, total))
+        return resp
+
+    @app.teardown_request
+    def _rastreio_liberar(_erro=None):
+        token = g.pop("rastreio_token", None)
+        if token is not None:
+            encerrar(token)
+
+    return app
@@ -0,0 +1,248 @@
+"""
+REPROCESSAMENTO A PARTIR DO ARQUIVO DE PAYLOADS (sem chamar a CISP)
+
+Relê a última versão de cada raiz em cisp_payload_raw (arquivo_cisp.py) e
+roda de novo o mapeamento e a gravação (gravar_payload do app.py) em
+processos paralelos. Serve para quando muda o mapeamento, aparece coluna
+nova em cisp_avaliacao_analitica ou muda a agregação de positivaSegmentos:
+a carteira inteira é regravada sem nenhuma requisição à CISP.
+
+    python reprocessar.py                               # carteira inteira
+    python reprocessar.py 45543915 37608058             # só essas raízes
+    python reprocessar.py --arquivo raizes.csv
+    python reprocessar.py --desde 2026-01-01 --ate 2026-02-01
+    python reprocessar.py --processos 8 --lote 200
+
+--desde/--ate filtram pela data da última versão de cada raiz (nunca grava
+uma versão mais velha por cima de uma mais nova). data_atualizacao recebe o
+buscado_em do arquivo: dado reprocessado não parece mais fresco do que é.
+
+O processo principal lê o arquivo num cursor nomeado e distribui lotes de
+--lote raízes (corpos ainda comprimidos) aos processos; cada processo grava
+o lote numa transação, com um SAVEPOINT por raiz.
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from banco import conexao
+from lote import raizes_de_csv, deduplicar
+from arquivo_cisp import TABELA_RAW, descomprimir
+
+PROCESSOS_PADRAO = max(1, (os.cpu_count() or 2) - 1)
+ITENS_POR_LEITURA = 2000
+
+# Última versão de cada raiz (índice (raiz, buscado_em DESC)); o filtro de data vem depois
+SQL_VERSOES = f"""
+    SELECT raiz, buscado_em, tamanho, corpo FROM (
+        SELECT DISTINCT ON (raiz) raiz, buscado_em, tamanho, corpo
+        FROM {TABELA_RAW} {{onde_raiz}}
+        ORDER BY raiz, buscado_em DESC
+    ) u {{onde_data}}
+"""
+
+
+def _consulta(raizes=None, desde=None, ate=None, colunas=None):
+    params = {"raizes": list(raizes or []), "desde": desde, "ate": ate}
+    onde_raiz = "WHERE raiz = ANY(%(raizes)s)" if raizes else ""
+    datas = []
+    if desde:
+        datas.append("buscado_em >= %(desde)s")
+    if ate:
+        datas.append("buscado_em < %(ate)s")
+    sql = SQL_VERSOES.format(onde_raiz=onde_raiz, onde_data=("WHERE " + " AND ".join(datas)) if datas else "")
+    if colunas:
+        sql = f"SELECT {colunas} FROM ({sql}) v"
+    return sql, params
+
+
+def contar(raizes=None, desde=None, ate=None):
+    """(raízes, bytes do JSON) que serão reprocessados"""
+    sql, params = _consulta(raizes, desde, ate, colunas="count(*), coalesce(sum(tamanho), 0)")
+    with conexao() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            n, tamanho = cursor.fetchone()
+        finally:
+            cursor.close()
+        conn.rollback()
+    return n, int(tamanho)
+
+
+def ler_versoes(raizes=None, desde=None, ate=None, lote=100):
+    """Gera listas de (raiz, buscado_em, bytes do JSON, corpo comprimido) com até `lote` itens, em streaming"""
+    sql, params = _consulta(raizes, desde, ate)
+    with conexao() as conn:
+        cursor = conn.cursor(name="reprocessar_versoes")
+        cursor.itersize = ITENS_POR_LEITURA
+        try:
+            cursor.execute(sql, params)
+            atual = []
+            for raiz, buscado_em, tamanho, corpo in cursor:
+                atual.append((raiz, buscado_em, tamanho, bytes(corpo)))
+                if len(atual) >= lote:
+                    yield atual
+                    atual = []
+            if atual:
+                yield atual
+        finally:
+            cursor.close()
+            conn.rollback()
+
+
+# ----------------------------------------------------------------------
+# Processos de gravação
+
+_app = None
+_forcar = True
+
+
+def _iniciar_processo(forcar):
+    """Cada processo importa o app (mapeadores, pool próprio); nada de agendador aqui"""
+    global _app, _forcar
+    os.environ["AGENDA_NO_PROCESSO"] = "0"
+    import app
+    _app = app
+    _forcar = forcar
+
+
+def _local(momento):
+    """timestamptz -> datetime local sem fuso (como o datetime.now() da sincronização)"""
+    return momento.astimezone().replace(tzinfo=None) if momento.tzinfo else momento
+
+
+def _reprocessar_lote(itens):
+    """Grava um lote numa transação; devolve contagens e as falhas (raiz, erro)"""
+    resultado = {"ok": 0, "bytes": 0, "linhas": 0, "falhas": []}
+    with _app.conexao() as conn:
+        cursor = conn.cursor()
+        try:
+            for raiz, buscado_em, tamanho, corpo in itens:
+                cursor.execute("SAVEPOINT reprocessar")
+                try:
+                    dados = descomprimir(corpo)
+                    gravou = _app.gravar_payload(cursor, raiz, dados, forcar=_forcar, obtido_em=_local(buscado_em))
+                    cursor.execute("RELEASE SAVEPOINT reprocessar")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT reprocessar")
+                    resultado["falhas"].append((raiz, str(e).strip()))
+                    continue
+                resultado["ok"] += 1
+                resultado["bytes"] += tamanho
+                resultado["linhas"] += sum(sum(c.values()) for c in gravou["linhas"].values())
+            conn.commit()
+        finally:
+            cursor.close()
+    return resultado
+
+
+# ----------------------------------------------------------------------
+
+class Vazao:
+    def __init__(self, total):
+        self.total = total
+        self.inicio = time.monotonic()
+        self.ok = 0
+        self.falhas = 0
+        self.bytes = 0
+        self.linhas = 0
+
+    def somar(self, r):
+        self.ok += r["ok"]
+        self.falhas += len(r["falhas"])
+        self.bytes += r["bytes"]
+        self.linhas += r["linhas"]
+
+    def linha(self):
+        decorrido = time.monotonic() - self.inicio
+        feitas = self.ok + self.falhas
+        taxa = feitas / decorrido if decorrido else 0.0
+        eta = f"{(self.total - feitas) / taxa / 60:.1f}min" if taxa else "-"
+        return (
+            f"{feitas}/{self.total} | {taxa:.1f} raízes/s | "
+            f"{self.bytes / 1e6 / decorrido if decorrido else 0:.2f} MB/s de JSON | "
+            f"{self.linhas / decorrido if decorrido else 0:.0f} linhas/s | falhas={self.falhas} | ETA {eta}"
+        )
+
+
+def reprocessar(raizes=None, desde=None, ate=None, processos=PROCESSOS_PADRAO, lote=100, forcar=True, intervalo=10.0):
+    """Reprocessa as versões arquivadas; devolve a Vazao final"""
+    total, _ = contar(raizes, desde, ate)
+    vazao = Vazao(total)
+    if not total:
+        return vazao
+    contexto = multiprocessing.get_context("spawn")
+    em_voo = set()
+    ultimo_relatorio = time.monotonic()
+
+    def colher(feitos):
+        for f in feitos:
+            em_voo.discard(f)
+            r = f.result()
+            vazao.somar(r)
+            for raiz, erro in r["falhas"]:
+                print(f"✗ {raiz}: {erro}")
+
+    with ProcessPoolExecutor(max_workers=processos, mp_context=contexto,
+                             initializer=_iniciar_processo, initargs=(forcar,)) as executor:
+        for itens in ler_versoes(raizes, desde, ate, lote):
+            # no máximo 2 lotes por processo em voo: o arquivo é lido no ritmo da gravação
+            while len(em_voo) >= 2 * processos:
+                feitos, _ = concurrent.futures.wait(em_voo, return_when=concurrent.futures.FIRST_COMPLETED)
+                colher(feitos)
+            em_voo.add(executor.submit(_reprocessar_lote, itens))
+            if time.monotonic() - ultimo_relatorio >= intervalo:
+                ultimo_relatorio = time.monotonic()
+                print(vazao.linha(), flush=True)
+        colher(concurrent.futures.wait(em_voo)[0])
+    return vazao
+
+
+def _data(texto):
+    return datetime.fromisoformat(texto) if texto else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Regrava as tabelas cisp_* a partir de cisp_payload_raw, sem chamar a CISP")
+    parser.add_argument("raizes", nargs="*", help="raízes a reprocessar (padrão: todas as arquivadas)")
+    parser.add_argument("--arquivo", help="arquivo texto/CSV com uma raiz por linha (primeira coluna)")
+    parser.add_argument("--desde", help="última versão buscada a partir de (AAAA-MM-DD[THH:MM])")
+    parser.add_argument("--ate", help="última versão buscada antes de (AAAA-MM-DD[THH:MM])")
+    parser.add_argument("--processos", type=int, default=PROCESSOS_PADRAO, help=f"processos gravando (padrão {PROCESSOS_PADRAO})")
+    parser.add_argument("--lote", type=int, default=100, help="raízes por transação (padrão 100)")
+    parser.add_argument("--pular-inalterados", action="store_true",
+                        help="respeita as assinaturas das seções (só regrava tabelas filhas cujo conteúdo mapeado mudou)")
+    parser.add_argument("--intervalo", type=float, default=10.0, help="segundos entre as linhas de progresso")
+    args = parser.parse_args()
+
+    raizes = list(args.raizes)
+    if args.arquivo:
+        with open(args.arquivo, encoding="utf-8-sig") as f:
+            raizes += raizes_de_csv(f.read())
+    raizes = deduplicar(raizes) or None
+    desde, ate = _data(args.desde), _data(args.ate)
+
+    total, tamanho = contar(raizes, desde, ate)
+    print(f"\n{'='*60}")
+    print(f"REPROCESSAMENTO: {total} raízes ({tamanho / 1e6:.1f} MB de JSON) | "
+          f"{args.processos} processos | commit a cada {args.lote} | 0 chamadas à CISP")
+    print(f"{'='*60}")
+    vazao = reprocessar(
+        raizes, desde, ate, processos=max(1, args.processos), lote=max(1, args.lote),
+        forcar=not args.pular_inalterados, intervalo=args.intervalo,
+    )
+    decorrido = time.monotonic() - vazao.inicio
+    print(f"\n{'='*60}")
+    print("RESUMO DO REPROCESSAMENTO")
+    print(f"{'='*60}")
+    print(vazao.linha())
+    print(f"✓ Regravadas: {vazao.ok} | ✗ Falhas: {vazao.falhas} | {vazao.linhas} linhas alteradas em {decorrido:.1f}s")
+    print(f"{'='*60}\n")
+    sys.exit(1 if vazao.falhas else 0)
@@ -19,4 +19,5 @@ else
 fi
 cd "$APP_DIR"
 docker compose -f "$COMPOSE_FILE" build
+docker compose -f "$COMPOSE_FILE" run --rm --no-deps web python migracoes.py aplicar --concorrente
 docker compose -f "$COMPOSE_FILE" up -d
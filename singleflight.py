@@ -0,0 +1,65 @@
+"""
+SINGLE-FLIGHT: UMA EXECUÇÃO POR CHAVE
+
+Quando várias threads pedem a mesma raiz ao mesmo tempo, só a primeira
+(líder) executa a busca/gravação; as demais esperam e recebem o mesmo
+resultado (ou a mesma exceção).
+
+Vale dentro do processo. Entre processos/containers a gravação de uma raiz é
+serializada pelo advisory lock do Postgres (ver gravar_payload no app.py).
+"""
+
+import threading
+
+
+class _Chamada:
+    __slots__ = ("evento", "resultado", "erro", "espera")
+
+    def __init__(self):
+        self.evento = threading.Event()
+        self.resultado = None
+        self.erro = None
+        self.espera = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._chamadas = {}
+        self._lock = threading.Lock()
+        self._stats = {"executadas": 0, "compartilhadas": 0}
+
+    def executar(self, chave, fn, *args, **kwargs):
+        """Executa fn(*args, **kwargs) uma vez por chave entre chamadas concorrentes"""
+        with self._lock:
+            chamada = self._chamadas.get(chave)
+            lider = chamada is None
+            if lider:
+                chamada = self._chamadas[chave] = _Chamada()
+                self._stats["executadas"] += 1
+            else:
+                chamada.espera += 1
+                self._stats["compartilhadas"] += 1
+
+        if not lider:
+            chamada.evento.wait()
+            if chamada.erro is not None:
+                raise chamada.erro
+            return chamada.resultado
+
+        try:
+            chamada.resultado = fn(*args, **kwargs)
+            return chamada.resultado
+        except BaseException as e:
+            chamada.erro = e
+            raise
+        finally:
+            with self._lock:
+                self._chamadas.pop(chave, None)
+            chamada.evento.set()
+
+    def estatisticas(self):
+        with self._lock:
+            return {"em_andamento": len(self._chamadas), **self._stats}
+
+
+voo_unico = SingleFlight()
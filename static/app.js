@@ -88,18 +88,11 @@
     }
   }
 
-  async function sincronizar(raiz) {
-    const r = await fetch(`/api/sincronizar/${raiz}`);
-    if (!r.ok) {
-      let msg = "Falha ao sincronizar";
-      try { const j = await r.json(); msg = j.mensagem || msg; } catch {}
-      throw new Error(msg);
-    }
-    return true;
-  }
-
-  async function obter(raiz) {
-    const r = await fetch(`/api/cliente/${raiz}`);
+  // Consulta combinada: o backend busca na CISP uma única vez, grava e devolve o documento.
+  // Com somenteLeitura=true lê apenas o Postgres (sem chamada à CISP).
+  async function obter(raiz, somenteLeitura) {
+    const url = somenteLeitura ? `/api/cliente/${raiz}?modo=leitura` : `/api/cliente/${raiz}`;
+    const r = await fetch(url);
     const j = await r.json();
     if (!r.ok || !j.success) {
       throw new Error(j.erro || "Falha ao obter dados");
@@ -107,6 +100,16 @@
     return j;
   }
 
+  function descreverOrigem(data) {
+    const idade = data.idade_segundos;
+    const min = idade != null ? Math.round(idade / 60) : null;
+    const quando = min == null ? "" : (min < 1 ? " (há menos de 1 min)" : ` (há ${min} min)`);
+    if (data.origem === "banco") return ` • dados do Postgres${quando}`;
+    if (data.origem === "cache") return ` • dados em cache${quando}`;
+    if (data.origem === "cisp") return " • dados atualizados na CISP";
+    return "";
+  }
+
   function clearLists() {
     $("tblRestritivas").innerHTML = "";
     $("tblConsultas").innerHTML = "";
@@ -356,20 +359,9 @@
       return;
     }
 
-    setLoading(true, "Consultando no Postgres...");
+    setLoading(true, "Consultando CISP e Postgres...");
     try {
-      let data = await obter(raiz);
-      const p = data.principal || {};
-      const vazio = !p.razao_social && !p.cnpj && !p.nome_fantasia && !p.cidade && !p.uf;
-      if (vazio) {
-        setStatus("work", "Buscando na API CISP...");
-        try {
-          await sincronizar(raiz);
-          data = await obter(raiz);
-        } catch (e) {
-          // mantém data original se API não retornar
-        }
-      }
+      const data = await obter(raiz);
       render(data);
       addChip(raiz);
       const p2 = data.principal || {};
@@ -377,7 +369,7 @@
       if (vazio2) {
         setStatus("warn", "Sem dados para esta raiz no Postgres/API.");
       } else {
-        setStatus("ok", "Consulta concluída.");
+        setStatus("ok", `Consulta concluída${descreverOrigem(data)}.`);
       }
     } catch (e) {
       showEmptyState();
@@ -445,7 +437,7 @@
     $("btnBaixarJson").addEventListener("click", async () => {
       const raiz = normalizarRaiz($("raiz").value);
       try {
-        const data = await obter(raiz);
+        const data = await obter(raiz, true);
         downloadJson(data, raiz);
       } catch (e) {
         notify("Não foi possível baixar o JSON.");
@@ -0,0 +1,54 @@
+import os
+import sys
+import importlib
+
+import pytest
+
+# módulos ficam na raiz do repositório (sem pacote)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class CursorFalso:
+    """Guarda os statements; rowcount fixo para os DELETEs"""
+
+    def __init__(self, rowcount=0):
+        self.executados = []
+        self.rowcount = rowcount
+
+    def execute(self, sql, params=None):
+        self.executados.append((sql, params))
+
+    @property
+    def sqls(self):
+        return [sql for sql, _ in self.executados]
+
+
+@pytest.fixture
+def cursor_falso():
+    return CursorFalso
+
+
+@pytest.fixture
+def esquema_de(monkeypatch):
+    """
+    Snapshot com os specs registrados pelo app.py compilados contra as colunas
+    dadas ({tabela: [colunas]}); vira o esquema.atual() do teste, sem PREPARE
+    """
+    importlib.import_module("app")   # registra os specs
+    import esquema as modulo
+    from esquema import esquema, Esquema, _compilar
+
+    monkeypatch.setattr(modulo, "USAR_PREPARED", False)
+
+    def montar(colunas, unicos=None, tipos=None):
+        unicos, tipos = unicos or {}, tipos or {}
+        colunas = {t: tuple(c) for t, c in colunas.items()}
+        mapeadores = {
+            t: _compilar(1, t, spec, chave, colunas[t], unicos.get(t, set()), tipos.get(t, {}))
+            for t, (spec, chave) in esquema._specs.items() if t in colunas
+        }
+        snap = Esquema(1, colunas, unicos, mapeadores, tipos)
+        monkeypatch.setattr(esquema, "atual", lambda cursor=None: snap)
+        return snap
+
+    return montar
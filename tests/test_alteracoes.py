@@ -0,0 +1,24 @@
+from datetime import datetime
+
+import pytest
+
+import alteracoes
+
+
+def test_cursor_ida_e_volta():
+    desde, ate, ts = datetime(2026, 1, 1), datetime(2026, 2, 1, 12, 30), datetime(2026, 1, 15, 8, 0, 1, 500)
+    token = alteracoes.codificar_cursor(desde, ate, ts, "12345678")
+    assert "=" not in token
+    assert alteracoes.decodificar_cursor(token) == (desde, ate, ts, "12345678")
+
+
+def test_cursor_sem_desde():
+    ate = datetime(2026, 2, 1)
+    token = alteracoes.codificar_cursor(None, ate, ate, "1")
+    assert alteracoes.decodificar_cursor(token)[0] is None
+
+
+@pytest.mark.parametrize("token", ["", "lixo", "e30"])
+def test_cursor_invalido(token):
+    with pytest.raises(alteracoes.CursorInvalido):
+        alteracoes.decodificar_cursor(token)
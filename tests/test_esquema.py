@@ -0,0 +1,51 @@
+import pytest
+
+import esquema as modulo
+from esquema import Esquema, RegistroEsquema, _compilar
+
+
+class Conexao:
+    pass
+
+
+class CursorPrepare:
+    """Falha no statement que contém `falhar` (uma vez só)"""
+
+    def __init__(self, falhar=None):
+        self.connection = Conexao()
+        self.falhar = falhar
+        self.executados = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.executados.append(sql)
+        if self.falhar and self.falhar in sql:
+            self.falhar = None
+            raise RuntimeError("PREPARE falhou")
+
+
+def _snap():
+    spec = [(modulo.OPCOES_RAIZ, lambda raiz, item: raiz), (["codigo"], lambda raiz, item: item)]
+    mapeadores = {
+        t: _compilar(1, t, spec, (), ("raiz", "codigo"), set(), {})
+        for t in ("cisp_a", "cisp_b")
+    }
+    return Esquema(1, {t: ("raiz", "codigo") for t in mapeadores}, {}, mapeadores)
+
+
+def test_prepare_que_falha_nao_marca_a_conexao(monkeypatch):
+    monkeypatch.setattr(modulo, "USAR_PREPARED", True)
+    registro, snap = RegistroEsquema(), _snap()
+    cursor = CursorPrepare(falhar="PREPARE cisp_v1_del_cisp_b")
+
+    with pytest.raises(RuntimeError):
+        registro.apagar_raiz(cursor, snap, snap.mapeadores["cisp_a"], "12345678")
+    assert cursor.executados[-1] == "ROLLBACK TO SAVEPOINT cisp_prepare"
+    assert registro._preparados[cursor.connection] is None
+
+    # os PREPAREs que deram certo continuam na sessão: a próxima vez começa do zero
+    cursor.executados.clear()
+    registro.apagar_raiz(cursor, snap, snap.mapeadores["cisp_a"], "12345678")
+    assert cursor.executados[:2] == ["SAVEPOINT cisp_prepare", "DEALLOCATE ALL"]
+    assert cursor.executados[-1] == "EXECUTE cisp_v1_del_cisp_a (%s)"
+    assert registro._preparados[cursor.connection] == 1
@@ -0,0 +1,53 @@
+from datetime import datetime
+
+import pytest
+
+import exportacao
+from esquema import Esquema
+
+
+@pytest.fixture
+def snap():
+    return Esquema(1, {
+        "cisp_avaliacao_analitica": ("raiz", "razao_social", "uf", "rating_atual", "data_atualizacao"),
+        "cisp_restritivas": ("id", "raiz", "codigo_associada"),
+    }, {}, {})
+
+
+def _filtros(**kw):
+    return {"raizes": [], "uf": [], "rating": [], "desde": None, "ate": None, **kw}
+
+
+def test_montar_consulta_sem_filtros(snap):
+    colunas, sql, params = exportacao.montar_consulta(snap, "cisp_restritivas", _filtros())
+    assert colunas == ["id", "raiz", "codigo_associada"]
+    assert sql == "SELECT t.id, t.raiz, t.codigo_associada FROM cisp_restritivas t ORDER BY t.raiz"
+    assert params == {}
+
+
+def test_montar_consulta_filtros_da_principal(snap):
+    _, sql, params = exportacao.montar_consulta(snap, "cisp_avaliacao_analitica", _filtros(
+        uf=["SP"], rating=["A"], desde=datetime(2026, 1, 1),
+    ))
+    assert "t.uf = ANY(%(uf)s)" in sql
+    assert "t.rating_atual = ANY(%(rating)s)" in sql
+    assert "t.data_atualizacao >= %(desde)s" in sql
+    assert set(params) == {"uf", "rating", "desde"}
+
+
+def test_montar_consulta_filha_filtra_pela_principal(snap):
+    _, sql, params = exportacao.montar_consulta(snap, "cisp_restritivas", _filtros(raizes=["12345678"], uf=["SP"]))
+    assert "t.raiz = ANY(%(raizes)s)" in sql
+    assert "t.raiz IN (SELECT p.raiz FROM cisp_avaliacao_analitica p WHERE p.uf = ANY(%(uf)s))" in sql
+    assert params == {"raizes": ["12345678"], "uf": ["SP"]}
+
+
+@pytest.mark.parametrize("tabela", ["pg_authid", "cisp_alertas"])
+def test_montar_consulta_tabela_recusada(snap, tabela):
+    with pytest.raises(ValueError):
+        exportacao.montar_consulta(snap, tabela, _filtros())
+
+
+def test_filtros_de_raiz_invalida():
+    with pytest.raises(ValueError):
+        exportacao.filtros_de({"raizes": "12345678,123"})
@@ -0,0 +1,75 @@
+import importlib
+
+app = importlib.import_module("app")
+
+# ordem do banco diferente da do spec; "id" não é mapeada
+CONSULTAS = ["id", "quantidade_consultas", "raiz", "mes_ano"]
+ITENS = [{"data": "2026-09", "consultas": 4}, {"data": "2026-10", "consultas": 7}]
+
+
+def _capturar(monkeypatch):
+    chamadas = []
+    monkeypatch.setattr(app, "execute_values", lambda cursor, sql, linhas, page_size: chamadas.append((sql, linhas, page_size)))
+    return chamadas
+
+
+def test_gravar_filhas_insere_em_lote_na_ordem_do_spec(esquema_de, cursor_falso, monkeypatch):
+    esquema_de({"cisp_consultas_mensais": CONSULTAS})
+    monkeypatch.setattr(app, "MODO_FILHAS", "substituir")
+    chamadas = _capturar(monkeypatch)
+    cursor = cursor_falso(rowcount=1)
+
+    n = app.gravar_filhas(cursor, app.esquema.atual(), "cisp_consultas_mensais", "12345678", ITENS)
+
+    assert n == {"inseridas": 2, "atualizadas": 0, "apagadas": 1}
+    assert cursor.sqls == ["DELETE FROM cisp_consultas_mensais WHERE raiz = %s"]
+    assert chamadas == [(
+        "INSERT INTO cisp_consultas_mensais (raiz, mes_ano, quantidade_consultas) VALUES %s",
+        [("12345678", "2026-09", 4), ("12345678", "2026-10", 7)],
+        app.BULK_PAGE_SIZE,
+    )]
+
+
+def test_gravar_filhas_chave_repetida_cai_no_insert_em_lote(esquema_de, cursor_falso, monkeypatch):
+    esquema_de({"cisp_consultas_mensais": CONSULTAS})
+    chamadas = _capturar(monkeypatch)
+    cursor = cursor_falso()
+
+    itens = ITENS + [{"data": "2026-10", "consultas": 8}]
+    n = app.gravar_filhas(cursor, app.esquema.atual(), "cisp_consultas_mensais", "12345678", itens)
+
+    assert n["inseridas"] == 3
+    assert [linha for _, linhas, _ in chamadas for linha in linhas][-1] == ("12345678", "2026-10", 8)
+
+
+class _Conexao:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _sincronizar(monkeypatch, gravou):
+    arquivados = []
+    monkeypatch.setattr(app.cliente_cisp, "buscar_json", lambda raiz: ({"raiz": raiz}, 20))
+    monkeypatch.setattr(app, "ler_arquivo", lambda raiz, max_age=None: None)
+    monkeypatch.setattr(app, "arquivar_payload", lambda raiz, payload: arquivados.append(raiz))
+    monkeypatch.setattr(app, "conexao", _Conexao)
+    monkeypatch.setattr(app, "_inserir_no_postgres", lambda conn, raiz, payload, forcar: gravou)
+    app.cache_payload.invalidar()
+    resultado = app._sincronizar_raiz("87654321", None, False, False)
+    return resultado, arquivados
+
+
+def test_payload_so_vai_para_o_cache_depois_de_gravado(monkeypatch):
+    (_, do_cache, gravou), arquivados = _sincronizar(monkeypatch, None)
+    assert (do_cache, gravou) == (False, None)
+    assert app.cache_payload.obter("87654321") is None
+    assert arquivados == []
+
+    (_, do_cache, gravou), arquivados = _sincronizar(monkeypatch, {"secoes_gravadas": []})
+    assert gravou is not None
+    assert app.cache_payload.obter("87654321") == {"raiz": "87654321"}
+    assert arquivados == ["87654321"]
+    app.cache_payload.invalidar()
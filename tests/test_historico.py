@@ -0,0 +1,21 @@
+from datetime import date
+
+import pytest
+
+import historico
+
+
+@pytest.mark.parametrize("mes, n, esperado", [
+    (date(2026, 10, 1), 0, date(2026, 10, 1)),
+    (date(2026, 10, 1), 3, date(2027, 1, 1)),
+    (date(2026, 1, 1), -1, date(2025, 12, 1)),
+    (date(2026, 10, 1), -36, date(2023, 10, 1)),
+])
+def test_somar_meses(mes, n, esperado):
+    assert historico._somar_meses(mes, n) == esperado
+
+
+def test_mes_da_particao():
+    assert historico._mes_da_particao(historico.nome_particao(date(2026, 10, 1))) == date(2026, 10, 1)
+    assert historico._mes_da_particao("cisp_historico_p2026") is None
+    assert historico._mes_da_particao("cisp_historico_default") is None
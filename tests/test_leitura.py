@@ -0,0 +1,31 @@
+from esquema import Esquema
+import leitura
+
+
+def _snap(tipos):
+    colunas = {t: tuple(c) for t, c in tipos.items()}
+    return Esquema(1, colunas, {}, {}, tipos)
+
+
+def test_raiz_nao_texto_compara_no_tipo_da_coluna():
+    snap = _snap({
+        leitura.TABELA_PRINCIPAL: {"raiz": "bigint", "razao_social": "text"},
+        leitura.TABELA_DERIVADAS: {"raiz": "bigint", "rating_atual": "text"},
+        "cisp_restritivas": {"raiz_cnpj": "integer", "tipo": "text"},
+        leitura.TABELA_RATINGS: {"raiz": "bigint", "data": "date"},
+    })
+    sql = leitura.compilar(snap)
+    assert "t.raiz = k.raiz::bigint" in sql
+    assert "d.raiz = k.raiz::bigint" in sql
+    assert "t.raiz_cnpj = k.raiz::integer" in sql
+    assert "= k.raiz)" not in sql and "= k.raiz " not in sql
+
+
+def test_raiz_texto_sem_cast():
+    snap = _snap({
+        leitura.TABELA_PRINCIPAL: {"raiz": "character varying(8)", "razao_social": "text"},
+        "cisp_alertas": {"raiz": "text", "tipo": "text"},
+    })
+    sql = leitura.compilar(snap)
+    assert "k.raiz::" not in sql
+    assert "t.raiz = k.raiz LIMIT 1" in sql
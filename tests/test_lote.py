@@ -0,0 +1,19 @@
+import pytest
+
+import lote
+
+
+@pytest.mark.parametrize("valor, raiz", [
+    ("45543915", "45543915"),
+    ("45.543.915/0001-20", "45543915"),
+    (45543915000120, "45543915"),
+    ("1234567", None),
+    ("", None),
+    (None, None),
+])
+def test_normalizar_raiz(valor, raiz):
+    assert lote.normalizar_raiz(valor) == raiz
+
+
+def test_deduplicar_mantem_a_ordem():
+    assert lote.deduplicar(["22222222", "11111111000199", "x", "22222222"]) == ["22222222", "11111111"]
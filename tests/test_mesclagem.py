@@ -0,0 +1,72 @@
+import importlib
+
+import mesclagem
+import derivados
+
+integracao = importlib.import_module("integração")
+
+
+COLUNAS = ["raiz", "codigo_associada", "razao_social"]
+
+
+def test_chaves_unicas():
+    assert mesclagem.chaves_unicas([("1", 10, "a"), ("1", 11, "a")], [1])
+    assert not mesclagem.chaves_unicas([("1", 10, "a"), ("1", 10, "b")], [1])
+    assert mesclagem.chaves_unicas([], [1])
+
+
+def test_compilar_um_statement_com_casts_e_contagens():
+    sql = mesclagem.compilar("cisp_x", COLUNAS, ["codigo_associada"], "raiz", {"codigo_associada": "integer"})
+    assert sql.count("%s") == 1
+    assert "v.codigo_associada::integer AS codigo_associada" in sql
+    assert "v.razao_social::text AS razao_social" in sql
+    assert "t.codigo_associada IS NOT DISTINCT FROM e.codigo_associada" in sql
+    assert "UPDATE cisp_x t SET razao_social = e.razao_social" in sql
+    assert sql.rstrip().endswith("(SELECT count(*) FROM apagadas)")
+
+
+def test_compilar_sem_colunas_fora_da_chave_nao_atualiza():
+    sql = mesclagem.compilar("cisp_x", ["raiz", "mes"], ["mes"], "raiz", {})
+    assert "UPDATE" not in sql
+    assert "atualizadas AS (SELECT 1 WHERE false)" in sql
+
+
+def test_mesclar_sem_linhas_nao_executa_nada(cursor_falso):
+    cursor = cursor_falso()
+    assert mesclagem.mesclar(cursor, "SQL", []) == {"inseridas": 0, "atualizadas": 0, "apagadas": 0}
+    assert cursor.executados == []
+
+
+def _integracao(cursor):
+    i = integracao.CISPIntegration(transacao_externa=True, verboso=False)
+    i.cursor = cursor
+    return i
+
+
+def test_cli_grava_filhas_sem_itens_apagando_as_da_raiz(esquema_de, cursor_falso):
+    esquema_de({"cisp_associadas_consultaram": COLUNAS})
+    cursor = cursor_falso(rowcount=3)
+    n = _integracao(cursor)._gravar_filhas("cisp_associadas_consultaram", "12345678", [])
+    assert n == {"inseridas": 0, "atualizadas": 0, "apagadas": 3}
+    assert cursor.executados == [("DELETE FROM cisp_associadas_consultaram WHERE raiz = %s", ("12345678",))]
+
+
+def test_inserir_derivados_sem_ratings_nem_positivas(esquema_de, cursor_falso):
+    esquema_de({
+        derivados.TABELA_RATINGS: ["raiz", "data", "classificacao"],
+        derivados.TABELA_POSITIVAS: ["raiz", "segmento", "codigo_associada"],
+        derivados.TABELA_DERIVADAS: ["raiz", "rating_atual", "calculado_em"],
+    }, unicos={derivados.TABELA_DERIVADAS: {("raiz",)}})
+    cursor = cursor_falso(rowcount=2)
+    assert _integracao(cursor).inserir_derivados("12345678", {"informacaoSuporte": {}})
+    assert f"DELETE FROM {derivados.TABELA_RATINGS} WHERE raiz = %s" in cursor.sqls
+    assert f"DELETE FROM {derivados.TABELA_POSITIVAS} WHERE raiz = %s" in cursor.sqls
+    assert any(s.startswith(f"INSERT INTO {derivados.TABELA_DERIVADAS}") for s in cursor.sqls)
+    assert "ROLLBACK TO SAVEPOINT integracao" not in cursor.sqls
+
+
+def test_cli_secao_vazia_limpa_as_linhas_da_raiz(esquema_de, cursor_falso):
+    esquema_de({"cisp_restritivas": ["id", "raiz", "codigo_associada", "data_ocorrencia"]})
+    cursor = cursor_falso(rowcount=2)
+    assert _integracao(cursor).inserir_restritivas("12345678", {"restritivas": []})
+    assert "DELETE FROM cisp_restritivas WHERE raiz = %s" in cursor.sqls